@@ -7,10 +7,17 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import sqlite3
+import sys
 from pathlib import Path
 import json
 
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+from metrics import DELAY_CHART_LABELS, MODERATE_MINS, category_counts, group_delay_stats, on_time_rate  # noqa: E402
+from incremental_loader import IncrementalLoader  # noqa: E402
+from analytics import BusAnalytics  # noqa: E402
+from db import ReadPool  # noqa: E402
+from query_cache import QueryCache  # noqa: E402
+
 # Page config
 st.set_page_config(
     page_title="Dublin Bus Analytics",
@@ -53,35 +60,83 @@ st.markdown("""
 DB_PATH = Path(__file__).parent / "data" / "dublin_bus.db"
 
 
-@st.cache_data(ttl=60)
-def load_data():
-    """Load data from SQLite database"""
-    conn = sqlite3.connect(DB_PATH)
-    
-    positions = pd.read_sql("SELECT * FROM vehicle_positions", conn)
-    updates = pd.read_sql("SELECT * FROM trip_updates", conn)
-    
-    conn.close()
-    
-    positions['collected_at'] = pd.to_datetime(positions['collected_at'])
-    updates['collected_at'] = pd.to_datetime(updates['collected_at'])
-    updates['arrival_delay_mins'] = updates['arrival_delay'] / 60
-    
-    return positions, updates
+# Sidebar time ranges, in hours back from the newest data (None = all time)
+TIME_RANGES = {
+    "Last hour": 1,
+    "Last 6 hours": 6,
+    "Last 24 hours": 24,
+    "Last 7 days": 24 * 7,
+    "All time": None,
+}
+
+# Map viewports: (min_lat, min_lon, max_lat, max_lon) and zoom level
+VIEWPORTS = {
+    "Dublin City Centre": ((53.325, -6.31, 53.365, -6.22), 13),
+    "Greater Dublin": ((53.20, -6.50, 53.62, -6.00), 10),
+    "All Ireland": ((51.30, -10.70, 55.45, -5.40), 6),
+}
+
+
+@st.cache_resource
+def get_read_pool():
+    """Read-only connections shared by every session; they never block the collector"""
+    return ReadPool(DB_PATH, size=8)
+
+
+@st.cache_resource
+def get_query_cache():
+    """Query results shared by every session, recomputed only when new data lands"""
+    return QueryCache()
+
+
+@st.cache_resource
+def get_loader():
+    """One incremental loader shared by every session"""
+    return IncrementalLoader(DB_PATH, pool=get_read_pool())
+
 
+def load_data(hours=None):
+    """Pull new rows into the shared loader and return the selected time range"""
+    loader = get_loader()
+    loader.refresh()
+    start = loader.latest - pd.Timedelta(hours=hours) if hours and loader.latest is not None else None
+    return loader.frames(start=start)
 
-def create_map(positions_df):
+
+def load_live_vehicles(bbox=None):
+    """Current position of each vehicle still in the feed, inside the viewport"""
+    analytics = BusAnalytics(DB_PATH, pool=get_read_pool(), cache=get_query_cache())
+    try:
+        return analytics.get_latest_positions(bbox)
+    finally:
+        analytics.close()
+
+
+def load_heatmap_bins(zoom, bbox, start=None):
+    """Position density for the viewport, pre-binned at the zoom's grid level"""
+    analytics = BusAnalytics(DB_PATH, pool=get_read_pool(), cache=get_query_cache())
+    try:
+        return analytics.get_heatmap_bins(zoom, bbox, start=start)
+    finally:
+        analytics.close()
+
+
+def viewport_center(bbox):
+    """Map center of a bounding box"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return dict(lat=(min_lat + max_lat) / 2, lon=(min_lon + max_lon) / 2)
+
+
+def create_map(latest_df, bbox, zoom=10):
     """Create an interactive map with bus positions"""
-    latest = positions_df.sort_values('collected_at').groupby('vehicle_id').last().reset_index()
-    
     fig = px.scatter_mapbox(
-        latest,
+        latest_df,
         lat='latitude',
         lon='longitude',
         color='route_id',
         hover_name='vehicle_id',
         hover_data=['route_id', 'direction_id'],
-        zoom=10,
+        zoom=zoom,
         height=600,
         title="Live Bus Positions"
     )
@@ -89,7 +144,7 @@ def create_map(positions_df):
     fig.update_layout(
         mapbox_style="carto-darkmatter",
         mapbox=dict(
-            center=dict(lat=53.35, lon=-6.26)
+            center=viewport_center(bbox)
         ),
         margin=dict(l=0, r=0, t=40, b=0),
         paper_bgcolor='rgba(0,0,0,0)',
@@ -101,23 +156,22 @@ def create_map(positions_df):
     return fig
 
 
-def create_heatmap(positions_df):
-    """Create a density heatmap"""
-    latest = positions_df.sort_values('collected_at').groupby('vehicle_id').last().reset_index()
-    
+def create_heatmap(bins_df, bbox, zoom=10):
+    """Create a density heatmap from pre-aggregated bins"""
     fig = px.density_mapbox(
-        latest,
+        bins_df,
         lat='latitude',
         lon='longitude',
-        radius=20,
-        zoom=10,
+        z='count',
+        radius=12,
+        zoom=zoom,
         height=500,
         title="Bus Density Heatmap"
     )
     
     fig.update_layout(
         mapbox_style="carto-darkmatter",
-        mapbox=dict(center=dict(lat=53.35, lon=-6.26)),
+        mapbox=dict(center=viewport_center(bbox)),
         margin=dict(l=0, r=0, t=40, b=0),
         paper_bgcolor='rgba(0,0,0,0)',
         font=dict(color='white')
@@ -190,12 +244,8 @@ def create_delay_gauge(on_time_pct):
 
 def create_route_performance_chart(updates_df):
     """Create route performance bar chart"""
-    route_stats = updates_df.groupby('route_id').agg({
-        'arrival_delay_mins': ['mean', 'count']
-    }).round(2)
-    route_stats.columns = ['avg_delay', 'count']
-    route_stats = route_stats.reset_index()
-    route_stats = route_stats[route_stats['count'] >= 10].sort_values('avg_delay', ascending=True).head(20)
+    route_stats = group_delay_stats(updates_df, 'route_id')
+    route_stats = route_stats[route_stats['sample_count'] >= 10].sort_values('avg_delay', ascending=True).head(20)
     
     colors = ['#10b981' if x < 0 else '#ef4444' if x > 5 else '#f59e0b' for x in route_stats['avg_delay']]
     
@@ -250,26 +300,13 @@ def create_activity_timeline(positions_df):
 
 def create_delay_categories_pie(updates_df):
     """Create pie chart of delay categories"""
-    def categorize(mins):
-        if mins < -1:
-            return 'Early (>1 min)'
-        elif mins <= 1:
-            return 'On Time (±1 min)'
-        elif mins <= 5:
-            return 'Slight (1-5 min)'
-        elif mins <= 15:
-            return 'Moderate (5-15 min)'
-        else:
-            return 'Severe (>15 min)'
-    
-    updates_df['category'] = updates_df['arrival_delay_mins'].apply(categorize)
-    category_counts = updates_df['category'].value_counts()
+    counts = category_counts(updates_df['arrival_delay_mins'], DELAY_CHART_LABELS)
     
     colors = ['#10b981', '#3b82f6', '#f59e0b', '#f97316', '#ef4444']
     
     fig = px.pie(
-        values=category_counts.values,
-        names=category_counts.index,
+        values=counts.values,
+        names=counts.index,
         title="Delay Categories",
         color_discrete_sequence=colors,
         hole=0.4
@@ -290,9 +327,18 @@ def main():
     st.markdown("*Real-time insights from Transport for Ireland's GTFS-Realtime API*")
     st.markdown("---")
     
+    with st.sidebar:
+        time_range = st.selectbox("Time range", list(TIME_RANGES), index=2)
+        viewport = st.selectbox("Map area", list(VIEWPORTS), index=1)
+    bbox, zoom = VIEWPORTS[viewport]
+    
     # Load data
     try:
-        positions, updates = load_data()
+        positions, updates = load_data(TIME_RANGES[time_range])
+        live = load_live_vehicles()
+        visible = load_live_vehicles(bbox)
+        start = positions['collected_at'].min() if len(positions) else None
+        bins = load_heatmap_bins(zoom, bbox, start)
     except Exception as e:
         st.error(f"Error loading data: {e}")
         st.info("Run the data collector first: `python src/data_collector.py --once`")
@@ -321,12 +367,12 @@ def main():
     # Key Metrics Row
     col1, col2, col3, col4 = st.columns(4)
     
-    on_time_pct = (updates['arrival_delay_mins'].abs() <= 1).mean() * 100
+    on_time_pct = on_time_rate(updates['arrival_delay_mins'])
     avg_delay = updates['arrival_delay_mins'].mean()
-    severe_pct = (updates['arrival_delay_mins'] > 15).mean() * 100
+    severe_pct = (updates['arrival_delay_mins'].dropna() > MODERATE_MINS).mean() * 100
     
     with col1:
-        st.metric("🚌 Active Buses", positions['vehicle_id'].nunique())
+        st.metric("🚌 Active Buses", len(live))
     with col2:
         st.metric("✅ On-Time Rate", f"{on_time_pct:.1f}%")
     with col3:
@@ -342,9 +388,9 @@ def main():
     with tab1:
         col1, col2 = st.columns([2, 1])
         with col1:
-            st.plotly_chart(create_map(positions), use_container_width=True)
+            st.plotly_chart(create_map(visible, bbox, zoom), use_container_width=True)
         with col2:
-            st.plotly_chart(create_heatmap(positions), use_container_width=True)
+            st.plotly_chart(create_heatmap(bins, bbox, zoom), use_container_width=True)
     
     with tab2:
         col1, col2 = st.columns([1, 1])
@@ -360,7 +406,7 @@ def main():
         
         # Top performing routes
         st.markdown("### 🏆 Best Performing Routes")
-        route_stats = updates.groupby('route_id').agg({
+        route_stats = updates.groupby('route_id', observed=True).agg({
             'arrival_delay_mins': 'mean'
         }).round(2).reset_index()
         route_stats.columns = ['Route ID', 'Avg Delay (mins)']
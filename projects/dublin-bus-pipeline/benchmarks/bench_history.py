@@ -0,0 +1,145 @@
+"""
+History Tier Benchmark
+Replays the data/raw snapshots over a month (--days) of simulated service,
+--cycles-per-day cycles a day, into SQLite with the Parquet history tier
+attached, compacts it, then times the full-history BusAnalytics scans on
+SQLite, pyarrow and DuckDB, checking that every engine returns the same rows
+
+    python benchmarks/bench_history.py --days 30 --cycles-per-day 48
+
+The database and history directory are cached in benchmarks/.cache per
+(days, cycles per day), so repeated runs only pay for the build once.
+"""
+import shutil
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from config import RAW_DATA_DIR  # noqa: E402
+from data_collector import DataCollector  # noqa: E402
+from analytics import BusAnalytics  # noqa: E402
+from history import ENGINES, compact, duckdb  # noqa: E402
+from partitions import read_range  # noqa: E402
+from bench_suite import CACHE_DIR, DB_START, load_snapshots, measure, shifted_cycle, summarize  # noqa: E402
+
+
+def _dir_mb(path: Path) -> float:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) / 1e6
+
+
+def build(db_path: Path, history_dir: Path, days: int, cycles_per_day: int, snapshots: list) -> int:
+    """Write recorded cycles in rotation, evenly spaced over `days`, then compact"""
+    cycles = [
+        (DataCollector.parse_vehicle_positions(vehicles), DataCollector.parse_trip_updates(updates),
+         int(vehicles["header"]["timestamp"]))
+        for vehicles, updates in snapshots
+    ]
+    collector = DataCollector(db_path=db_path, history_dir=history_dir)
+    spacing = timedelta(days=1) / cycles_per_day
+    rows = 0
+    start = time.perf_counter()
+    for cycle_index in range(days * cycles_per_day):
+        positions, updates, feed_time = cycles[cycle_index % len(cycles)]
+        collected_at = DB_START + cycle_index * spacing
+        positions, updates = shifted_cycle(positions, updates, feed_time, collected_at)
+        collector.writer.write_cycle(positions, updates, collected_at=collected_at)
+        rows += len(positions) + len(updates)
+        if (cycle_index + 1) % cycles_per_day == 0:
+            print(f"  day {(cycle_index + 1) // cycles_per_day}: {rows:,} rows "
+                  f"({rows / (time.perf_counter() - start):,.0f} rows/s)")
+    collector.writer.close()
+    collector.fetcher.close()
+
+    start = time.perf_counter()
+    partitions = compact(history_dir, before=DB_START + timedelta(days=days + 1))
+    print(f"  compacted {partitions} partitions in {time.perf_counter() - start:.1f}s")
+    return rows
+
+
+def _route_delays(analytics: BusAnalytics, route_id: str, start, end) -> pd.DataFrame:
+    """One route's arrival delays over a window, the raw read behind a delay trend"""
+    if analytics.history is not None:
+        return analytics.history.scan("trip_updates", ["collected_at", "arrival_delay"], start, end,
+                                      equals={"route_id": route_id}, not_null=("arrival_delay",))
+    return read_range(analytics.conn, """
+        SELECT collected_at, arrival_delay FROM trip_updates
+        WHERE route_id = ? AND arrival_delay IS NOT NULL AND collected_at >= ? AND collected_at <= ?
+    """, (route_id, str(start), str(end)), start, end)
+
+
+def cases(analytics: BusAnalytics, days: int) -> dict:
+    vehicle_id, route_id = analytics.conn.execute(
+        "SELECT vehicle_id, route_id FROM vehicle_latest ORDER BY vehicle_id LIMIT 1"
+    ).fetchone()
+    day_start = DB_START + timedelta(days=days // 2)
+    week_end = min(DB_START + timedelta(days=days), day_start + timedelta(days=7))
+    return {
+        "geographic_data": analytics.get_geographic_data,
+        "activity_by_time": analytics.get_activity_by_time,
+        "vehicle_trajectory_month": lambda: analytics.get_vehicle_trajectories(vehicle_id),
+        "trajectories_one_day": lambda: analytics.get_vehicle_trajectories(
+            start=day_start, end=day_start + timedelta(days=1)),
+        "route_delays_week": lambda: _route_delays(analytics, route_id, day_start, week_end),
+    }
+
+
+def _normalized(frame: pd.DataFrame) -> pd.DataFrame:
+    """Engine-independent form of a result: plain object/float columns in a fixed row order"""
+    frame = frame.copy()
+    for column in frame:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype) or frame[column].dtype == "string":
+            frame[column] = frame[column].astype(object).where(frame[column].notna(), None)
+        elif pd.api.types.is_numeric_dtype(frame[column]):
+            frame[column] = frame[column].astype("float64")
+    return frame.sort_values(list(frame.columns), ignore_index=True)
+
+
+def bench(db_path: Path, history_dir: Path, days: int, repeat: int) -> list:
+    engines = {"sqlite": None, **{name: engine(history_dir) for name, engine in ENGINES.items()
+                                  if name != "duckdb" or duckdb is not None}}
+    results, reference = [], {}
+    for name, history in engines.items():
+        analytics = BusAnalytics(db_path, history=history)
+        for case, query in cases(analytics, days).items():
+            query()  # warm the page cache so runs are comparable
+            latencies, peak, value = measure(query, repeat)
+            if case not in reference:
+                reference[case] = _normalized(value)
+            elif not reference[case].equals(_normalized(value)):
+                raise AssertionError(f"{case} on {name} differs from SQLite")
+            results.append(summarize("history", case, latencies, engine=name,
+                                     result_rows=len(value), peak_rss_mb=peak))
+            print(f"  {case:<26} {name:<7} p50 {results[-1]['p50_ms']:>9.1f} ms, "
+                  f"{len(value):>10,} rows, peak {peak:,.0f} MB")
+        analytics.close()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SQLite vs Parquet history scans")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--cycles-per-day", type=int, default=48)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the cached database and history")
+    args = parser.parse_args()
+
+    CACHE_DIR.mkdir(exist_ok=True)
+    db_path = CACHE_DIR / f"history_{args.days}d_{args.cycles_per_day}.db"
+    history_dir = CACHE_DIR / f"history_{args.days}d_{args.cycles_per_day}"
+    if args.rebuild or not db_path.exists() or not history_dir.exists():
+        for stale in CACHE_DIR.glob(f"{db_path.name}*"):
+            stale.unlink()
+        shutil.rmtree(history_dir, ignore_errors=True)
+        print(f"Building {args.days} days x {args.cycles_per_day} cycles...")
+        rows = build(db_path, history_dir, args.days, args.cycles_per_day, load_snapshots(RAW_DATA_DIR))
+        print(f"  {rows:,} rows written")
+
+    sqlite_mb = sum(path.stat().st_size for path in CACHE_DIR.glob(f"{db_path.name}*")) / 1e6
+    print(f"SQLite {sqlite_mb:,.1f} MB, Parquet {_dir_mb(history_dir):,.1f} MB")
+    bench(db_path, history_dir, args.days, args.repeat)
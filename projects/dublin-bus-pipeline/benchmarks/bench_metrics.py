@@ -0,0 +1,96 @@
+"""
+Delay Metrics Benchmark
+Times the original row-wise delay classification (Series.apply) and
+per-route stats (agg plus a groupby-apply on-time rate) against the
+vectorized metrics kernel on synthetic delays, and checks both agree
+
+    python benchmarks/bench_metrics.py --rows 1000000 5000000
+"""
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from metrics import category_counts, delay_summary, group_delay_stats  # noqa: E402
+
+
+def synthetic_updates(rows: int, routes: int = 300, seed: int = 7) -> pd.DataFrame:
+    """Skewed arrival delays (seconds) spread over `routes` route ids"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "route_id": rng.integers(0, routes, rows).astype(str),
+        "arrival_delay_mins": np.round(rng.lognormal(4, 1.2, rows) - 60) / 60,
+    })
+
+
+def categorize_delay(mins):
+    """The original per-row classifier"""
+    if mins < -1:
+        return 'Early'
+    elif mins <= 1:
+        return 'On Time'
+    elif mins <= 5:
+        return 'Slight Delay'
+    elif mins <= 15:
+        return 'Moderate Delay'
+    else:
+        return 'Severe Delay'
+
+
+def row_wise(updates: pd.DataFrame) -> tuple:
+    """The original classification plus get_route_performance's two groupby passes"""
+    distribution = updates['arrival_delay_mins'].apply(categorize_delay).value_counts().to_dict()
+    updates.groupby('route_id').agg({
+        'arrival_delay_mins': ['mean', 'median', 'std', 'count']
+    }).round(2)
+    on_time = updates.groupby('route_id').apply(
+        lambda x: (x['arrival_delay_mins'].abs() <= 1).mean() * 100
+    )
+    return distribution, on_time
+
+
+def vectorized(updates: pd.DataFrame) -> tuple:
+    distribution = category_counts(updates['arrival_delay_mins']).to_dict()
+    on_time = group_delay_stats(updates, 'route_id').set_index('route_id')['on_time_rate']
+    return distribution, on_time
+
+
+def timed(func, *args) -> tuple:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench(row_counts: list) -> list:
+    results = []
+    for rows in row_counts:
+        updates = synthetic_updates(rows)
+
+        legacy_seconds, (legacy_dist, legacy_rate) = timed(row_wise, updates)
+        fast_seconds, (fast_dist, fast_rate) = timed(vectorized, updates)
+        summary_seconds, _ = timed(delay_summary, updates['arrival_delay_mins'])
+
+        assert legacy_dist == fast_dist, "category counts differ"
+        assert np.allclose(legacy_rate.sort_index(), fast_rate.sort_index()), "on-time rates differ"
+
+        results.append({"rows": rows, "row_wise": legacy_seconds, "vectorized": fast_seconds,
+                        "summary": summary_seconds})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark delay metric computation")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000])
+    args = parser.parse_args()
+
+    results = bench(args.rows)
+
+    print(f"\n{'rows':>12} {'row-wise s':>11} {'vectorized s':>13} {'summary s':>10} {'speedup':>8}")
+    for r in results:
+        print(f"{r['rows']:>12,} {r['row_wise']:>11.2f} {r['vectorized']:>13.3f} "
+              f"{r['summary']:>10.3f} {r['row_wise'] / r['vectorized']:>7.1f}x")
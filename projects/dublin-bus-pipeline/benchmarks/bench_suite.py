@@ -0,0 +1,368 @@
+"""
+Benchmark Suite
+Replays the data/raw snapshots, and synthetic feeds scaled to 10x/100x the
+entity count, through the feed parsers and save_to_database, then times
+each BusAnalytics query against databases of 1M/10M rows. Reports
+throughput, latency percentiles and peak RSS per case and saves the run
+as JSON; pass an earlier run to --compare to flag regressions.
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --scales 1 10 --db-rows 1000000 --compare benchmarks/results/<run>.json
+
+Analytics databases are deterministic (fixed start time and cycle spacing)
+and cached in benchmarks/.cache, so repeated runs only pay for the build once.
+"""
+import json
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from config import RAW_DATA_DIR  # noqa: E402
+from data_collector import DataCollector  # noqa: E402
+from analytics import BusAnalytics  # noqa: E402
+from query_cache import QueryCache  # noqa: E402
+from dimensions import is_encoded  # noqa: E402
+from instrumentation import process_rss_bytes  # noqa: E402
+from replay_server import scale_vehicles, scale_updates  # noqa: E402
+
+BENCH_DIR = Path(__file__).resolve().parent
+CACHE_DIR = BENCH_DIR / ".cache"
+RESULTS_DIR = BENCH_DIR / "results"
+
+# Analytics databases: one cycle of the recorded feeds every CYCLE_SECONDS
+# from a fixed start, so every build has identical contents
+DB_START = datetime(2026, 1, 26, 6, 0, 0)
+CYCLE_SECONDS = 30
+
+# City-centre viewport and a stop on O'Connell Street
+CITY_BBOX = (53.33, -6.29, 53.36, -6.23)
+STOP_POINT = (53.3498, -6.2603)
+
+
+class PeakRss:
+    """Samples resident memory on a background thread while a case runs"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start = process_rss_bytes()
+        self.peak = self.start
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_rss_bytes())
+
+
+def summarize(group: str, case: str, latencies: list, items: int = None, **extra) -> dict:
+    """Latency percentiles (ms) and throughput for one case"""
+    ms = np.array(latencies) * 1000
+    result = {
+        "group": group, "case": case, "runs": len(ms),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+    if items is not None:
+        result["items_per_run"] = items
+        result["items_per_sec"] = round(items * len(ms) / (ms.sum() / 1000))
+    result.update(extra)
+    return result
+
+
+def measure(func, runs: int) -> tuple:
+    """(latencies, peak RSS MB, last return value) over `runs` calls"""
+    latencies = []
+    value = None
+    with PeakRss() as rss:
+        for _ in range(runs):
+            start = time.perf_counter()
+            value = func()
+            latencies.append(time.perf_counter() - start)
+    return latencies, round(rss.peak / 1e6, 1), value
+
+
+# Feeds
+
+def load_snapshots(raw_dir: Path) -> list:
+    """[(vehicles_feed, updates_feed)] for each recorded snapshot pair"""
+    pairs = []
+    for vehicles_path in sorted(raw_dir.glob("vehicles_*.json")):
+        updates_path = raw_dir / vehicles_path.name.replace("vehicles_", "updates_")
+        with open(vehicles_path) as f:
+            vehicles = json.load(f)
+        updates = {"entity": []}
+        if updates_path.exists():
+            with open(updates_path) as f:
+                updates = json.load(f)
+        pairs.append((vehicles, updates))
+    return pairs
+
+
+def bench_parse(snapshots: list, scales: list, repeat: int) -> list:
+    results = []
+    for scale in scales:
+        for feed_name, index, scale_feed, parse in (
+            ("vehicles", 0, scale_vehicles, DataCollector.parse_vehicle_positions),
+            ("updates", 1, scale_updates, DataCollector.parse_trip_updates),
+        ):
+            feeds = [scale_feed(pair[index], scale) for pair in snapshots]
+            latencies, peak, records = [], 0, 0
+            for feed in feeds:
+                runs, feed_peak, parsed = measure(lambda: parse(feed), repeat)
+                latencies += runs
+                peak = max(peak, feed_peak)
+                records = max(records, len(parsed))
+                del parsed
+            results.append(summarize("parse", f"parse_{feed_name}", latencies, items=records,
+                                     scale=scale, peak_rss_mb=peak))
+            print(f"  parse_{feed_name} {scale}x: p50 {results[-1]['p50_ms']:.1f} ms, "
+                  f"{results[-1]['items_per_sec']:,} records/s")
+    return results
+
+
+def bench_save(snapshots: list, scales: list) -> list:
+    """One save_to_database per snapshot, into a fresh database per scale"""
+    results = []
+    for scale in scales:
+        cycles = [
+            (DataCollector.parse_vehicle_positions(scale_vehicles(vehicles, scale)),
+             DataCollector.parse_trip_updates(scale_updates(updates, scale)))
+            for vehicles, updates in snapshots
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            collector = DataCollector(db_path=Path(tmp) / "bench.db")
+            latencies, rows = [], 0
+            with PeakRss() as rss:
+                for positions, updates in cycles:
+                    start = time.perf_counter()
+                    collector.save_to_database(positions, updates)
+                    latencies.append(time.perf_counter() - start)
+                    rows = max(rows, len(positions) + len(updates))
+            collector.writer.close()
+            collector.fetcher.close()
+        results.append(summarize("save", "save_to_database", latencies, items=rows,
+                                 scale=scale, peak_rss_mb=round(rss.peak / 1e6, 1)))
+        print(f"  save_to_database {scale}x: p50 {results[-1]['p50_ms']:.1f} ms, "
+              f"{results[-1]['items_per_sec']:,} rows/s")
+    return results
+
+
+# Analytics
+
+def _shift(value, seconds: int):
+    return None if value is None else int(value) + seconds
+
+
+def shifted_cycle(positions: list, updates: list, feed_time: int, collected_at: datetime) -> tuple:
+    """A recorded cycle's records moved in time to `collected_at`"""
+    offset = int(collected_at.timestamp()) - feed_time
+    positions = [{**p, "timestamp": _shift(p["timestamp"], offset)} for p in positions]
+    updates = [{**u, "timestamp": _shift(u["timestamp"], offset),
+                "arrival_time": _shift(u["arrival_time"], offset),
+                "departure_time": _shift(u["departure_time"], offset)} for u in updates]
+    return positions, updates
+
+
+def build_db(db_path: Path, target_rows: int, snapshots: list):
+    """Write recorded cycles in rotation until the database holds target_rows rows"""
+    cycles = [
+        (DataCollector.parse_vehicle_positions(vehicles), DataCollector.parse_trip_updates(updates),
+         int(vehicles["header"]["timestamp"]))
+        for vehicles, updates in snapshots
+    ]
+    collector = DataCollector(db_path=db_path)
+    rows, cycle_index = 0, 0
+    start = time.perf_counter()
+    while rows < target_rows:
+        positions, updates, feed_time = cycles[cycle_index % len(cycles)]
+        collected_at = DB_START + timedelta(seconds=cycle_index * CYCLE_SECONDS)
+        positions, updates = shifted_cycle(positions, updates, feed_time, collected_at)
+        collector.writer.write_cycle(positions, updates, collected_at=collected_at)
+        rows += len(positions) + len(updates)
+        cycle_index += 1
+        if cycle_index % 100 == 0:
+            print(f"  {rows:,} rows ({rows / (time.perf_counter() - start):,.0f} rows/s)")
+    collector.writer.close()
+    collector.fetcher.close()
+    return rows
+
+
+def analytics_cases(analytics: BusAnalytics) -> dict:
+    """{name: zero-argument query} covering every BusAnalytics read path"""
+    data_end = datetime.fromisoformat(analytics.get_fleet_summary()["data_end"])
+    hour_start = data_end - timedelta(hours=1)
+    vehicle_id = analytics.conn.execute(
+        "SELECT vehicle_id FROM vehicle_latest ORDER BY vehicle_id LIMIT 1"
+    ).fetchone()[0]
+
+    return {
+        "fleet_summary": analytics.get_fleet_summary,
+        "delay_statistics": analytics.get_delay_statistics,
+        "route_performance": lambda: analytics.get_route_performance(20),
+        "delay_percentiles_route": lambda: analytics.get_delay_percentiles(by="route"),
+        "delay_percentiles_hour": lambda: analytics.get_delay_percentiles(by="hour"),
+        "latest_positions": analytics.get_latest_positions,
+        "latest_positions_bbox": lambda: analytics.get_latest_positions(bbox=CITY_BBOX),
+        "vehicles_in_bbox_last_hour": lambda: analytics.get_vehicles_in_bbox(*CITY_BBOX, start=hour_start),
+        "nearest_vehicles_live": lambda: analytics.get_nearest_vehicles(*STOP_POINT),
+        "nearest_vehicles_last_hour": lambda: analytics.get_nearest_vehicles(*STOP_POINT, start=hour_start),
+        "heatmap_bins_city": lambda: analytics.get_heatmap_bins(13, bbox=CITY_BBOX),
+        "heatmap_bins_country": lambda: analytics.get_heatmap_bins(7),
+        "vehicle_trajectory": lambda: analytics.get_vehicle_trajectories(vehicle_id),
+        "vehicle_kinematics": lambda: analytics.get_vehicle_kinematics(vehicle_id, tolerance_m=25),
+        "vehicle_tracks_last_hour": lambda: analytics.get_vehicle_tracks(start=hour_start),
+        "activity_by_time": analytics.get_activity_by_time,
+        "operator_breakdown": analytics.get_operator_breakdown,
+        "geographic_data": analytics.get_geographic_data,
+    }
+
+
+def _is_current(db_path: Path) -> bool:
+    """Whether a cached database has the current (dimension-encoded) schema"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return is_encoded(conn)
+    finally:
+        conn.close()
+
+
+def bench_analytics(db_sizes: list, snapshots: list, repeat: int, rebuild: bool) -> list:
+    results = []
+    CACHE_DIR.mkdir(exist_ok=True)
+    for target in db_sizes:
+        db_path = CACHE_DIR / f"analytics_{target}.db"
+        if rebuild or not db_path.exists() or not _is_current(db_path):
+            for stale in CACHE_DIR.glob(f"{db_path.name}*"):
+                stale.unlink()
+            print(f"Building {target:,}-row database...")
+            build_db(db_path, target, snapshots)
+
+        analytics = BusAnalytics(db_path)
+        for name, query in analytics_cases(analytics).items():
+            query()  # warm the page cache so runs are comparable
+            latencies, peak, value = measure(query, repeat)
+            result_rows = len(value) if hasattr(value, "__len__") else None
+            results.append(summarize("analytics", name, latencies, db_rows=target,
+                                     result_rows=result_rows, peak_rss_mb=peak))
+            print(f"  {name} @ {target:,}: p50 {results[-1]['p50_ms']:.1f} ms, "
+                  f"p99 {results[-1]['p99_ms']:.1f} ms")
+
+        # The JSON export recomputed, then served from a warm result cache
+        cached = BusAnalytics(db_path, cache=QueryCache(disk_dir=None))
+        for name, instance in (("export_summary", analytics), ("export_summary_cached", cached)):
+            instance.export_summary_json()
+            latencies, peak, _ = measure(instance.export_summary_json, repeat)
+            results.append(summarize("analytics", name, latencies, db_rows=target, peak_rss_mb=peak))
+            print(f"  {name} @ {target:,}: p50 {results[-1]['p50_ms']:.1f} ms, "
+                  f"p99 {results[-1]['p99_ms']:.1f} ms")
+        cached.close()
+        analytics.close()
+    return results
+
+
+# Reporting
+
+def _case_key(result: dict) -> tuple:
+    return result["group"], result["case"], result.get("scale"), result.get("db_rows")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: Path, threshold: float) -> list:
+    """Cases whose p50 grew by more than `threshold` (a ratio) against a saved run"""
+    baseline = {_case_key(r): r for r in json.loads(baseline_path.read_text())["results"]}
+    regressions = []
+    print(f"\nAgainst {baseline_path.name} (p50 ratio, >{threshold:.2f} flagged):")
+    for result in results:
+        before = baseline.get(_case_key(result))
+        if before is None or not before["p50_ms"]:
+            continue
+        ratio = result["p50_ms"] / before["p50_ms"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        label = " ".join(str(part) for part in _case_key(result)[1:] if part is not None)
+        print(f"  {label:<45} {before['p50_ms']:>10.1f} -> {result['p50_ms']:>10.1f} ms  {ratio:5.2f}x{flag}")
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Parse, write and analytics benchmarks")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="Feed entity multipliers for the parse and save benchmarks")
+    parser.add_argument("--db-rows", type=int, nargs="+", default=[1_000_000, 10_000_000],
+                        help="Database sizes for the analytics benchmarks")
+    parser.add_argument("--only", choices=["parse", "save", "analytics"], nargs="+",
+                        default=["parse", "save", "analytics"])
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per parse snapshot / analytics query")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild cached analytics databases")
+    parser.add_argument("--output", type=Path, help="Results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", type=Path, help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="p50 ratio above which a case counts as a regression")
+    args = parser.parse_args()
+
+    snapshots = load_snapshots(RAW_DATA_DIR)
+    if not snapshots:
+        raise SystemExit(f"No snapshots in {RAW_DATA_DIR}")
+
+    started = datetime.now()
+    results = []
+    if "parse" in args.only:
+        print("Parsing...")
+        results += bench_parse(snapshots, args.scales, args.repeat)
+    if "save" in args.only:
+        print("Saving...")
+        results += bench_save(snapshots, args.scales)
+    if "analytics" in args.only:
+        print("Analytics...")
+        results += bench_analytics(args.db_rows, snapshots, args.repeat, args.rebuild)
+
+    run = {
+        "started_at": started.isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    output = args.output or RESULTS_DIR / f"{started:%Y%m%d_%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(run, indent=2, default=str))
+    print(f"\nSaved {len(results)} results to {output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} case(s) regressed")
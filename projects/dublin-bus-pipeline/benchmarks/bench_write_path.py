@@ -0,0 +1,136 @@
+"""
+Write Path Benchmark
+Replays the data/raw snapshots at 1x/10x/100x volume through the original
+pandas.to_sql path and the BulkWriter, and reports rows/sec for each
+
+    python benchmarks/bench_write_path.py --scales 1 10 100
+"""
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from config import RAW_DATA_DIR  # noqa: E402
+from data_collector import DataCollector  # noqa: E402
+from bulk_writer import BulkWriter  # noqa: E402
+
+
+def load_cycles(raw_dir: Path) -> list:
+    """Parse each vehicles/updates snapshot pair into one cycle of records"""
+    cycles = []
+    for vehicles_path in sorted(raw_dir.glob("vehicles_*.json")):
+        updates_path = raw_dir / vehicles_path.name.replace("vehicles_", "updates_")
+        with open(vehicles_path) as f:
+            positions = DataCollector.parse_vehicle_positions(json.load(f))
+        updates = []
+        if updates_path.exists():
+            with open(updates_path) as f:
+                updates = DataCollector.parse_trip_updates(json.load(f))
+        cycles.append((positions, updates))
+    return cycles
+
+
+def to_sql_write(db_path: Path, positions: list, updates: list):
+    """The original save_to_database: fresh connection, DataFrame.to_sql, default journal"""
+    conn = sqlite3.connect(db_path)
+    if positions:
+        df_positions = pd.DataFrame(positions)
+        df_positions["collected_at"] = datetime.now()
+        df_positions.to_sql("vehicle_positions", conn, if_exists="append", index=False)
+    if updates:
+        df_updates = pd.DataFrame(updates)
+        df_updates["collected_at"] = datetime.now()
+        df_updates.to_sql("trip_updates", conn, if_exists="append", index=False)
+    conn.close()
+
+
+def init_legacy_schema(db_path: Path):
+    """The original raw tables and indexes, before IDs were dimension-encoded"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE vehicle_positions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            vehicle_id TEXT, trip_id TEXT, route_id TEXT,
+            latitude REAL, longitude REAL, timestamp INTEGER,
+            start_time TEXT, start_date TEXT, direction_id INTEGER
+        );
+        CREATE TABLE trip_updates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            trip_id TEXT, route_id TEXT, stop_id TEXT,
+            arrival_delay INTEGER, departure_delay INTEGER, timestamp INTEGER,
+            start_date TEXT, start_time TEXT, stop_sequence INTEGER,
+            arrival_time INTEGER, departure_time INTEGER
+        );
+        CREATE INDEX idx_positions_time ON vehicle_positions(collected_at);
+        CREATE INDEX idx_positions_route ON vehicle_positions(route_id);
+        CREATE INDEX idx_positions_vehicle_time ON vehicle_positions(vehicle_id, collected_at);
+        CREATE INDEX idx_updates_trip ON trip_updates(trip_id);
+        CREATE INDEX idx_updates_time ON trip_updates(collected_at);
+    """)
+    conn.close()
+
+
+def init_schema(db_path: Path):
+    collector = DataCollector(db_path=db_path)
+    collector.writer.close()
+    collector.fetcher.close()
+
+
+def run(label: str, cycles: list, scale: int, write) -> dict:
+    rows = 0
+    start = time.perf_counter()
+    for positions, updates in cycles:
+        write(positions * scale, updates * scale)
+        rows += (len(positions) + len(updates)) * scale
+    elapsed = time.perf_counter() - start
+    return {"path": label, "scale": scale, "rows": rows,
+            "seconds": round(elapsed, 3), "rows_per_sec": round(rows / elapsed)}
+
+
+def bench(scales: list) -> list:
+    cycles = load_cycles(RAW_DATA_DIR)
+    results = []
+
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            legacy_db = Path(tmp) / "to_sql.db"
+            bulk_db = Path(tmp) / "bulk.db"
+
+            # Each path writes into the schema it was written for
+            init_legacy_schema(legacy_db)
+            init_schema(bulk_db)
+
+            results.append(run("to_sql", cycles, scale,
+                               lambda p, u: to_sql_write(legacy_db, p, u)))
+            writer = BulkWriter(bulk_db)
+            results.append(run("bulk", cycles, scale,
+                               lambda p, u: writer.write_cycle(p, u)))
+            writer.close()
+
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite write path")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    args = parser.parse_args()
+
+    results = bench(args.scales)
+
+    print(f"\n{'path':<8} {'scale':>6} {'rows':>12} {'seconds':>9} {'rows/sec':>12}")
+    for r in results:
+        print(f"{r['path']:<8} {r['scale']:>5}x {r['rows']:>12,} {r['seconds']:>9.2f} {r['rows_per_sec']:>12,}")
+
+    for scale in args.scales:
+        legacy, bulk = [r for r in results if r["scale"] == scale]
+        print(f"{scale}x: bulk writer is {bulk['rows_per_sec'] / legacy['rows_per_sec']:.1f}x faster")
@@ -0,0 +1,186 @@
+"""
+Concurrent Read/Ingest Check
+Writes recorded cycles through the collector's single writer, first alone
+and then while reader processes run every BusAnalytics query and dashboard
+refresh in a loop off their read pools. The writer runs with
+busy_timeout = 0, so any moment it would have had to wait for a reader
+fails the cycle instead of stalling it; the check passes when no cycle and
+no query fails. --journal-mode delete repeats the run in rollback-journal
+mode for comparison, where readers do block commits.
+
+    python benchmarks/check_concurrency.py --cycles 200 --readers 4 --threads 2
+
+Write latencies are reported too, but with fewer cores than readers they
+mostly measure CPU sharing rather than locking.
+"""
+import argparse
+import multiprocessing
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from data_collector import DataCollector  # noqa: E402
+from analytics import BusAnalytics  # noqa: E402
+from db import ReadPool  # noqa: E402
+from incremental_loader import IncrementalLoader  # noqa: E402
+from config import RAW_DATA_DIR  # noqa: E402
+from bench_suite import DB_START, CYCLE_SECONDS, analytics_cases, load_snapshots, shifted_cycle  # noqa: E402
+
+
+def recorded_cycles(raw_dir: Path) -> list:
+    return [
+        (DataCollector.parse_vehicle_positions(vehicles), DataCollector.parse_trip_updates(updates),
+         int(vehicles["header"]["timestamp"]))
+        for vehicles, updates in load_snapshots(raw_dir)
+    ]
+
+
+def write_cycles(collector: DataCollector, cycles: list, first: int, count: int) -> tuple:
+    """Write `count` cycles starting at cycle number `first`
+
+    Returns the seconds taken by each committed cycle and the number of
+    cycles that hit a lock.
+    """
+    latencies, blocked = [], 0
+    for n in range(first, first + count):
+        positions, updates, feed_time = cycles[n % len(cycles)]
+        collected_at = DB_START + timedelta(seconds=n * CYCLE_SECONDS)
+        positions, updates = shifted_cycle(positions, updates, feed_time, collected_at)
+        start = time.perf_counter()
+        try:
+            collector.writer.write_cycle(positions, updates, collected_at=collected_at)
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            blocked += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, blocked
+
+
+def reader_process(db_path: str, threads: int, stop, results):
+    """Run every analytics case and a dashboard refresh in a loop from `threads` threads"""
+    pool = ReadPool(db_path, size=threads)
+    loader = IncrementalLoader(db_path, pool=pool)
+    counts = {"queries": 0, "errors": 0, "locked": 0}
+    lock = threading.Lock()
+    messages = []
+
+    def run(query):
+        try:
+            query()
+        except Exception as e:
+            with lock:
+                counts["errors"] += 1
+                counts["locked"] += "locked" in str(e) or "busy" in str(e)
+                messages.append(repr(e))
+        else:
+            with lock:
+                counts["queries"] += 1
+
+    def work():
+        while not stop.is_set():
+            # The analytics instance holds its connection until closed, so
+            # the loader refreshes after it is returned to the pool
+            analytics = BusAnalytics(db_path, pool=pool)
+            try:
+                for query in analytics_cases(analytics).values():
+                    if stop.is_set():
+                        break
+                    run(query)
+            finally:
+                analytics.close()
+            run(loader.refresh)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.close()
+    results.put({**counts, "messages": messages[:5]})
+
+
+def describe(name: str, latencies: list, blocked: int):
+    if not latencies:
+        print(f"  {name:<14} every cycle blocked")
+        return
+    ms = np.array(latencies) * 1000
+    print(f"  {name:<14} p50 {np.percentile(ms, 50):7.1f} ms   p99 {np.percentile(ms, 99):7.1f} ms   "
+          f"max {ms.max():7.1f} ms   {blocked} blocked")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raw-dir", type=Path, default=RAW_DATA_DIR)
+    parser.add_argument("--warmup", type=int, default=120, help="Cycles written before timing starts")
+    parser.add_argument("--cycles", type=int, default=200, help="Timed cycles per phase")
+    parser.add_argument("--readers", type=int, default=4, help="Reader processes")
+    parser.add_argument("--threads", type=int, default=2, help="Threads sharing each reader's pool")
+    parser.add_argument("--journal-mode", choices=("wal", "delete"), default="wal")
+    args = parser.parse_args()
+
+    cycles = recorded_cycles(args.raw_dir)
+    if not cycles:
+        sys.exit(f"No snapshots in {args.raw_dir}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "concurrency.db"
+        collector = DataCollector(db_path=db_path)
+        write_cycles(collector, cycles, 0, args.warmup)
+        writer = collector.writer.conn
+        journal = writer.execute(f"PRAGMA journal_mode = {args.journal_mode}").fetchone()[0]
+        writer.execute("PRAGMA busy_timeout = 0")
+        print(f"Database in {journal} mode, {args.warmup} warm-up cycles written")
+
+        pool = ReadPool(db_path, size=1)
+        with pool.connection() as conn:
+            try:
+                conn.execute("DELETE FROM ingest_cycles")
+                sys.exit("Pooled connection accepted a write")
+            except sqlite3.OperationalError as e:
+                print(f"Pooled connections are read-only ({e})")
+        pool.close()
+
+        print(f"\nWrites over {args.cycles} cycles")
+        describe("no readers", *write_cycles(collector, cycles, args.warmup, args.cycles))
+
+        context = multiprocessing.get_context("spawn")
+        stop, results = context.Event(), context.Queue()
+        readers = [context.Process(target=reader_process, args=(str(db_path), args.threads, stop, results))
+                   for _ in range(args.readers)]
+        for reader in readers:
+            reader.start()
+        time.sleep(2)  # let every reader import and get into its loop
+        latencies, blocked = write_cycles(collector, cycles, args.warmup + args.cycles, args.cycles)
+        describe(f"{args.readers}x{args.threads} readers", latencies, blocked)
+        stop.set()
+        reports = [results.get() for _ in readers]
+        for reader in readers:
+            reader.join()
+        collector.writer.close()
+        collector.fetcher.close()
+
+    queries = sum(report["queries"] for report in reports)
+    errors = sum(report["errors"] for report in reports)
+    locked = sum(report["locked"] for report in reports)
+    print(f"\nReaders ran {queries:,} queries: {errors} errors, {locked} lock errors")
+    for message in sorted({m for report in reports for m in report["messages"]}):
+        print(f"  {message}")
+
+    if blocked or errors or queries == 0:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
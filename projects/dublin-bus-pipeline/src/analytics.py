@@ -2,22 +2,102 @@
 Advanced Analytics for Dublin Bus Data
 Generates insights, statistics, and prepares data for visualizations
 """
-import sqlite3
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
+from pathlib import Path
 from config import DATABASE_PATH
+from db import ReadPool, read_pool
+from query_cache import QueryCache, cached_query, data_watermark, shared_cache
+from change_capture import state_as_of
+from metrics import DELAY_CATEGORIES, DELAY_LABELS, delay_summary, group_delay_stats
+from quantile_sketch import KLLSketch, ALL_ROUTES
+from vehicle_state import latest_positions
+from spatial_index import haversine_m, positions_in_bbox, nearest_positions
+from heatmap import heatmap_bins
+from trajectories import load_tracks
+from partitions import expired_days, read_range
+from dimensions import POSITIONS_BY_VEHICLE, categorize, is_encoded, operator_for
+from history import ParquetHistory, open_history
 import json
 
 
 class BusAnalytics:
-    """Analytics engine for Dublin Bus data"""
+    """Analytics engine for Dublin Bus data
+
+    Holds a query_only connection checked out of the database's read pool
+    until close(), so any number of instances can run alongside ingest.
+    Aggregate queries are served from `cache` when one is given, until new
+    data lands; cached frames are shared and must not be mutated.
+    Full-history scans read the Parquet `history` tier when one is given.
+    """
+    
+    def __init__(self, db_path=DATABASE_PATH, pool: ReadPool = None, cache: QueryCache = None,
+                 history: ParquetHistory = None):
+        self.pool = pool if pool is not None else read_pool(db_path)
+        self.conn = self.pool.acquire()
+        self.cache = cache
+        self.history = history
+        self.db_key = str(Path(db_path).resolve())
+        if history is not None:
+            self.db_key += f"|{type(history).__name__}:{history.root.resolve()}"
+    
+    def data_watermark(self) -> tuple:
+        """Moves whenever new data is ingested (see query_cache)"""
+        if self.history is not None:
+            return (*data_watermark(self.conn), self.history.watermark())
+        return data_watermark(self.conn)
+    
+    def _has_rows(self, table: str) -> bool:
+        """Ingest-maintained tables exist once the collector has run (or backfilled) against this DB"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        return bool(exists) and bool(self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone())
     
-    def __init__(self):
-        self.conn = sqlite3.connect(DATABASE_PATH)
+    def _has_rollups(self) -> bool:
+        return self._has_rows("ingest_cycles")
+    
+    def _merged_sketches(self, by: str = None, route_ids: list = None,
+                         start=None, end=None) -> dict:
+        """Merge hourly delay sketches, keyed by route, hour bucket or ALL_ROUTES"""
+        conditions = ["bucket_size = 'hour'"]
+        params = []
+        if route_ids is not None:
+            conditions.append(f"route_id IN ({', '.join('?' for _ in route_ids)})")
+            params.extend(route_ids)
+        else:
+            # Per-hour and fleet-wide answers use the pre-merged all-routes sketch
+            conditions.append("route_id = ?" if by != "route" else "route_id NOT IN (?, '')")
+            params.append(ALL_ROUTES)
+        if start is not None:
+            conditions.append("bucket_start >= ?")
+            params.append(str(start))
+        if end is not None:
+            conditions.append("bucket_start <= ?")
+            params.append(str(end))
+        
+        rows = self.conn.execute(f"""
+            SELECT route_id, bucket_start, sketch FROM delay_sketches
+            WHERE {' AND '.join(conditions)}
+        """, params)
         
+        merged = {}
+        for route_id, bucket_start, blob in rows:
+            key = {"route": route_id, "hour": bucket_start}.get(by, ALL_ROUTES)
+            sketch = KLLSketch.from_bytes(blob)
+            if key in merged:
+                merged[key].merge(sketch)
+            else:
+                merged[key] = sketch
+        return merged
+    
+    @cached_query
     def get_fleet_summary(self) -> dict:
         """Get overall fleet statistics"""
+        if self._has_rollups():
+            return self._fleet_summary_from_rollups()
+        
         positions = pd.read_sql("SELECT * FROM vehicle_positions", self.conn)
         updates = pd.read_sql("SELECT * FROM trip_updates", self.conn)
         
@@ -31,46 +111,82 @@ class BusAnalytics:
             "snapshots": positions['collected_at'].nunique()
         }
     
+    def _fleet_summary_from_rollups(self) -> dict:
+        positions, updates, start, end, snapshots = self.conn.execute("""
+            SELECT SUM(position_count), SUM(update_count),
+                   MIN(CASE WHEN position_count > 0 THEN collected_at END),
+                   MAX(CASE WHEN position_count > 0 THEN collected_at END),
+                   SUM(position_count > 0)
+            FROM ingest_cycles
+        """).fetchone()
+        
+        return {
+            "total_position_records": positions,
+            "total_update_records": updates,
+            "unique_vehicles": self.conn.execute("SELECT COUNT(*) FROM seen_vehicles").fetchone()[0],
+            "unique_routes": self.conn.execute("SELECT COUNT(*) FROM seen_routes").fetchone()[0],
+            "data_start": str(start),
+            "data_end": str(end),
+            "snapshots": snapshots
+        }
+    
+    @cached_query
     def get_delay_statistics(self) -> dict:
         """Analyze delay patterns"""
-        updates = pd.read_sql("SELECT * FROM trip_updates", self.conn)
+        if self._has_rollups():
+            return self._delay_statistics_from_rollups()
+        
+        updates = pd.read_sql(
+            "SELECT arrival_delay FROM trip_updates WHERE arrival_delay IS NOT NULL", self.conn
+        )
         
         if len(updates) == 0:
             return {}
         
-        updates['arrival_delay_mins'] = updates['arrival_delay'] / 60
-        updates['departure_delay_mins'] = updates['departure_delay'] / 60
-        
-        # Categorize delays
-        def categorize_delay(mins):
-            if mins < -1:
-                return 'Early'
-            elif mins <= 1:
-                return 'On Time'
-            elif mins <= 5:
-                return 'Slight Delay'
-            elif mins <= 15:
-                return 'Moderate Delay'
-            else:
-                return 'Severe Delay'
+        return delay_summary(updates['arrival_delay'] / 60)
+    
+    def _delay_statistics_from_rollups(self) -> dict:
+        row = self.conn.execute(f"""
+            SELECT SUM(count), SUM(sum), SUM(sum_sq), MIN(min), MAX(max),
+                   {", ".join(f"SUM({name})" for name in DELAY_CATEGORIES)}
+            FROM delay_rollups
+            WHERE bucket_size = 'hour'
+        """).fetchone()
+        n, total, total_sq, min_delay, max_delay = row[:5]
+        categories = dict(zip(DELAY_CATEGORIES, row[5:]))
+        
+        if not n:
+            return {}
         
-        updates['delay_category'] = updates['arrival_delay_mins'].apply(categorize_delay)
+        mean = total / n
+        variance = (total_sq - n * mean ** 2) / (n - 1) if n > 1 else float('nan')
+        overall = self._merged_sketches().get(ALL_ROUTES)
+        median = overall.quantile(0.5) if overall else float('nan')
+        distribution = sorted(
+            ((DELAY_LABELS[name], count) for name, count in categories.items() if count),
+            key=lambda item: -item[1]
+        )
         
         return {
-            "avg_delay_mins": round(updates['arrival_delay_mins'].mean(), 2),
-            "median_delay_mins": round(updates['arrival_delay_mins'].median(), 2),
-            "max_delay_mins": round(updates['arrival_delay_mins'].max(), 2),
-            "min_delay_mins": round(updates['arrival_delay_mins'].min(), 2),
-            "std_delay_mins": round(updates['arrival_delay_mins'].std(), 2),
-            "on_time_percentage": round((updates['delay_category'] == 'On Time').mean() * 100, 1),
-            "early_percentage": round((updates['delay_category'] == 'Early').mean() * 100, 1),
-            "delayed_percentage": round((updates['arrival_delay_mins'] > 1).mean() * 100, 1),
-            "severe_delay_percentage": round((updates['arrival_delay_mins'] > 15).mean() * 100, 1),
-            "delay_distribution": updates['delay_category'].value_counts().to_dict()
+            "avg_delay_mins": round(mean / 60, 2),
+            "median_delay_mins": round(median / 60, 2),
+            "max_delay_mins": round(max_delay / 60, 2),
+            "min_delay_mins": round(min_delay / 60, 2),
+            "std_delay_mins": round(float(np.sqrt(max(variance, 0))) / 60, 2),
+            "on_time_percentage": round(categories['on_time'] / n * 100, 1),
+            "early_percentage": round(categories['early'] / n * 100, 1),
+            "delayed_percentage": round(
+                (categories['slight'] + categories['moderate'] + categories['severe']) / n * 100, 1),
+            "severe_delay_percentage": round(categories['severe'] / n * 100, 1),
+            "delay_distribution": dict(distribution)
         }
     
+    @cached_query
     def get_route_performance(self, top_n: int = 20) -> pd.DataFrame:
         """Analyze performance by route"""
+        if self._has_rollups():
+            return self._route_performance_from_rollups(top_n)
+        
         updates = pd.read_sql("""
             SELECT route_id, arrival_delay, departure_delay 
             FROM trip_updates
@@ -81,71 +197,241 @@ class BusAnalytics:
             return pd.DataFrame()
         
         updates['arrival_delay_mins'] = updates['arrival_delay'] / 60
+        route_stats = group_delay_stats(updates, 'route_id')
         
-        route_stats = updates.groupby('route_id').agg({
-            'arrival_delay_mins': ['mean', 'median', 'std', 'count']
-        }).round(2)
+        return route_stats.sort_values('sample_count', ascending=False).head(top_n)
+    
+    def _route_performance_from_rollups(self, top_n: int) -> pd.DataFrame:
+        routes = pd.read_sql("""
+            SELECT route_id, SUM(count) AS n, SUM(sum) AS total,
+                   SUM(sum_sq) AS total_sq, SUM(on_time) AS on_time
+            FROM delay_rollups
+            WHERE bucket_size = 'hour' AND route_id != ''
+            GROUP BY route_id
+            ORDER BY n DESC
+            LIMIT ?
+        """, self.conn, params=(top_n,))
         
-        route_stats.columns = ['avg_delay', 'median_delay', 'std_delay', 'sample_count']
-        route_stats = route_stats.reset_index()
-        route_stats['on_time_rate'] = updates.groupby('route_id').apply(
-            lambda x: (x['arrival_delay_mins'].abs() <= 1).mean() * 100
-        ).values
+        if len(routes) == 0:
+            return pd.DataFrame()
         
-        return route_stats.sort_values('sample_count', ascending=False).head(top_n)
+        mean = routes['total'] / routes['n']
+        variance = (routes['total_sq'] - routes['n'] * mean ** 2) / (routes['n'] - 1)
+        sketches = self._merged_sketches(by="route", route_ids=routes['route_id'].tolist())
+        medians = {route: sketch.quantile(0.5) for route, sketch in sketches.items()}
+        
+        return pd.DataFrame({
+            'route_id': routes['route_id'],
+            'avg_delay': (mean / 60).round(2),
+            'median_delay': (routes['route_id'].map(medians) / 60).round(2),
+            'std_delay': (np.sqrt(variance.clip(lower=0)) / 60).round(2),
+            'sample_count': routes['n'],
+            'on_time_rate': routes['on_time'] / routes['n'] * 100
+        })
+    
+    @cached_query
+    def get_delay_percentiles(self, percentiles=(50, 90, 95), by: str = "route",
+                              start=None, end=None) -> pd.DataFrame:
+        """Arrival delay percentiles (minutes) per route, per hour, or fleet-wide (by=None)
+        
+        Answered by merging hourly KLL sketches, so cost does not depend on how
+        many rows were collected. Each value is within about ±1.65% in rank of
+        the exact percentile (see quantile_sketch).
+        """
+        if by not in ("route", "hour", None):
+            raise ValueError(f"Unknown grouping: {by}")
+        
+        sketches = self._merged_sketches(by=by, start=start, end=end)
+        quantiles = [p / 100 for p in percentiles]
+        
+        rows = []
+        for key, sketch in sorted(sketches.items()):
+            values = sketch.quantiles(quantiles) / 60
+            rows.append({
+                {"route": "route_id", "hour": "bucket_start"}.get(by, "scope"): key,
+                "sample_count": sketch.n,
+                **{f"p{p:g}_delay": round(float(v), 2) for p, v in zip(percentiles, values)}
+            })
+        return pd.DataFrame(rows)
     
     def get_geographic_data(self) -> pd.DataFrame:
-        """Get geographic data for mapping"""
-        positions = pd.read_sql("""
+        """Get geographic data for mapping, with categorical vehicle and route IDs
+
+        Archived days are read from their partitions, and days past
+        retention from the downsampled history (without direction_id).
+        """
+        if self.history is not None:
+            return self.history.scan("vehicle_positions", ["vehicle_id", "route_id", "latitude", "longitude",
+                                                           "collected_at", "direction_id"],
+                                     not_null=("latitude", "longitude"))
+        positions = read_range(self.conn, """
             SELECT vehicle_id, route_id, latitude, longitude, 
                    collected_at, direction_id
             FROM vehicle_positions
             WHERE latitude IS NOT NULL AND longitude IS NOT NULL
-        """, self.conn)
+        """)
+        if expired_days(self.conn):
+            downsampled = pd.read_sql("""
+                SELECT vehicle_id, route_id, latitude, longitude,
+                       collected_at, NULL as direction_id
+                FROM positions_downsampled
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """, self.conn)
+            positions = pd.concat([frame for frame in (downsampled, positions) if len(frame)] or [positions],
+                                  ignore_index=True)
         
-        return positions
+        return categorize(positions)
     
-    def get_latest_positions(self) -> pd.DataFrame:
-        """Get most recent position for each vehicle"""
-        return pd.read_sql("""
+    @cached_query
+    def get_latest_positions(self, bbox: tuple = None) -> pd.DataFrame:
+        """Get most recent position for each vehicle, optionally inside
+        bbox = (min_lat, min_lon, max_lat, max_lon)"""
+        if self._has_rows("vehicle_latest"):
+            return latest_positions(self.conn, bbox=bbox)
+        
+        latest = pd.read_sql("""
             SELECT * FROM vehicle_positions
             WHERE collected_at = (SELECT MAX(collected_at) FROM vehicle_positions)
         """, self.conn)
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            latest = latest[latest['latitude'].between(min_lat, max_lat)
+                            & latest['longitude'].between(min_lon, max_lon)]
+        return latest
+    
+    def get_vehicles_in_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                             start=None, end=None) -> pd.DataFrame:
+        """Every position recorded inside a bounding box, optionally within a time window"""
+        return positions_in_bbox(self.conn, min_lat, min_lon, max_lat, max_lon, start=start, end=end)
     
-    def get_vehicle_trajectories(self, vehicle_id: str = None) -> pd.DataFrame:
+    def get_nearest_vehicles(self, lat: float, lon: float, k: int = 10,
+                             start=None, end=None) -> pd.DataFrame:
+        """The k vehicles nearest a point (e.g. a stop), with distance_m
+        
+        Without a time window this ranks the live fleet; with one, each
+        vehicle is placed at its closest recorded position in the window.
+        """
+        if start is None and end is None:
+            live = self.get_latest_positions()
+            live = live.assign(distance_m=haversine_m(lat, lon, live['latitude'], live['longitude']))
+            return live.dropna(subset=['distance_m']).nsmallest(k, 'distance_m').reset_index(drop=True)
+        
+        return nearest_positions(self.conn, lat, lon, k=k, start=start, end=end)
+    
+    @cached_query
+    def get_heatmap_bins(self, zoom: float, bbox: tuple = None, start=None, end=None,
+                         max_bins: int = 5000) -> pd.DataFrame:
+        """Pre-aggregated position density for a map viewport (see heatmap)"""
+        if not self._has_rows("heatmap_bins"):
+            return pd.DataFrame(columns=['latitude', 'longitude', 'count', 'level'])
+        return heatmap_bins(self.conn, zoom, bbox, start, end, max_bins)
+    
+    def get_vehicle_trajectories(self, vehicle_id: str = None, start=None, end=None) -> pd.DataFrame:
         """Get movement history for vehicles"""
+        if self.history is not None:
+            trajectories = self.history.scan(
+                "vehicle_positions", ["vehicle_id", "route_id", "latitude", "longitude", "collected_at", "timestamp"],
+                start, end, equals={"vehicle_id": vehicle_id} if vehicle_id else None, not_null=("latitude",)
+            )
+            return trajectories.sort_values(['vehicle_id', 'collected_at'], kind='stable', ignore_index=True)
+        conditions = ["latitude IS NOT NULL"]
+        params = []
+        if vehicle_id:
+            conditions.append("vehicle_id = ?")
+            params.append(vehicle_id)
+        if start is not None:
+            conditions.append("collected_at >= ?")
+            params.append(str(start))
+        if end is not None:
+            conditions.append("collected_at <= ?")
+            params.append(str(end))
+        
         query = """
             SELECT vehicle_id, route_id, latitude, longitude, 
                    collected_at, timestamp
-            FROM vehicle_positions
-            WHERE latitude IS NOT NULL
+            FROM {source}
+            WHERE {conditions}
+            ORDER BY vehicle_id, collected_at
         """
-        if vehicle_id:
-            query += f" AND vehicle_id = '{vehicle_id}'"
-        query += " ORDER BY vehicle_id, collected_at"
-        
-        return pd.read_sql(query, self.conn)
+        main_query = None
+        if vehicle_id and is_encoded(self.conn):
+            # Look the vehicle up first instead of scanning every row of the view
+            main_query = query.format(source=POSITIONS_BY_VEHICLE, conditions=' AND '.join(conditions))
+        trajectories = read_range(self.conn, query.format(source="vehicle_positions",
+                                                          conditions=' AND '.join(conditions)),
+                                  params, start, end, main_query=main_query)
+        # Day partitions come back one after another; restore the global order
+        trajectories = trajectories.sort_values(['vehicle_id', 'collected_at'], kind='stable', ignore_index=True)
+        return categorize(trajectories)
+    
+    def get_vehicle_tracks(self, vehicle_ids=None, start=None, end=None) -> dict:
+        """{vehicle_id: Track} of deduplicated GPS fixes (see trajectories)"""
+        return load_tracks(self.conn, vehicle_ids, start, end)
+    
+    def get_vehicle_kinematics(self, vehicle_id: str, start=None, end=None,
+                               tolerance_m: float = None) -> pd.DataFrame:
+        """Speed, heading and distance along one vehicle's track, optionally simplified"""
+        track = load_tracks(self.conn, vehicle_id, start, end).get(vehicle_id)
+        if track is None:
+            return pd.DataFrame()
+        if tolerance_m:
+            track = track.simplify(tolerance_m)
+        return track.kinematics()
     
+    def get_trip_updates_as_of(self, as_of=None) -> pd.DataFrame:
+        """Reconstruct live trip updates at a point in time from the CDC change log"""
+        return state_as_of(self.conn, as_of)
+    
+    @cached_query
     def get_activity_by_time(self) -> pd.DataFrame:
-        """Get fleet activity over time"""
-        return pd.read_sql("""
+        """Get fleet activity over time
+
+        Archived days are read from their partitions; days past retention
+        only have one row per downsampling bucket.
+        """
+        if self.history is not None:
+            return self.history.activity_by_time()
+        main_query = None
+        if is_encoded(self.conn):
+            # Distinct integer keys straight off the fact table; NULL keys
+            # are skipped just like NULL IDs
+            main_query = """
+                SELECT collected_at,
+                       COUNT(DISTINCT vehicle_sk) as active_vehicles,
+                       COUNT(DISTINCT route_sk) as active_routes
+                FROM vehicle_positions_fact
+                GROUP BY collected_at
+                ORDER BY collected_at
+            """
+        
+        activity = read_range(self.conn, """
             SELECT collected_at,
                    COUNT(DISTINCT vehicle_id) as active_vehicles,
                    COUNT(DISTINCT route_id) as active_routes
             FROM vehicle_positions
             GROUP BY collected_at
             ORDER BY collected_at
-        """, self.conn)
+        """, main_query=main_query)
+        if expired_days(self.conn):
+            downsampled = pd.read_sql("""
+                SELECT bucket_start as collected_at,
+                       COUNT(DISTINCT vehicle_id) as active_vehicles,
+                       COUNT(DISTINCT route_id) as active_routes
+                FROM positions_downsampled
+                GROUP BY bucket_start
+            """, self.conn)
+            activity = pd.concat([frame for frame in (downsampled, activity) if len(frame)] or [activity],
+                                 ignore_index=True)
+        # Day partitions come back one after another; restore the global order
+        return activity.sort_values('collected_at', kind='stable', ignore_index=True)
     
+    @cached_query
     def get_operator_breakdown(self) -> dict:
-        """Estimate operator breakdown based on route patterns"""
-        positions = pd.read_sql("SELECT DISTINCT route_id FROM vehicle_positions", self.conn)
-        
-        # TFI route IDs have patterns:
-        # 5240_xxx = Dublin Bus
-        # 5249_xxx = Go-Ahead
-        # Other patterns for Bus Éireann
-        
+        """Count routes ever seen at ingest by operator (see dimensions.operator_for)
+
+        seen_routes outlives the raw rows, so routes whose days have been
+        archived or expired still count.
+        """
         operators = {
             'Dublin Bus': 0,
             'Go-Ahead Ireland': 0,
@@ -153,15 +439,22 @@ class BusAnalytics:
             'Other': 0
         }
         
-        for route in positions['route_id'].dropna():
-            if route.startswith('5240'):
-                operators['Dublin Bus'] += 1
-            elif route.startswith('5249'):
-                operators['Go-Ahead Ireland'] += 1
-            elif route.startswith('52'):
-                operators['Bus Éireann'] += 1
-            else:
-                operators['Other'] += 1
+        if is_encoded(self.conn):
+            # The routes dimension carries each route's operator
+            operators.update(self.conn.execute("""
+                SELECT operator, COUNT(*) FROM routes
+                JOIN seen_routes USING (route_id)
+                GROUP BY operator
+            """).fetchall())
+            return operators
+        
+        if self._has_rows("seen_routes"):
+            routes = pd.read_sql("SELECT route_id FROM seen_routes", self.conn)
+        else:
+            # Databases collected before rollups existed have no seen_routes
+            routes = pd.read_sql("SELECT DISTINCT route_id FROM vehicle_positions", self.conn)
+        for route in routes['route_id'].dropna():
+            operators[operator_for(route)] += 1
         
         return operators
     
@@ -182,11 +475,14 @@ class BusAnalytics:
         return summary
     
     def close(self):
-        self.conn.close()
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
 
 
 if __name__ == "__main__":
-    analytics = BusAnalytics()
+    # With QUERY_CACHE_DIR set, repeated runs reuse results until new data lands
+    analytics = BusAnalytics(cache=shared_cache(), history=open_history())
     
     print("\n" + "="*60)
     print("DUBLIN BUS ANALYTICS SUMMARY")
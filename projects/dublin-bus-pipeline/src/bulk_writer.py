@@ -0,0 +1,143 @@
+"""
+Bulk SQLite Writer
+Writes each collection cycle with prepared executemany inserts inside a
+single transaction, over one long-lived WAL connection, encoding IDs with
+dimension keys cached in memory
+"""
+from datetime import datetime
+from functools import cached_property
+from operator import itemgetter
+import pandas as pd
+from config import DATABASE_PATH
+from db import connect, WRITER_PRAGMAS
+from dimensions import FACT_TABLES, DimensionCache, fact_column
+from instrumentation import METRICS
+from stream_parser import ColumnBuffer, VehiclePositionColumns, TripUpdateColumns
+
+POSITION_COLUMNS = tuple(VehiclePositionColumns.schema)
+UPDATE_COLUMNS = tuple(TripUpdateColumns.schema)
+
+
+def _insert_sql(table: str, columns: tuple) -> str:
+    """INSERT into a raw view's fact table, with ID columns written as their keys"""
+    placeholders = ", ".join("?" for _ in columns)
+    return (f"INSERT INTO {FACT_TABLES[table]} (collected_at, {', '.join(map(fact_column, columns))}) "
+            f"VALUES (?, {placeholders})")
+
+
+def _rows(batch, columns: tuple, collected_at: str):
+    """Row tuples for a list of record dicts or a column buffer"""
+    if isinstance(batch, ColumnBuffer):
+        return ((collected_at, *row) for row in batch.rows())
+    values = itemgetter(*columns)
+    return ((collected_at, *values(record)) for record in batch)
+
+
+def _frame(batch, columns: tuple) -> pd.DataFrame:
+    if isinstance(batch, ColumnBuffer):
+        return batch.to_frame()
+    return pd.DataFrame.from_records(batch or [], columns=list(columns))
+
+
+class IngestCycle:
+    """One collection cycle, as handed to ingest hooks"""
+
+    def __init__(self, cycle_id: int, collected_at: str, positions, updates):
+        self.cycle_id = cycle_id
+        self.collected_at = collected_at
+        self.positions = positions or []
+        self.updates = updates or []
+
+    def position_rows(self):
+        """(collected_at, *POSITION_COLUMNS) tuples, as written to vehicle_positions"""
+        return _rows(self.positions, POSITION_COLUMNS, self.collected_at)
+
+    @cached_property
+    def positions_frame(self) -> pd.DataFrame:
+        return _frame(self.positions, POSITION_COLUMNS)
+
+    @cached_property
+    def updates_frame(self) -> pd.DataFrame:
+        return _frame(self.updates, UPDATE_COLUMNS)
+
+
+class BulkWriter:
+    """Long-lived writer connection used for every ingest cycle
+
+    `hooks` are called as hook(conn, cycle) inside the cycle's transaction,
+    so anything they maintain commits atomically with the raw rows.
+    `after_commit` hooks are called as hook(cycle) once the cycle is
+    committed, for sinks outside the database; a failing one is reported
+    and does not undo the cycle.
+    """
+
+    INSERT_POSITIONS = _insert_sql("vehicle_positions", POSITION_COLUMNS)
+    INSERT_UPDATES = _insert_sql("trip_updates", UPDATE_COLUMNS)
+    INSERT_CYCLE = """
+        INSERT INTO ingest_cycles (collected_at, position_count, update_count)
+        VALUES (?, ?, ?)
+    """
+
+    def __init__(self, db_path=DATABASE_PATH, hooks: list = None, after_commit: list = None):
+        self.db_path = db_path
+        self.hooks = list(hooks or [])
+        self.after_commit = list(after_commit or [])
+        # Transactions are opened explicitly in write_cycle
+        self.conn = connect(db_path, WRITER_PRAGMAS, isolation_level=None, check_same_thread=False)
+        self.dims = DimensionCache(self.conn)
+
+    def write_cycle(self, positions, updates, changes: list = None, change_tracker=None,
+                    collected_at=None) -> tuple:
+        """Write one cycle's rows in a single transaction
+
+        In CDC mode pass the tracker's `changes`: they are written instead of
+        the trip_updates rows, while the full `updates` still reach the hooks.
+        """
+        collected_at = str(collected_at or datetime.now())
+
+        self.conn.execute("BEGIN")
+        try:
+            cursor = self.conn.execute(self.INSERT_CYCLE,
+                                       (collected_at, len(positions or []), len(updates or [])))
+            cycle = IngestCycle(cursor.lastrowid, collected_at, positions, updates)
+
+            position_count = update_count = 0
+            if positions:
+                with METRICS.timed("insert", table="vehicle_positions"):
+                    self.conn.executemany(self.INSERT_POSITIONS, self.dims.encode(
+                        _rows(positions, POSITION_COLUMNS, collected_at), ("collected_at", *POSITION_COLUMNS)))
+                position_count = len(positions)
+            if changes is not None:
+                with METRICS.timed("insert", table="trip_update_changes"):
+                    update_count = change_tracker.save_changes(self.conn, changes, collected_at)
+            elif updates:
+                with METRICS.timed("insert", table="trip_updates"):
+                    self.conn.executemany(self.INSERT_UPDATES, self.dims.encode(
+                        _rows(updates, UPDATE_COLUMNS, collected_at), ("collected_at", *UPDATE_COLUMNS)))
+                update_count = len(updates)
+
+            for hook in self.hooks:
+                with METRICS.timed("hook", hook=hook.__name__):
+                    hook(self.conn, cycle)
+            with METRICS.timed("commit"):
+                self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            self.dims.rollback()
+            raise
+        self.dims.commit()
+
+        for hook in self.after_commit:
+            try:
+                with METRICS.timed("hook", hook=hook.__name__):
+                    hook(cycle)
+            except Exception as e:
+                print(f"After-commit hook {hook.__name__} failed for cycle {cycle.cycle_id}: {e}")
+
+        written = METRICS.counter("pipeline_rows_written_total", "Rows committed per table")
+        written.inc(position_count, table="vehicle_positions")
+        written.inc(update_count, table="trip_update_changes" if changes is not None else "trip_updates")
+        return position_count, update_count
+
+    def close(self):
+        self.conn.close()
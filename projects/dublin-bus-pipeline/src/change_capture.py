@@ -0,0 +1,238 @@
+"""
+Change-Data-Capture for Trip Updates
+The TripUpdates feed is FULL_DATASET, so every cycle repeats every
+stop_time_update. This module diffs each snapshot against the last known
+state and records only inserts, changes and removals.
+"""
+import sqlite3
+import pandas as pd
+
+INSERT = "I"
+UPDATE = "U"
+DELETE = "D"
+
+# Fields compared between snapshots. The predicted times matter on their own:
+# without a static schedule, stops that only carry a time have no delay. The
+# per-trip `timestamp` is left out on purpose: it moves forward on every feed
+# and would mark every stop as changed.
+TRACKED_FIELDS = ("route_id", "stop_id", "arrival_delay", "departure_delay", "arrival_time", "departure_time")
+
+CHANGE_COLUMNS = (
+    "collected_at", "change_type", "trip_key", "stop_key",
+    "trip_id", "start_date", "start_time", "stop_sequence", *TRACKED_FIELDS, "timestamp"
+)
+
+# Columns added after the change log was first released
+_ADDED_COLUMNS = {"start_time": "TEXT", "arrival_time": "INTEGER", "departure_time": "INTEGER"}
+
+
+def trip_key(record: dict) -> str:
+    """Stable key for the trip a stop_time_update belongs to"""
+    # ADDED trips carry no trip_id, so fall back to route + start time
+    trip_id = record.get("trip_id")
+    if trip_id:
+        return trip_id
+    return f"{record.get('route_id')}@{record.get('start_time')}"
+
+
+def stop_key(record: dict) -> str:
+    """Key of a stop within its trip (stop_sequence, else stop_id)"""
+    if record.get("stop_sequence") is not None:
+        return str(record["stop_sequence"])
+    return f"stop:{record.get('stop_id')}"
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    """Create the change log table and its indexes"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trip_update_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            change_type TEXT NOT NULL,
+            trip_key TEXT NOT NULL,
+            stop_key TEXT NOT NULL,
+            trip_id TEXT,
+            start_date TEXT,
+            start_time TEXT,
+            stop_sequence INTEGER,
+            route_id TEXT,
+            stop_id TEXT,
+            arrival_delay INTEGER,
+            departure_delay INTEGER,
+            arrival_time INTEGER,
+            departure_time INTEGER,
+            timestamp INTEGER
+        )
+    """)
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(trip_update_changes)")}
+    for column, column_type in _ADDED_COLUMNS.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE trip_update_changes ADD COLUMN {column} {column_type}")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_changes_key
+        ON trip_update_changes(trip_key, start_date, stop_key, id)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changes_time ON trip_update_changes(collected_at)")
+
+
+class TripUpdateChangeTracker:
+    """Keeps the last known state of every stop_time_update and diffs new snapshots against it"""
+
+    def __init__(self, conn: sqlite3.Connection = None):
+        self.state = {}
+        if conn is not None:
+            self.load_state(conn)
+
+    def load_state(self, conn: sqlite3.Connection):
+        """Rebuild the in-memory state from the change log (e.g. after a restart)"""
+        query, params = _state_query()
+        cursor = conn.execute(query, params)
+        columns = [col[0] for col in cursor.description]
+        self.state = {}
+        for row in cursor:
+            record = dict(zip(columns, row))
+            self.state[(record["trip_key"], record["start_date"], record["stop_key"])] = record
+
+    @staticmethod
+    def _values(record: dict) -> tuple:
+        return tuple(record.get(field) for field in TRACKED_FIELDS)
+
+    def diff(self, records: list) -> list:
+        """Diff a full snapshot against the current state and advance the state
+
+        Returns change records tagged with `change_type` I (insert), U (update)
+        or D (removed from the feed).
+        """
+        snapshot = {}
+        for record in records:
+            key = (trip_key(record), record.get("start_date"), stop_key(record))
+            snapshot[key] = record
+
+        changes = []
+        for key, record in snapshot.items():
+            previous = self.state.get(key)
+            if previous is None:
+                change_type = INSERT
+            elif self._values(previous) != self._values(record):
+                change_type = UPDATE
+            else:
+                continue
+            changes.append({**record, "change_type": change_type,
+                            "trip_key": key[0], "stop_key": key[2]})
+
+        for key in self.state.keys() - snapshot.keys():
+            previous = self.state[key]
+            changes.append({**previous, "change_type": DELETE,
+                            "trip_key": key[0], "stop_key": key[2]})
+
+        self.state = snapshot
+        return changes
+
+    def save_changes(self, conn: sqlite3.Connection, changes: list, collected_at) -> int:
+        """Append change records to the change log
+
+        The caller owns the transaction, so changes commit together with the
+        rest of the cycle.
+        """
+        if not changes:
+            return 0
+
+        placeholders = ", ".join("?" for _ in CHANGE_COLUMNS)
+        rows = [
+            (str(collected_at), *(change.get(col) for col in CHANGE_COLUMNS[1:]))
+            for change in changes
+        ]
+        conn.executemany(
+            f"INSERT INTO trip_update_changes ({', '.join(CHANGE_COLUMNS)}) VALUES ({placeholders})",
+            rows
+        )
+        return len(rows)
+
+
+def _state_query(as_of=None, include_deleted: bool = False) -> tuple:
+    time_filter = "WHERE collected_at <= ?" if as_of is not None else ""
+    params = (str(as_of),) if as_of is not None else ()
+    deleted_filter = "" if include_deleted else f"WHERE c.change_type != '{DELETE}'"
+
+    return f"""
+        SELECT c.*
+        FROM trip_update_changes c
+        JOIN (
+            SELECT MAX(id) AS id
+            FROM trip_update_changes
+            {time_filter}
+            GROUP BY trip_key, start_date, stop_key
+        ) latest ON c.id = latest.id
+        {deleted_filter}
+        ORDER BY c.trip_key, c.stop_key
+    """, params
+
+
+def state_as_of(conn: sqlite3.Connection, as_of=None) -> pd.DataFrame:
+    """Reconstruct the live stop_time_updates as they were at `as_of`
+
+    With no `as_of` the latest state is returned.
+    """
+    query, params = _state_query(as_of)
+    return pd.read_sql(query, conn, params=params)
+
+
+def states_as_of(conn: sqlite3.Connection, instants):
+    """Yield (as_of, state) for each of `instants` (in ascending order), each
+    state as state_as_of would return it
+
+    Only the first state is queried in full; later ones are advanced by the
+    changes logged in between, so the change log is read once.
+    """
+    instants = [str(as_of) for as_of in instants]
+    if not instants:
+        return
+    query, params = _state_query(instants[0], include_deleted=True)
+    cursor = conn.execute(query, params)
+    columns = [col[0] for col in cursor.description]
+    collected_at = columns.index("collected_at")
+    state = {}
+
+    def apply(row):
+        record = dict(zip(columns, row))
+        key = (record["trip_key"], record["start_date"], record["stop_key"])
+        # Like state_as_of, the newest logged change wins, even if a backfill
+        # logged it with an older collected_at
+        if key not in state or record["id"] > state[key]["id"]:
+            state[key] = record
+
+    for row in cursor.fetchall():
+        apply(row)
+    later = conn.execute(
+        "SELECT * FROM trip_update_changes WHERE collected_at > ? AND collected_at <= ? ORDER BY collected_at, id",
+        (instants[0], instants[-1])
+    ).fetchall()
+
+    position = 0
+    for as_of in instants:
+        while position < len(later) and later[position][collected_at] <= as_of:
+            apply(later[position])
+            position += 1
+        live = [record for record in state.values() if record["change_type"] != DELETE]
+        yield as_of, pd.DataFrame(live, columns=columns)
+
+
+if __name__ == "__main__":
+    import json
+    from config import RAW_DATA_DIR
+    from data_collector import DataCollector
+
+    # Replay the raw snapshots through the tracker to show the write reduction
+    tracker = TripUpdateChangeTracker()
+    total_rows = total_changes = 0
+
+    for path in sorted(RAW_DATA_DIR.glob("updates_*.json")):
+        with open(path) as f:
+            records = DataCollector.parse_trip_updates(json.load(f))
+        changes = tracker.diff(records)
+        total_rows += len(records)
+        total_changes += len(changes)
+        print(f"{path.name}: {len(records):,} rows -> {len(changes):,} changes")
+
+    if total_changes:
+        print(f"\nWrite reduction: {total_rows / total_changes:.1f}x")
@@ -26,3 +26,90 @@ PROCESSED_DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 # Database
 DATABASE_PATH = DATA_DIR / "dublin_bus.db"
+
+# Static GTFS schedule, used to derive delays for stop updates that only
+# carry an absolute arrival time. The index is rebuilt when the zip changes.
+GTFS_STATIC_PATH = Path(os.getenv("GTFS_STATIC_PATH", DATA_DIR / "gtfs" / "GTFS_Realtime.zip"))
+GTFS_INDEX_DIR = DATA_DIR / "gtfs" / "index"
+
+# Ingestion
+# "full" appends every stop_time_update on every cycle, "cdc" only writes
+# inserts, changes and removals to trip_update_changes
+TRIP_UPDATES_INGEST_MODE = os.getenv("TRIP_UPDATES_INGEST_MODE", "full")
+
+# "dict" decodes the whole feed with json and builds one dict per record,
+# "stream" walks entity[] incrementally into typed column buffers
+FEED_PARSER = os.getenv("FEED_PARSER", "dict")
+
+# "json" requests ?format=json, "protobuf" fetches the native GTFS-RT
+# FeedMessage (needs gtfs-realtime-bindings)
+FEED_FORMAT = os.getenv("FEED_FORMAT", "json")
+
+# A vehicle missing from the feed for longer than this is no longer "live"
+VEHICLE_STALE_SECONDS = int(os.getenv("VEHICLE_STALE_SECONDS", "300"))
+
+# Storage. Raw rows older than PARTITION_HOT_DAYS move out of the main
+# database into one file per day; after RAW_RETENTION_DAYS a day's positions
+# are downsampled to one fix per vehicle per DOWNSAMPLE_SECONDS and its raw
+# rows are dropped. 0 disables either step.
+PARTITION_HOT_DAYS = int(os.getenv("PARTITION_HOT_DAYS", "7"))
+RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", "90"))
+DOWNSAMPLE_SECONDS = int(os.getenv("DOWNSAMPLE_SECONDS", "300"))
+
+# Columnar history tier (needs pyarrow; duckdb for HISTORY_ENGINE=duckdb).
+# With HISTORY_DIR set, every committed cycle is also written as Parquet,
+# partitioned by service date and hour, and each finished hour is compacted
+# into one file. HISTORY_ENGINE picks how BusAnalytics scans it.
+HISTORY_DIR = os.getenv("HISTORY_DIR") or None
+HISTORY_ENGINE = os.getenv("HISTORY_ENGINE", "arrow")
+
+# Collection cadence. Cycles start on wall-clock multiples of the interval;
+# a failing endpoint is retried after a jittered exponential backoff capped
+# at FETCH_BACKOFF_MAX_SECONDS
+COLLECTION_INTERVAL_SECONDS = int(os.getenv("COLLECTION_INTERVAL_SECONDS", "60"))
+FETCH_BACKOFF_BASE_SECONDS = float(os.getenv("FETCH_BACKOFF_BASE_SECONDS", "5"))
+FETCH_BACKOFF_MAX_SECONDS = float(os.getenv("FETCH_BACKOFF_MAX_SECONDS", "300"))
+
+# Pipelined ingest (--pipeline) parses, writes and archives each cycle on
+# its own thread, with up to PIPELINE_QUEUE_SIZE cycles waiting per stage
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+# Raw snapshot sink. "archive" appends each feed body, compressed, to one
+# file per day under RAW_ARCHIVE_DIR with an offset index beside it;
+# "files" writes one pretty-printed file per feed to data/raw.
+# RAW_ARCHIVE_CODEC is "zstd" (needs zstandard) or "gzip"; unset picks zstd
+# when it is installed
+RAW_SNAPSHOT_SINK = os.getenv("RAW_SNAPSHOT_SINK", "archive")
+RAW_ARCHIVE_DIR = Path(os.getenv("RAW_ARCHIVE_DIR", DATA_DIR / "archive"))
+RAW_ARCHIVE_CODEC = os.getenv("RAW_ARCHIVE_CODEC") or None
+
+# Raw snapshots are saved on the first cycle and then every
+# RAW_SNAPSHOT_EVERY-th (0 = first only). The archive keeps every cycle by
+# default, since replaying it can only rebuild the cycles it holds; the
+# "files" sink defaults to the first only
+RAW_SNAPSHOT_EVERY = int(os.getenv("RAW_SNAPSHOT_EVERY", "1" if RAW_SNAPSHOT_SINK == "archive" else "0"))
+
+# Instrumentation
+# METRICS_PORT serves Prometheus text metrics at /metrics (0 disables it);
+# METRICS_LOG_PATH appends per-cycle stage timings as JSON lines, rotated by
+# size. PROFILE_MODE ("cprofile" or "tracemalloc") profiles every
+# PROFILE_EVERY-th cycle, writing cProfile dumps to PROFILE_DIR.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH") or None
+PROFILE_MODE = os.getenv("PROFILE_MODE") or None
+PROFILE_EVERY = int(os.getenv("PROFILE_EVERY", "10"))
+PROFILE_DIR = DATA_DIR / "profiles"
+
+# Query result cache. Results are reused until the data watermark moves;
+# the in-memory tier holds up to QUERY_CACHE_ENTRIES results and
+# QUERY_CACHE_MB. Setting QUERY_CACHE_DIR adds an on-disk tier, capped at
+# QUERY_CACHE_DISK_MB, that every process using the directory shares.
+QUERY_CACHE_ENTRIES = int(os.getenv("QUERY_CACHE_ENTRIES", "256"))
+QUERY_CACHE_MB = float(os.getenv("QUERY_CACHE_MB", "256"))
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR") or None
+QUERY_CACHE_DISK_MB = float(os.getenv("QUERY_CACHE_DISK_MB", "1024"))
+
+# Dashboard
+# Hours of history the dashboard keeps in memory (0 keeps everything). Wider
+# sidebar ranges are queried from SQLite on demand.
+DASHBOARD_WINDOW_HOURS = float(os.getenv("DASHBOARD_WINDOW_HOURS", "24"))
@@ -4,100 +4,210 @@ Fetches vehicle positions and trip updates from Transport for Ireland API
 """
 import json
 import sqlite3
-import requests
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-import pandas as pd
 from config import (
     TFI_API_KEY, 
-    VEHICLES_ENDPOINT, 
-    TRIP_UPDATES_ENDPOINT,
+    TFI_BASE_URL,
     DATABASE_PATH,
-    RAW_DATA_DIR
+    RAW_DATA_DIR,
+    TRIP_UPDATES_INGEST_MODE,
+    FEED_PARSER,
+    FEED_FORMAT,
+    COLLECTION_INTERVAL_SECONDS,
+    FETCH_BACKOFF_BASE_SECONDS,
+    FETCH_BACKOFF_MAX_SECONDS,
+    METRICS_PORT,
+    METRICS_LOG_PATH,
+    PROFILE_MODE,
+    PROFILE_EVERY,
+    PROFILE_DIR,
+    PIPELINE_QUEUE_SIZE,
+    RAW_SNAPSHOT_EVERY,
+    RAW_SNAPSHOT_SINK,
+    HISTORY_DIR
 )
+from change_capture import TripUpdateChangeTracker, create_tables as create_change_tables
+from feed_fetcher import FeedFetcher
+from bulk_writer import BulkWriter
+from db import WRITER_PRAGMAS
+import rollups
+import quantile_sketch
+import vehicle_state
+import spatial_index
+import heatmap
+import trajectories
+import dimensions
+import partitions
+from history import HistoryWriter
+from raw_archive import RawArchive
+from gtfs_static import ScheduleIndex
+from scheduler import Backoff, FixedRateScheduler
+from pipeline import IngestPipeline, snapshot_due
+from instrumentation import METRICS, CycleProfiler, MetricsLog, MetricsServer, record_db_size
+from stream_parser import ColumnBuffer, parse_vehicle_positions_stream, parse_trip_updates_stream
+from protobuf_feed import parse_vehicle_positions_pb, parse_trip_updates_pb, peek_feed_timestamp_pb
 
 
 class DataCollector:
     """Collects real-time bus data from TFI API"""
     
-    def __init__(self):
+    def __init__(self, ingest_mode: str = TRIP_UPDATES_INGEST_MODE, parser: str = FEED_PARSER,
+                 feed_format: str = FEED_FORMAT, db_path=DATABASE_PATH, base_url: str = TFI_BASE_URL,
+                 metrics_log=METRICS_LOG_PATH, profile: str = PROFILE_MODE,
+                 profile_every: int = PROFILE_EVERY, history_dir=HISTORY_DIR,
+                 snapshot_sink: str = RAW_SNAPSHOT_SINK):
+        if ingest_mode not in ("full", "cdc"):
+            raise ValueError(f"Unknown ingest mode: {ingest_mode}")
+        if snapshot_sink not in ("archive", "files"):
+            raise ValueError(f"Unknown raw snapshot sink: {snapshot_sink}")
+        if parser not in ("dict", "stream"):
+            raise ValueError(f"Unknown feed parser: {parser}")
+        if feed_format not in ("json", "protobuf"):
+            raise ValueError(f"Unknown feed format: {feed_format}")
+        
         self.headers = {"x-api-key": TFI_API_KEY}
-        self._init_database()
+        self.ingest_mode = ingest_mode
+        self.parser = parser
+        self.feed_format = feed_format
+        self.db_path = db_path
+        self.raw_archive = RawArchive() if snapshot_sink == "archive" else None
+        
+        if feed_format == "protobuf":
+            # Protobuf is always decoded straight into column buffers
+            self.fetcher = FeedFetcher(self.headers, decode_json=False,
+                                       timestamp_reader=peek_feed_timestamp_pb)
+            self.endpoints = {"vehicles": f"{base_url}/Vehicles", "updates": f"{base_url}/TripUpdates"}
+        else:
+            self.fetcher = FeedFetcher(self.headers, decode_json=(parser == "dict"))
+            self.endpoints = {
+                "vehicles": f"{base_url}/Vehicles?format=json",
+                "updates": f"{base_url}/TripUpdates?format=json"
+            }
+        self.backoff = {
+            name: Backoff(FETCH_BACKOFF_BASE_SECONDS, FETCH_BACKOFF_MAX_SECONDS)
+            for name in self.endpoints
+        }
+        self.metrics_log = MetricsLog(metrics_log) if metrics_log else None
+        self.profiler = CycleProfiler(profile, profile_every, PROFILE_DIR) if profile else None
+        self.cycle_count = 0
+        self._local = threading.local()
+        self.maintained_on = None
+        
+        with METRICS.timed("init"):
+            self._init_database()
+        self.schedule = ScheduleIndex.open()
+        if self.schedule is None:
+            print("No static GTFS schedule; stop updates without a delay are stored as NULL")
+        self.writer = BulkWriter(db_path, hooks=[rollups.update_rollups,
+                                                   quantile_sketch.update_sketches,
+                                                   vehicle_state.update_vehicle_latest,
+                                                   spatial_index.update_index,
+                                                   heatmap.update_heatmap])
+        self.history = None
+        if history_dir is not None:
+            self.history = HistoryWriter(history_dir, conn=self.writer.conn)
+            self.writer.after_commit.append(self.history.append_cycle)
+        
+        self.change_tracker = None
+        if ingest_mode == "cdc":
+            self.change_tracker = TripUpdateChangeTracker(self.writer.conn)
     
     def _init_database(self):
         """Initialize SQLite database with required tables"""
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        # Vehicle positions table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS vehicle_positions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                vehicle_id TEXT,
-                trip_id TEXT,
-                route_id TEXT,
-                latitude REAL,
-                longitude REAL,
-                timestamp INTEGER,
-                start_time TEXT,
-                start_date TEXT,
-                direction_id INTEGER
-            )
-        """)
+        # Only takes effect on a new database; see partitions.enable_incremental_vacuum
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL is persistent, so switching before any table exists means no
+        # reader ever sees the database in rollback-journal mode
+        cursor.execute(f"PRAGMA journal_mode = {WRITER_PRAGMAS['journal_mode']}")
+        
+        # Raw rows, keyed to route/stop/trip/vehicle dimensions
+        dimensions.create_tables(cursor)
         
-        # Trip updates table (delays)
+        # One row per ingest cycle (snapshot catalog)
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS trip_updates (
+            CREATE TABLE IF NOT EXISTS ingest_cycles (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                trip_id TEXT,
-                route_id TEXT,
-                stop_id TEXT,
-                arrival_delay INTEGER,
-                departure_delay INTEGER,
-                timestamp INTEGER
+                collected_at TIMESTAMP NOT NULL,
+                position_count INTEGER NOT NULL,
+                update_count INTEGER NOT NULL
             )
         """)
         
+        # Change log for CDC ingestion
+        create_change_tables(cursor)
+        
+        # Aggregates maintained at ingest time
+        rollups.create_tables(cursor)
+        quantile_sketch.create_tables(cursor)
+        vehicle_state.create_tables(cursor)
+        spatial_index.create_tables(cursor)
+        heatmap.create_tables(cursor)
+        
+        # Day partitions and downsampled history
+        partitions.create_tables(cursor)
+        
         # Create indexes for faster queries
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_positions_time ON vehicle_positions(collected_at)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_positions_route ON vehicle_positions(route_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_updates_trip ON trip_updates(trip_id)")
+        trajectories.create_indexes(cursor)
+        
+        # Databases collected before rollups existed get them rebuilt once
+        rollups.backfill_if_empty(conn)
+        quantile_sketch.backfill_if_empty(conn)
+        vehicle_state.backfill_if_empty(conn)
+        spatial_index.backfill_if_empty(conn)
+        heatmap.backfill_if_empty(conn)
         
         conn.commit()
+        # Returns the space freed by converting pre-dimension raw tables
+        partitions.incremental_vacuum(conn)
         conn.close()
-        print(f"Database initialized at {DATABASE_PATH}")
+        print(f"Database initialized at {self.db_path}")
+    
+    @property
+    def cycle_timings(self) -> dict:
+        """Stage timings of the cycle this thread is working on
+
+        Thread-local so that pipelined stages, each on its own thread, time
+        into whichever cycle they are handling.
+        """
+        if not hasattr(self._local, "timings"):
+            self._local.timings = {}
+        return self._local.timings
+    
+    @cycle_timings.setter
+    def cycle_timings(self, timings: dict):
+        self._local.timings = timings
+    
+    @contextmanager
+    def _stage(self, stage: str, **labels):
+        """Time a stage into the metrics registry and this cycle's breakdown"""
+        with METRICS.timed(stage, **labels) as timer:
+            yield timer
+        key = "_".join([stage, *map(str, labels.values())])
+        self.cycle_timings[key] = self.cycle_timings.get(key, 0.0) + timer.elapsed
+    
+    def _fetch(self, name: str) -> dict:
+        result = self.fetcher.fetch(name, self.endpoints[name])
+        if result.error:
+            print(f"Error fetching {name}: {result.error}")
+        return result.data
     
     def fetch_vehicle_positions(self) -> dict:
         """Fetch current vehicle positions"""
-        try:
-            response = requests.get(
-                f"{VEHICLES_ENDPOINT}?format=json",
-                headers=self.headers,
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            print(f"Error fetching vehicle positions: {e}")
-            return {}
+        return self._fetch("vehicles")
     
     def fetch_trip_updates(self) -> dict:
         """Fetch trip updates (delays)"""
-        try:
-            response = requests.get(
-                f"{TRIP_UPDATES_ENDPOINT}?format=json",
-                headers=self.headers,
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            print(f"Error fetching trip updates: {e}")
-            return {}
+        return self._fetch("updates")
     
-    def parse_vehicle_positions(self, data: dict) -> list:
+    @staticmethod
+    def parse_vehicle_positions(data: dict) -> list:
         """Parse vehicle positions from API response"""
         records = []
         entities = data.get("entity", [])
@@ -121,7 +231,8 @@ class DataCollector:
         
         return records
     
-    def parse_trip_updates(self, data: dict) -> list:
+    @staticmethod
+    def parse_trip_updates(data: dict) -> list:
         """Parse trip updates (delays) from API response"""
         records = []
         entities = data.get("entity", [])
@@ -137,93 +248,273 @@ class DataCollector:
                 records.append({
                     "trip_id": trip.get("trip_id"),
                     "route_id": trip.get("route_id"),
+                    "start_date": trip.get("start_date"),
+                    "start_time": trip.get("start_time"),
+                    "stop_sequence": stop_update.get("stop_sequence"),
                     "stop_id": stop_update.get("stop_id"),
-                    "arrival_delay": arrival.get("delay", 0),
-                    "departure_delay": departure.get("delay", 0),
-                    "timestamp": trip_update.get("timestamp")
+                    "arrival_delay": arrival.get("delay"),
+                    "departure_delay": departure.get("delay"),
+                    "timestamp": trip_update.get("timestamp"),
+                    "arrival_time": arrival.get("time"),
+                    "departure_time": departure.get("time")
                 })
         
         return records
     
-    def save_to_database(self, positions: list, updates: list):
-        """Save collected data to SQLite database"""
-        conn = sqlite3.connect(DATABASE_PATH)
+    def save_to_database(self, positions, updates, collected_at=None) -> tuple:
+        """Save collected data to SQLite database
         
-        if positions:
-            df_positions = pd.DataFrame(positions)
-            df_positions["collected_at"] = datetime.now()
-            df_positions.to_sql("vehicle_positions", conn, if_exists="append", index=False)
-            print(f"Saved {len(positions)} vehicle positions")
+        Accepts either lists of record dicts or column buffers from the streaming
+        parser, and writes the whole cycle in one transaction. Missing delays
+        are first derived from the static schedule when one is available.
+        Replays pass the cycle's original `collected_at` (default: now).
+        Returns (positions saved, trip updates or changes saved).
+        """
+        if updates and self.schedule is not None:
+            with self._stage("derive_delays"):
+                self.schedule.fill_delays(updates)
         
-        if updates:
-            df_updates = pd.DataFrame(updates)
-            df_updates["collected_at"] = datetime.now()
-            df_updates.to_sql("trip_updates", conn, if_exists="append", index=False)
-            print(f"Saved {len(updates)} trip updates")
+        changes = None
+        if updates and self.change_tracker is not None:
+            records = updates.to_records() if isinstance(updates, ColumnBuffer) else updates
+            with self._stage("cdc_diff"):
+                changes = self.change_tracker.diff(records)
+            feed_updates = len(updates)
         
-        conn.close()
+        try:
+            with self._stage("write"):
+                saved_positions, saved_updates = self.writer.write_cycle(
+                    positions, updates, changes=changes, change_tracker=self.change_tracker,
+                    collected_at=collected_at
+                )
+        except Exception:
+            # The diff already advanced the tracker; resync it with what was committed
+            if changes is not None:
+                self.change_tracker.load_state(self.writer.conn)
+            raise
+        record_db_size(self.db_path)
+        
+        if saved_positions:
+            print(f"Saved {saved_positions} vehicle positions")
+        if changes is not None:
+            print(f"Saved {saved_updates} trip update changes ({feed_updates} in feed)")
+        elif saved_updates:
+            print(f"Saved {saved_updates} trip updates")
+        return saved_positions, saved_updates
     
-    def save_raw_snapshot(self, data: dict, prefix: str):
+    def save_raw_snapshot(self, data, prefix: str):
         """Save raw API response as JSON for debugging"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filepath = RAW_DATA_DIR / f"{prefix}_{timestamp}.json"
+        suffix = ".pb" if self.feed_format == "protobuf" else ".json"
+        filepath = RAW_DATA_DIR / f"{prefix}_{timestamp}{suffix}"
         
-        with open(filepath, "w") as f:
-            json.dump(data, f, indent=2)
+        with self._stage("raw_save", feed=prefix):
+            # The streaming and protobuf paths keep the undecoded body
+            if isinstance(data, bytes):
+                filepath.write_bytes(data)
+            else:
+                with open(filepath, "w") as f:
+                    json.dump(data, f, indent=2)
         
+        METRICS.counter("raw_snapshot_bytes_total", "Bytes written to raw snapshots").inc(
+            filepath.stat().st_size, feed=prefix
+        )
         return filepath
     
+    def _parse(self, result, dict_parser, stream_parser, pb_parser):
+        if result is None:
+            return []
+        with self._stage("parse", feed=result.name):
+            if self.feed_format == "protobuf":
+                _, records = pb_parser(result.content)
+            elif self.parser == "stream":
+                _, records = stream_parser(result.content)
+            else:
+                records = dict_parser(result.data)
+        METRICS.counter("pipeline_rows_parsed_total", "Records parsed from each feed").inc(
+            len(records), feed=result.name
+        )
+        return records
+    
     def collect(self, save_raw: bool = False):
-        """Run a single collection cycle"""
+        """Run a single collection cycle, profiled if this is a profiling cycle"""
+        self.cycle_count += 1
+        self.cycle_timings = {}
+        if self.profiler is None:
+            return self._collect(save_raw)
+        with self.profiler.profile(self.cycle_count):
+            return self._collect(save_raw)
+    
+    def _collect(self, save_raw: bool):
         print(f"\n{'='*50}")
         print(f"Collection started at {datetime.now()}")
         
-        # Fetch data
-        positions_data = self.fetch_vehicle_positions()
-        updates_data = self.fetch_trip_updates()
+        fresh = self.fetch_feeds()
+        collected_at = str(datetime.now())
+        if save_raw:
+            self.archive_feeds(fresh, collected_at)
+        positions, updates = self.parse_feeds(fresh)
+        self.finish_cycle(positions, updates, collected_at=collected_at)
+        print(f"Collection completed at {datetime.now()}")
+        return len(positions), len(updates)
+    
+    def fetch_feeds(self) -> dict:
+        """Fetch every endpoint that is not backing off; {name: FetchResult} of new feeds"""
+        # Fetch both feeds concurrently over the pooled session, leaving out
+        # any endpoint that is still backing off after a failure
+        now = time.time()
+        due = {name: url for name, url in self.endpoints.items() if self.backoff[name].ready(now)}
+        for name in self.endpoints.keys() - due.keys():
+            print(f"Skipping {name}: backing off for {self.backoff[name].retry_at - now:.0f}s more")
         
-        # Save raw if requested
-        if save_raw and positions_data:
-            self.save_raw_snapshot(positions_data, "vehicles")
-        if save_raw and updates_data:
-            self.save_raw_snapshot(updates_data, "updates")
+        results = self.fetcher.fetch_all(due)
+        for result in results.values():
+            self.cycle_timings[f"fetch_{result.name}"] = result.latency_seconds
+            if result.error:
+                wait = self.backoff[result.name].failure()
+                print(f"Error fetching {result.name}: {result.error} (retry in {wait:.0f}s)")
+            else:
+                self.backoff[result.name].success()
+                status = "unchanged, skipped" if result.unchanged else "new"
+                print(f"Fetched {result.name}: {result.wire_bytes:,} bytes "
+                      f"in {result.latency_seconds:.2f}s ({status})")
         
-        # Parse data
-        positions = self.parse_vehicle_positions(positions_data)
-        updates = self.parse_trip_updates(updates_data)
+        # Feeds whose header timestamp hasn't moved are not parsed again
+        return {
+            name: result for name, result in results.items()
+            if result.error is None and not result.unchanged
+        }
+    
+    def archive_feeds(self, fresh: dict, collected_at: str = None):
+        """Save each new feed as a raw snapshot, to the archive or as separate files
         
-        # Save to database
-        self.save_to_database(positions, updates)
+        Archived snapshots carry the cycle's `collected_at`, so a replay
+        writes the same timestamp as the live cycle did.
+        """
+        collected_at = collected_at or str(datetime.now())
+        for name, result in fresh.items():
+            body = result.data if self.fetcher.decode_json else result.content
+            if self.raw_archive is None:
+                self.save_raw_snapshot(body, name)
+                continue
+            with self._stage("raw_save", feed=name):
+                size = self.raw_archive.append(name, body, collected_at,
+                                               "pb" if self.feed_format == "protobuf" else "json",
+                                               result.feed_timestamp)
+            METRICS.counter("raw_snapshot_bytes_total", "Bytes written to raw snapshots").inc(size, feed=name)
+    
+    def parse_feeds(self, fresh: dict) -> tuple:
+        """(positions, updates) parsed from the new feeds"""
+        positions = self._parse(fresh.get("vehicles"), self.parse_vehicle_positions,
+                                parse_vehicle_positions_stream, parse_vehicle_positions_pb)
+        updates = self._parse(fresh.get("updates"), self.parse_trip_updates,
+                              parse_trip_updates_stream, parse_trip_updates_pb)
+        return positions, updates
+    
+    def finish_cycle(self, positions, updates, cycle_number: int = None, collected_at: str = None):
+        """Write a parsed cycle, run daily maintenance and report the cycle's timings"""
+        self.save_to_database(positions, updates, collected_at=collected_at)
+        self._maintain_storage()
+        self._report_cycle(len(positions) + len(updates), cycle_number)
+    
+    def _maintain_storage(self):
+        """Compact finished history hours once per hour, and archive and expire
+        day partitions once per calendar day"""
+        now = datetime.now()
+        if self.history is not None and self.history.compaction_due(now):
+            with self._stage("compaction"):
+                compacted = self.history.compact_finished_hours(now)
+            if compacted:
+                print(f"History compaction: {compacted} partition(s) compacted")
+        today = now.date()
+        if self.maintained_on == today:
+            return
+        with self._stage("maintenance"):
+            result = partitions.maintain(self.writer.conn, today=today)
+        self.maintained_on = today
+        if result["archived"] or result["expired"]:
+            print(f"Storage maintenance: {len(result['archived'])} day(s) archived, "
+                  f"{len(result['expired'])} expired, {result['pages_freed']:,} pages freed")
+    
+    def _report_cycle(self, rows: int, cycle_number: int = None):
+        """Print this cycle's stage breakdown and append it to the metrics log"""
+        write_seconds = self.cycle_timings.get("write", 0.0)
+        rows_per_second = rows / write_seconds if write_seconds else 0.0
+        METRICS.gauge("pipeline_write_rows_per_second", "Rows written per second in the last cycle").set(
+            rows_per_second
+        )
+        METRICS.counter("pipeline_cycles_total", "Collection cycles completed").inc()
+        print("Stage timings: " + ", ".join(
+            f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in self.cycle_timings.items()
+        ) + f" ({rows_per_second:,.0f} rows/s written)")
         
-        print(f"Collection completed at {datetime.now()}")
-        return len(positions), len(updates)
+        if self.metrics_log is not None:
+            self.metrics_log.write({
+                "cycle": self.cycle_count if cycle_number is None else cycle_number,
+                "completed_at": datetime.now().isoformat(),
+                "rows": rows,
+                "rows_per_second": round(rows_per_second, 1),
+                "stages": {stage: round(seconds, 6) for stage, seconds in self.cycle_timings.items()},
+                "db_bytes": METRICS.gauge("sqlite_file_bytes").get(file="db"),
+                "wal_bytes": METRICS.gauge("sqlite_file_bytes").get(file="wal"),
+            })
 
 
-def run_continuous_collection(interval_seconds: int = 60, duration_minutes: int = 30):
-    """Run continuous data collection for specified duration"""
-    import time
+def run_continuous_collection(interval_seconds: int = COLLECTION_INTERVAL_SECONDS, duration_minutes: int = 30,
+                              ingest_mode: str = TRIP_UPDATES_INGEST_MODE, parser: str = FEED_PARSER,
+                              feed_format: str = FEED_FORMAT, base_url: str = TFI_BASE_URL,
+                              metrics_port: int = METRICS_PORT,
+                              metrics_log=METRICS_LOG_PATH, profile: str = PROFILE_MODE,
+                              profile_every: int = PROFILE_EVERY, pipelined: bool = False,
+                              queue_size: int = PIPELINE_QUEUE_SIZE, snapshot_every: int = RAW_SNAPSHOT_EVERY):
+    """Run continuous data collection for specified duration
     
-    collector = DataCollector()
-    end_time = datetime.now().timestamp() + (duration_minutes * 60)
-    collection_count = 0
+    pipelined runs parsing, writing and raw snapshots on their own threads,
+    so the scheduler thread only fetches and ticks stay on time.
+    """
+    collector = DataCollector(ingest_mode=ingest_mode, parser=parser, feed_format=feed_format,
+                              base_url=base_url, metrics_log=metrics_log, profile=profile, profile_every=profile_every)
+    server = MetricsServer(metrics_port) if metrics_port else None
+    end_time = time.time() + (duration_minutes * 60)
+    scheduler = FixedRateScheduler(interval_seconds)
+    
+    pipeline = IngestPipeline(collector, queue_size, snapshot_every).start() if pipelined else None
     
     print(f"Starting continuous collection for {duration_minutes} minutes")
-    print(f"Collecting every {interval_seconds} seconds")
+    print(f"Collecting every {interval_seconds} seconds" + (" (pipelined)" if pipelined else ""))
     
-    while datetime.now().timestamp() < end_time:
-        try:
-            positions, updates = collector.collect(save_raw=(collection_count == 0))
-            collection_count += 1
-            print(f"Total collections: {collection_count}")
-            time.sleep(interval_seconds)
-        except KeyboardInterrupt:
-            print("\nCollection stopped by user")
-            break
-        except Exception as e:
-            print(f"Error during collection: {e}")
-            time.sleep(interval_seconds)
-    
-    print(f"\nCollection finished. Total cycles: {collection_count}")
+    def cycle(tick):
+        lag = time.time() - tick
+        if pipeline is not None:
+            pipeline.submit(tick)
+        else:
+            collector.collect(save_raw=snapshot_due(scheduler.stats.ticks_run + 1, snapshot_every))
+        print(f"Total collections: {scheduler.stats.ticks_run + 1} (started {lag:.2f}s after tick)")
+    
+    try:
+        scheduler.run(cycle, until=end_time,
+                      on_error=lambda e: print(f"Error during collection: {e}"))
+    except KeyboardInterrupt:
+        print("\nCollection stopped by user")
+    
+    if pipeline is not None:
+        print("Draining pipeline (Ctrl-C again to abandon queued cycles)")
+        pipeline.close()
+    
+    collector.fetcher.close()
+    collector.writer.close()
+    if collector.metrics_log is not None:
+        collector.metrics_log.close()
+    if server is not None:
+        server.close()
+    print(f"\nCollection finished. {scheduler.stats.summary()}")
+    for name, stats in collector.fetcher.stats.items():
+        print(f"  {name}: {stats.requests} requests, {stats.errors} errors, "
+              f"{stats.unchanged} unchanged, avg {stats.avg_latency:.2f}s, "
+              f"{stats.wire_bytes / 1e6:.1f} MB on the wire")
+    if pipeline is not None:
+        print("Pipeline stages:")
+        print(pipeline.summary())
 
 
 if __name__ == "__main__":
@@ -232,15 +523,51 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Dublin Bus Data Collector")
     parser.add_argument("--once", action="store_true", help="Run single collection")
     parser.add_argument("--duration", type=int, default=30, help="Duration in minutes")
-    parser.add_argument("--interval", type=int, default=60, help="Interval in seconds")
+    parser.add_argument("--interval", type=int, default=COLLECTION_INTERVAL_SECONDS,
+                        help="Interval in seconds")
+    parser.add_argument("--mode", choices=["full", "cdc"], default=TRIP_UPDATES_INGEST_MODE,
+                        help="Trip update ingestion mode")
+    parser.add_argument("--parser", choices=["dict", "stream"], default=FEED_PARSER,
+                        help="Feed parser implementation")
+    parser.add_argument("--format", choices=["json", "protobuf"], default=FEED_FORMAT,
+                        help="Wire format requested from the API")
+    parser.add_argument("--base-url", default=TFI_BASE_URL,
+                        help="GTFS-RT API base URL (e.g. a local replay server)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this local port (0 = off)")
+    parser.add_argument("--metrics-log", default=METRICS_LOG_PATH,
+                        help="Append per-cycle stage timings to this rotated JSON-lines file")
+    parser.add_argument("--profile", choices=CycleProfiler.MODES, default=PROFILE_MODE,
+                        help="Profile cycles with cProfile or tracemalloc")
+    parser.add_argument("--profile-every", type=int, default=PROFILE_EVERY,
+                        help="Profile every Nth cycle")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Parse, write and save snapshots on separate threads from fetching")
+    parser.add_argument("--queue-size", type=int, default=PIPELINE_QUEUE_SIZE,
+                        help="Cycles that may wait in front of each pipeline stage")
+    parser.add_argument("--snapshot-every", type=int, default=RAW_SNAPSHOT_EVERY,
+                        help="Save raw snapshots every Nth cycle as well as the first (0 = first only; "
+                             "defaults to every cycle with the archive sink)")
     
     args = parser.parse_args()
     
     if args.once:
-        collector = DataCollector()
+        collector = DataCollector(ingest_mode=args.mode, parser=args.parser, feed_format=args.format,
+                                  base_url=args.base_url, metrics_log=args.metrics_log, profile=args.profile, profile_every=1)
         collector.collect(save_raw=True)
     else:
         run_continuous_collection(
             interval_seconds=args.interval,
-            duration_minutes=args.duration
+            duration_minutes=args.duration,
+            ingest_mode=args.mode,
+            parser=args.parser,
+            feed_format=args.format,
+            base_url=args.base_url,
+            metrics_port=args.metrics_port,
+            metrics_log=args.metrics_log,
+            profile=args.profile,
+            profile_every=args.profile_every,
+            pipelined=args.pipeline,
+            queue_size=args.queue_size,
+            snapshot_every=args.snapshot_every
         )
@@ -0,0 +1,131 @@
+"""
+SQLite Connection Helpers
+Shared connection setup so every writer runs with the same pragmas, and a
+pool of read-only connections for analytics and dashboard sessions
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from config import DATABASE_PATH
+
+# WAL lets readers carry on during writes and turns each commit into a
+# sequential append; synchronous=NORMAL only fsyncs at checkpoints, which is
+# safe in WAL mode (a crash can lose the last cycle but never corrupts the DB)
+WRITER_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,       # 64 MB page cache
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,     # 256 MB
+}
+
+# Readers see the snapshot from the start of each query and never take the
+# write lock; query_only turns an accidental write into an error instead of
+# a lock the collector has to wait on. busy_timeout only matters for the
+# brief moments WAL needs an exclusive lock (recovery after a crash)
+READER_PRAGMAS = {
+    "query_only": 1,
+    "busy_timeout": 5000,
+    "cache_size": -16000,       # 16 MB page cache per connection
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,     # 256 MB, shared with the writer through the OS page cache
+}
+
+
+def connect(db_path=DATABASE_PATH, pragmas: dict = None, **kwargs) -> sqlite3.Connection:
+    """Open a connection with the given pragmas applied"""
+    conn = sqlite3.connect(db_path, **kwargs)
+    for name, value in (pragmas or {}).items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+class ReadPool:
+    """Thread-safe pool of query_only connections to one database
+
+    Connections are opened lazily up to `size`; a caller that finds them all
+    checked out waits up to `timeout` seconds. Each connection is used by one
+    thread at a time but may move between threads, as Streamlit sessions do.
+    The single writer is BulkWriter's connection, which is what puts the
+    database in WAL mode.
+    """
+
+    def __init__(self, db_path=DATABASE_PATH, size: int = 4, timeout: float = 30.0,
+                 pragmas: dict = READER_PRAGMAS):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection; release() must hand it back"""
+        if self._closed:
+            raise RuntimeError("Read pool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return connect(self.db_path, self.pragmas, check_same_thread=False)
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No read connection free after {self.timeout:g}s") from None
+
+    def release(self, conn: sqlite3.Connection):
+        # End any read transaction so the snapshot doesn't pin the WAL and
+        # stop checkpoints from resetting it
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close idle connections now and checked-out ones as they are released"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def read_pool(db_path=DATABASE_PATH, size: int = 4) -> ReadPool:
+    """The process-wide read pool for a database file"""
+    key = str(Path(db_path).resolve())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            pool = _pools[key] = ReadPool(db_path, size)
+        return pool
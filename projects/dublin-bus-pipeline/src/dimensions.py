@@ -0,0 +1,276 @@
+"""
+Dimension Tables
+Route, stop, trip and vehicle IDs are stored once each in small dimension
+tables and referenced from the raw fact tables by integer surrogate keys,
+so rows and indexes shrink and group-bys compare integers instead of
+strings. The vehicle_positions and trip_updates views join the IDs back
+in, with the original columns in the original order, so every reader
+(and the day partitions, which stay denormalized) sees the same rows as
+before. Routes also carry their agency prefix and operator.
+"""
+import sqlite3
+import pandas as pd
+
+# ID column -> (dimension table, surrogate key column)
+DIMENSIONS = {
+    "route_id": ("routes", "route_sk"),
+    "stop_id": ("stops", "stop_sk"),
+    "trip_id": ("trips", "trip_sk"),
+    "vehicle_id": ("vehicles", "vehicle_sk"),
+}
+
+# View -> fact table holding its rows
+FACT_TABLES = {
+    "vehicle_positions": "vehicle_positions_fact",
+    "trip_updates": "trip_updates_fact",
+}
+
+# Columns of each view, in the order of the original tables
+VIEW_COLUMNS = {
+    "vehicle_positions": ("id", "collected_at", "vehicle_id", "trip_id", "route_id", "latitude", "longitude",
+                          "timestamp", "start_time", "start_date", "direction_id"),
+    "trip_updates": ("id", "collected_at", "trip_id", "route_id", "stop_id", "arrival_delay",
+                     "departure_delay", "timestamp", "start_date", "start_time", "stop_sequence",
+                     "arrival_time", "departure_time"),
+}
+
+# Positions joined to their vehicle (and route), for queries that filter on
+# vehicle_id: an inner join lets SQLite start from the vehicle instead of
+# scanning the fact table, which the view's left joins cannot
+POSITIONS_BY_VEHICLE = "vehicle_positions_fact JOIN vehicles USING (vehicle_sk) LEFT JOIN routes USING (route_sk)"
+
+
+def operator_for(route_id: str) -> str:
+    """Operator of a TFI route ID, from its agency prefix"""
+    # 5240_xxx = Dublin Bus
+    # 5249_xxx = Go-Ahead
+    # Other 52xx patterns for Bus Éireann
+    if route_id.startswith('5240'):
+        return 'Dublin Bus'
+    if route_id.startswith('5249'):
+        return 'Go-Ahead Ireland'
+    if route_id.startswith('52'):
+        return 'Bus Éireann'
+    return 'Other'
+
+
+def fact_column(column: str) -> str:
+    """Name of a view column in the fact table"""
+    return DIMENSIONS[column][1] if column in DIMENSIONS else column
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    """Create dimension and fact tables and the views over them
+
+    A database collected before dimensions existed has its raw tables
+    converted in place, keeping every row id.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS routes (
+            route_sk INTEGER PRIMARY KEY,
+            route_id TEXT NOT NULL UNIQUE,
+            agency TEXT,
+            operator TEXT NOT NULL
+        )
+    """)
+    for column, (table, key) in DIMENSIONS.items():
+        if table != "routes":
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {key} INTEGER PRIMARY KEY,
+                    {column} TEXT NOT NULL UNIQUE
+                )
+            """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vehicle_positions_fact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            vehicle_sk INTEGER,
+            trip_sk INTEGER,
+            route_sk INTEGER,
+            latitude REAL,
+            longitude REAL,
+            timestamp INTEGER,
+            start_time TEXT,
+            start_date TEXT,
+            direction_id INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trip_updates_fact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            collected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            trip_sk INTEGER,
+            route_sk INTEGER,
+            stop_sk INTEGER,
+            arrival_delay INTEGER,
+            departure_delay INTEGER,
+            timestamp INTEGER,
+            start_date TEXT,
+            start_time TEXT,
+            stop_sequence INTEGER,
+            arrival_time INTEGER,
+            departure_time INTEGER
+        )
+    """)
+
+    for view in FACT_TABLES:
+        if _table_type(cursor, view) == "table":
+            _migrate(cursor, view)
+        cursor.execute(_view_sql(view))
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_positions_time ON vehicle_positions_fact(collected_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_positions_route ON vehicle_positions_fact(route_sk)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_updates_trip ON trip_updates_fact(trip_sk)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_updates_time ON trip_updates_fact(collected_at)")
+
+
+def _table_type(cursor: sqlite3.Cursor, name: str) -> str:
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _view_sql(view: str) -> str:
+    # Left joins: rows without an ID keep a NULL key, and SQLite drops the
+    # join entirely from queries that never read the ID
+    columns, joins = [], []
+    for column in VIEW_COLUMNS[view]:
+        if column in DIMENSIONS:
+            table, key = DIMENSIONS[column]
+            columns.append(f"{table}.{column}")
+            joins.append(f"LEFT JOIN {table} ON {table}.{key} = f.{key}")
+        else:
+            columns.append(f"f.{column}")
+    return (f"CREATE VIEW IF NOT EXISTS {view} AS SELECT {', '.join(columns)} "
+            f"FROM {FACT_TABLES[view]} f {' '.join(joins)}")
+
+
+def _migrate(cursor: sqlite3.Cursor, table: str):
+    """Move a pre-dimension raw table's rows into its fact table and drop it"""
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    rows = cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    print(f"Encoding {rows:,} {table} rows with dimension keys...")
+
+    for column in DIMENSIONS:
+        if column in existing:
+            _add_ids(cursor, column, (value for (value,) in cursor.execute(
+                f"SELECT DISTINCT {column} FROM {table} WHERE {column} IS NOT NULL").fetchall()))
+
+    # Columns added after the first release may be missing entirely
+    columns, values, joins = [], [], []
+    for column in VIEW_COLUMNS[table]:
+        columns.append(fact_column(column))
+        if column not in existing:
+            values.append("NULL")
+        elif column in DIMENSIONS:
+            dimension, key = DIMENSIONS[column]
+            values.append(f"{dimension}.{key}")
+            joins.append(f"LEFT JOIN {dimension} ON {dimension}.{column} = t.{column}")
+        else:
+            values.append(f"t.{column}")
+    cursor.execute(f"INSERT INTO {FACT_TABLES[table]} ({', '.join(columns)}) "
+                   f"SELECT {', '.join(values)} FROM {table} t {' '.join(joins)} ORDER BY t.id")
+    cursor.execute(f"DROP TABLE {table}")
+
+
+def _add_ids(cursor: sqlite3.Cursor, column: str, ids) -> dict:
+    """Insert IDs not yet in their dimension; returns {id: key} of those added"""
+    table, key = DIMENSIONS[column]
+    added = {}
+    for value in ids:
+        if column == "route_id":
+            cursor.execute("INSERT OR IGNORE INTO routes (route_id, agency, operator) VALUES (?, ?, ?)",
+                           (value, value.split("_")[0] if "_" in value else None, operator_for(value)))
+        else:
+            cursor.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+        if cursor.rowcount:
+            added[value] = cursor.lastrowid
+    return added
+
+
+class DimensionCache:
+    """{id: key} maps of every dimension, held by the writer
+
+    Loaded once; IDs first seen in a cycle are inserted inside that cycle's
+    transaction, and only kept in memory once it commits.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.keys = {
+            column: dict(conn.execute(f"SELECT {column}, {key} FROM {table}"))
+            for column, (table, key) in DIMENSIONS.items()
+        }
+        self._pending = []
+
+    def encode(self, rows, columns: tuple) -> list:
+        """Row tuples with every ID column replaced by its key, adding new IDs first"""
+        values = list(zip(*rows))
+        if not values:
+            return []
+        for i, column in enumerate(columns):
+            if column not in DIMENSIONS:
+                continue
+            keys = self.keys[column]
+            new = set(values[i]).difference(keys)
+            new.discard(None)
+            if new:
+                added = _add_ids(self.conn.cursor(), column, sorted(new))
+                keys.update(added)
+                self._pending.extend((column, value) for value in added)
+            # None is never a key, so missing IDs stay NULL
+            values[i] = list(map(keys.get, values[i]))
+        return list(zip(*values))
+
+    def commit(self):
+        self._pending.clear()
+
+    def rollback(self):
+        """Forget keys added by a transaction that was rolled back"""
+        for column, value in self._pending:
+            self.keys[column].pop(value, None)
+        self._pending.clear()
+
+
+def is_encoded(conn: sqlite3.Connection) -> bool:
+    """Whether conn's raw rows are in fact tables (day partition files never are)"""
+    return bool(conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vehicle_positions_fact'"
+    ).fetchone())
+
+
+def categorize(frame: pd.DataFrame) -> pd.DataFrame:
+    """Convert a frame's ID columns to categoricals, with categories in sorted order"""
+    for column in DIMENSIONS:
+        if column not in frame:
+            continue
+        dtype = frame[column].dtype
+        if not isinstance(dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype("category")
+        elif not dtype.categories.is_monotonic_increasing:
+            # e.g. Parquet dictionaries, which keep first-seen order
+            frame[column] = frame[column].cat.reorder_categories(dtype.categories.sort_values())
+    return frame
+
+
+def concat(frames: list) -> pd.DataFrame:
+    """pd.concat that keeps ID columns categorical across frames with different categories"""
+    frames = list(frames)
+    for column in DIMENSIONS:
+        dtypes = [frame[column].dtype for frame in frames if column in frame]
+        if len(dtypes) != len(frames) or not all(isinstance(d, pd.CategoricalDtype) for d in dtypes):
+            continue
+        if all(d == dtypes[0] for d in dtypes[1:]):
+            continue
+        categories = sorted(set().union(*(d.categories for d in dtypes)))
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def prune_categories(frame: pd.DataFrame) -> pd.DataFrame:
+    """Drop categories no longer used by any row, e.g. after evicting old rows"""
+    for column in DIMENSIONS:
+        if column in frame and isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].cat.remove_unused_categories()
+    return frame
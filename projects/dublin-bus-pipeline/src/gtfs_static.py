@@ -0,0 +1,272 @@
+"""
+Static GTFS Schedule Index
+Turns a static GTFS zip into a compact, memory-mapped index of scheduled
+arrival/departure times keyed by (trip_id, stop_sequence), and uses it to
+derive delays for stop time updates that only carry an absolute arrival.time
+
+The index is a handful of .npy files rebuilt only when the zip changes:
+  trip_ids   sorted trip ids (fixed-width bytes)
+  keys       sorted trip_rank * STOP_SPACE + stop_sequence (int64)
+  arrival    scheduled arrival, seconds after service-day noon-minus-12h (int32, -1 if blank)
+  departure  scheduled departure, same encoding
+"""
+import json
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+from config import GTFS_STATIC_PATH, GTFS_INDEX_DIR
+from stream_parser import ColumnBuffer
+
+INDEX_VERSION = 1
+STOP_SPACE = 1 << 20
+DEFAULT_TIMEZONE = "Europe/Dublin"
+_ARRAYS = ("trip_ids", "keys", "arrival", "departure")
+
+
+def _fingerprint(zip_path: Path) -> dict:
+    stat = zip_path.stat()
+    return {"source": str(zip_path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _gtfs_seconds(values: pd.Series) -> np.ndarray:
+    """'H:MM:SS' (hours may exceed 24) to int32 seconds, -1 where blank"""
+    codes = values.cat.codes.to_numpy()
+    categories = pd.Series(values.cat.categories.astype(str))
+    if categories.empty:
+        # An all-blank column has no categories to split
+        return np.full(len(codes), -1, np.int32)
+    parts = categories.str.strip().str.split(":", expand=True).astype(np.int32)
+    seconds = (parts[0] * 3600 + parts[1] * 60 + parts[2]).to_numpy(np.int32)
+    # Code -1 (blank) picks up the trailing sentinel
+    return np.append(seconds, np.int32(-1))[codes]
+
+
+def _agency_timezone(archive: zipfile.ZipFile) -> str:
+    if "agency.txt" not in archive.namelist():
+        return DEFAULT_TIMEZONE
+    with archive.open("agency.txt") as f:
+        agency = pd.read_csv(f, usecols=["agency_timezone"], dtype=str)
+    return agency["agency_timezone"].dropna().iloc[0] if len(agency) else DEFAULT_TIMEZONE
+
+
+def build_index(zip_path: Path = GTFS_STATIC_PATH, index_dir: Path = GTFS_INDEX_DIR) -> dict:
+    """Build the index files for a static GTFS zip and return its metadata"""
+    print(f"Building schedule index from {zip_path}...")
+    with zipfile.ZipFile(zip_path) as archive:
+        timezone = _agency_timezone(archive)
+        with archive.open("stop_times.txt") as f:
+            # Ids and times repeat heavily, so categoricals keep this compact
+            stop_times = pd.read_csv(
+                f,
+                usecols=["trip_id", "stop_sequence", "arrival_time", "departure_time"],
+                dtype={"trip_id": "category", "stop_sequence": np.int64,
+                       "arrival_time": "category", "departure_time": "category"},
+            )
+
+    if stop_times["stop_sequence"].max() >= STOP_SPACE:
+        raise ValueError(f"stop_sequence above {STOP_SPACE - 1} is not supported")
+
+    names = np.char.encode(stop_times["trip_id"].cat.categories.to_numpy(str), "utf-8")
+    order = np.argsort(names, kind="stable")
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[order] = np.arange(len(names))
+
+    keys = rank[stop_times["trip_id"].cat.codes.to_numpy()] * STOP_SPACE + stop_times["stop_sequence"].to_numpy()
+    sort = np.argsort(keys, kind="stable")
+    arrays = {
+        "trip_ids": names[order],
+        "keys": keys[sort],
+        "arrival": _gtfs_seconds(stop_times["arrival_time"])[sort],
+        "departure": _gtfs_seconds(stop_times["departure_time"])[sort],
+    }
+
+    index_dir.mkdir(parents=True, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(index_dir / f"{name}.npy", values)
+    meta = {**_fingerprint(zip_path), "version": INDEX_VERSION, "timezone": timezone,
+            "trips": len(names), "stop_times": len(keys)}
+    (index_dir / "meta.json").write_text(json.dumps(meta, indent=2))
+    print(f"Indexed {len(keys):,} stop times over {len(names):,} trips")
+    return meta
+
+
+def _is_current(zip_path: Path, index_dir: Path) -> bool:
+    meta_path = index_dir / "meta.json"
+    if not meta_path.exists() or not all((index_dir / f"{name}.npy").exists() for name in _ARRAYS):
+        return False
+    meta = json.loads(meta_path.read_text())
+    return meta.get("version") == INDEX_VERSION and all(
+        meta.get(key) == value for key, value in _fingerprint(zip_path).items()
+    )
+
+
+def service_day_start(start_date, timezone: ZoneInfo) -> float:
+    """Epoch seconds of noon minus 12h on a YYYYMMDD service date (the GTFS time origin)
+
+    The 12h are elapsed seconds, not wall-clock time, so on DST change days
+    the origin is an hour off local midnight, as the GTFS spec defines it.
+    """
+    try:
+        noon = datetime.strptime(start_date, "%Y%m%d").replace(hour=12, tzinfo=timezone)
+    except (TypeError, ValueError):
+        return np.nan
+    return noon.timestamp() - 12 * 3600
+
+
+class ScheduleIndex:
+    """Memory-mapped scheduled stop times"""
+
+    def __init__(self, index_dir: Path = GTFS_INDEX_DIR):
+        self.meta = json.loads((index_dir / "meta.json").read_text())
+        self.timezone = ZoneInfo(self.meta["timezone"])
+        for name in _ARRAYS:
+            setattr(self, name, np.load(index_dir / f"{name}.npy", mmap_mode="r"))
+        self._day_starts = {}
+
+    @classmethod
+    def open(cls, zip_path: Path = GTFS_STATIC_PATH, index_dir: Path = GTFS_INDEX_DIR,
+             rebuild: bool = False):
+        """Open the index, rebuilding it if the zip changed; None if there is no schedule"""
+        zip_path, index_dir = Path(zip_path), Path(index_dir)
+        if zip_path.exists() and (rebuild or not _is_current(zip_path, index_dir)):
+            build_index(zip_path, index_dir)
+        if not (index_dir / "meta.json").exists():
+            return None
+        return cls(index_dir)
+
+    def _day_start(self, start_date) -> float:
+        if start_date not in self._day_starts:
+            self._day_starts[start_date] = service_day_start(start_date, self.timezone)
+        return self._day_starts[start_date]
+
+    def positions(self, trip_ids, stop_sequences) -> np.ndarray:
+        """Row in the index for each (trip_id, stop_sequence), -1 if not scheduled"""
+        names = np.char.encode(np.array([t or "" for t in trip_ids], dtype=str), "utf-8")
+        sequences = np.asarray(stop_sequences, dtype="float64")
+        if not len(self.trip_ids) or not len(names):
+            return np.full(len(names), -1)
+
+        rank = np.searchsorted(self.trip_ids, names)
+        known = (rank < len(self.trip_ids)) & ~np.isnan(sequences)
+        known[known] &= self.trip_ids[rank[known]] == names[known]
+
+        keys = rank * STOP_SPACE + np.nan_to_num(sequences).astype(np.int64)
+        rows = np.searchsorted(self.keys, keys)
+        known &= rows < len(self.keys)
+        known[known] &= self.keys[rows[known]] == keys[known]
+        return np.where(known, rows, -1)
+
+    def scheduled_times(self, trip_ids, start_dates, stop_sequences) -> tuple:
+        """Scheduled (arrival, departure) epoch seconds, NaN where unknown"""
+        rows = self.positions(trip_ids, stop_sequences)
+        found = rows >= 0
+        day_start = np.array([self._day_start(d) for d in start_dates], dtype="float64")
+
+        result = []
+        for offsets in (self.arrival, self.departure):
+            seconds = np.full(len(rows), -1, dtype=np.int64)
+            seconds[found] = offsets[rows[found]]
+            result.append(np.where(seconds >= 0, day_start + seconds, np.nan))
+        arrival, departure = result
+        # Non-timepoint stops may only have one of the two
+        return np.where(np.isnan(arrival), departure, arrival), np.where(np.isnan(departure), arrival, departure)
+
+    def fill_delays(self, updates) -> int:
+        """Derive missing arrival/departure delays from absolute times, in place
+
+        Works on record dicts or a TripUpdateColumns buffer. Stops with no
+        delay, no time or no scheduled time keep a missing (NULL) delay.
+        Returns the number of delays filled.
+        """
+        if not len(updates):
+            return 0
+        scheduled = dict(zip(("arrival", "departure"), self.scheduled_times(
+            _values(updates, "trip_id"), _values(updates, "start_date"), _numbers(updates, "stop_sequence")
+        )))
+
+        filled = 0
+        for kind, scheduled_at in scheduled.items():
+            delay = _numbers(updates, f"{kind}_delay")
+            derived = _numbers(updates, f"{kind}_time") - scheduled_at
+            rows = np.flatnonzero(np.isnan(delay) & ~np.isnan(derived))
+            _assign(updates, f"{kind}_delay", rows, derived[rows].astype(np.int64))
+            filled += len(rows)
+        return filled
+
+
+def _values(updates, name: str) -> list:
+    if isinstance(updates, ColumnBuffer):
+        return updates.columns[name]
+    return [record.get(name) for record in updates]
+
+
+def _numbers(updates, name: str) -> np.ndarray:
+    """An int column as float64 with NaN for missing values"""
+    if isinstance(updates, ColumnBuffer):
+        values = np.frombuffer(updates.columns[name], dtype=np.int64).astype("float64")
+        values[np.frombuffer(updates.valid[name], dtype=np.uint8) == 0] = np.nan
+        return values
+    # JSON feeds encode int64 fields such as arrival.time as strings
+    return pd.to_numeric(pd.Series(_values(updates, name), dtype=object), errors="coerce").to_numpy("float64")
+
+
+def _assign(updates, name: str, rows, values):
+    if isinstance(updates, ColumnBuffer):
+        column, valid = updates.columns[name], updates.valid[name]
+        for row, value in zip(rows.tolist(), values.tolist()):
+            column[row] = value
+            valid[row] = 1
+    else:
+        for row, value in zip(rows.tolist(), values.tolist()):
+            updates[row][name] = value
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from config import RAW_DATA_DIR
+    from stream_parser import parse_trip_updates_stream
+
+    parser = argparse.ArgumentParser(description="Static GTFS schedule index")
+    parser.add_argument("command", choices=["build", "bench", "check"])
+    parser.add_argument("--zip", type=Path, default=GTFS_STATIC_PATH, help="Static GTFS zip")
+    parser.add_argument("--index", type=Path, default=GTFS_INDEX_DIR, help="Index directory")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the zip is unchanged")
+    args = parser.parse_args()
+
+    if args.command == "check":
+        # Service day origins in Europe/Dublin around both 2026 DST changes
+        utc = ZoneInfo("UTC")
+        expected = {
+            "20260328": datetime(2026, 3, 28, 0, tzinfo=utc),
+            "20260329": datetime(2026, 3, 28, 23, tzinfo=utc),
+            "20260330": datetime(2026, 3, 29, 23, tzinfo=utc),
+            "20261025": datetime(2026, 10, 25, 0, tzinfo=utc),
+            "20261026": datetime(2026, 10, 26, 0, tzinfo=utc),
+        }
+        for start_date, origin in expected.items():
+            got = service_day_start(start_date, ZoneInfo(DEFAULT_TIMEZONE))
+            if got != origin.timestamp():
+                raise SystemExit(f"{start_date}: origin {got:.0f}, expected {origin.timestamp():.0f}")
+        print(f"Service day origins correct across DST for {len(expected)} dates")
+    elif args.command == "build":
+        start = time.perf_counter()
+        index = ScheduleIndex.open(args.zip, args.index, rebuild=args.force)
+        if index is None:
+            raise SystemExit(f"No static GTFS at {args.zip}")
+        print(f"Index ready in {time.perf_counter() - start:.1f}s: {index.meta}")
+    else:
+        # Delay derivation over each raw TripUpdates snapshot
+        index = ScheduleIndex.open(args.zip, args.index)
+        if index is None:
+            raise SystemExit(f"No static GTFS at {args.zip}")
+        for path in sorted(RAW_DATA_DIR.glob("updates_*.json")):
+            _, columns = parse_trip_updates_stream(path.read_bytes())
+            start = time.perf_counter()
+            filled = index.fill_delays(columns)
+            elapsed = time.perf_counter() - start
+            print(f"{path.name}: {len(columns):,} stop updates, {filled:,} delays derived "
+                  f"in {elapsed * 1000:.1f} ms")
@@ -0,0 +1,156 @@
+"""
+Heatmap Tile Pyramid
+Position counts binned on square lat/lon grids at several resolutions, per
+hour, updated at ingest. The dashboard reads the level matching its zoom, so
+the payload is bounded by the number of cells on screen rather than the
+number of positions stored.
+"""
+import math
+import sqlite3
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import partitions
+from rollups import BUCKETS
+
+# Cell edge in degrees per level; each level halves the one before
+LEVELS = {level: 0.08 / 2 ** level for level in range(6)}
+
+# Roughly how many screen pixels a cell should span
+_CELL_PIXELS = 8
+
+_UPSERT = """
+    INSERT INTO heatmap_bins (level, bucket_start, cell_y, cell_x, count)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (level, bucket_start, cell_y, cell_x) DO UPDATE SET
+        count = count + excluded.count
+"""
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS heatmap_bins (
+            level INTEGER NOT NULL,
+            bucket_start TEXT NOT NULL,
+            cell_y INTEGER NOT NULL,
+            cell_x INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (level, bucket_start, cell_y, cell_x)
+        ) WITHOUT ROWID
+    """)
+
+
+def level_for_zoom(zoom: float) -> int:
+    """Grid level whose cells are about _CELL_PIXELS wide at a web-map zoom"""
+    target = 360 / 2 ** zoom * _CELL_PIXELS / 256
+    return min(LEVELS, key=lambda level: abs(math.log(LEVELS[level] / target)))
+
+
+def bin_positions(latitudes, longitudes) -> list:
+    """[(level, cell_y, cell_x, count)] for a batch of points"""
+    lat = np.asarray(latitudes, dtype="float64")
+    lon = np.asarray(longitudes, dtype="float64")
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    lat, lon = lat[valid], lon[valid]
+
+    rows = []
+    for level, size in LEVELS.items():
+        cells = np.stack([np.floor(lat / size), np.floor(lon / size)], axis=1).astype(np.int64)
+        unique, counts = np.unique(cells, axis=0, return_counts=True)
+        rows.extend((level, int(y), int(x), int(n)) for (y, x), n in zip(unique, counts))
+    return rows
+
+
+def _fold(conn: sqlite3.Connection, bucket_start: str, latitudes, longitudes):
+    conn.executemany(_UPSERT, (
+        (level, bucket_start, y, x, n) for level, y, x, n in bin_positions(latitudes, longitudes)
+    ))
+
+
+def update_heatmap(conn: sqlite3.Connection, cycle):
+    """Ingest hook: add the cycle's positions to every level of the pyramid"""
+    if not len(cycle.positions):
+        return
+    frame = cycle.positions_frame
+    bucket_start = datetime.fromisoformat(cycle.collected_at).strftime(BUCKETS["hour"])
+    _fold(conn, bucket_start, frame["latitude"], frame["longitude"])
+
+
+def backfill(conn: sqlite3.Connection, chunk_size: int = 500_000):
+    """Rebuild the pyramid from vehicle_positions, in the main database and in day files
+
+    Expired days only keep downsampled positions, so their bins are kept.
+    """
+    partitions.clear_rebuildable(conn, "heatmap_bins")
+    with partitions.range_sources(conn) as sources:
+        for source in sources:
+            chunks = pd.read_sql(f"""
+                SELECT strftime('{BUCKETS["hour"]}', collected_at) AS bucket_start, latitude, longitude
+                FROM vehicle_positions
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """, source, chunksize=chunk_size)
+
+            for chunk in chunks:
+                for bucket_start, group in chunk.groupby("bucket_start"):
+                    _fold(conn, bucket_start, group["latitude"], group["longitude"])
+    conn.commit()
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    if conn.execute("SELECT 1 FROM heatmap_bins LIMIT 1").fetchone():
+        return False
+    if not conn.execute("SELECT 1 FROM vehicle_positions LIMIT 1").fetchone():
+        return False
+    print("Backfilling heatmap bins from existing data...")
+    backfill(conn)
+    return True
+
+
+def _bins_query(level: int, bbox: tuple, start, end) -> tuple:
+    size = LEVELS[level]
+    conditions, params = ["level = ?"], [level]
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        conditions += ["cell_y BETWEEN ? AND ?", "cell_x BETWEEN ? AND ?"]
+        params += [math.floor(min_lat / size), math.floor(max_lat / size),
+                   math.floor(min_lon / size), math.floor(max_lon / size)]
+    if start is not None:
+        conditions.append("bucket_start >= ?")
+        params.append(pd.Timestamp(start).strftime(BUCKETS["hour"]))
+    if end is not None:
+        conditions.append("bucket_start <= ?")
+        params.append(pd.Timestamp(end).strftime(BUCKETS["hour"]))
+    return " AND ".join(conditions), params
+
+
+def heatmap_bins(conn: sqlite3.Connection, zoom: float, bbox: tuple = None, start=None, end=None,
+                 max_bins: int = 5000) -> pd.DataFrame:
+    """Binned position counts for a viewport, as cell-center latitude/longitude/count
+
+    Time filters are applied at hour granularity. If the level matching
+    `zoom` would return more than max_bins cells, coarser levels are used.
+    """
+    level = level_for_zoom(zoom)
+    while True:
+        where, params = _bins_query(level, bbox, start, end)
+        cells = conn.execute(
+            f"SELECT COUNT(*) FROM (SELECT 1 FROM heatmap_bins WHERE {where} GROUP BY cell_y, cell_x)",
+            params
+        ).fetchone()[0]
+        if cells <= max_bins or level == min(LEVELS):
+            break
+        level -= 1
+
+    size = LEVELS[level]
+    bins = pd.read_sql(f"""
+        SELECT cell_y, cell_x, SUM(count) AS count
+        FROM heatmap_bins
+        WHERE {where}
+        GROUP BY cell_y, cell_x
+    """, conn, params=params)
+    return pd.DataFrame({
+        "latitude": (bins["cell_y"] + 0.5) * size,
+        "longitude": (bins["cell_x"] + 0.5) * size,
+        "count": bins["count"],
+        "level": level,
+    })
@@ -0,0 +1,563 @@
+"""
+Columnar History Tier
+Every committed cycle is also written as Parquet, one file per table per
+cycle, under <HISTORY_DIR>/<table>/service_date=YYYY-MM-DD/hour=HH/. Once an
+hour is over, compaction merges its per-cycle files into one file sorted
+for pushdown, in row groups small enough for their statistics to skip most
+of a file. Scans read only the requested columns, only open the partitions
+overlapping the requested time range, and push the remaining predicates
+down to row groups, through pyarrow or DuckDB.
+
+Unlike the SQLite raw tables, nothing here is downsampled or expired, and
+trip updates are kept in full in CDC mode too: cycles copied over from
+SQLite get theirs rebuilt from the change log.
+"""
+import os
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+import pandas as pd
+from config import HISTORY_DIR, HISTORY_ENGINE
+from dimensions import DIMENSIONS, VIEW_COLUMNS, categorize
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, only needed with HISTORY_DIR set
+    pa = None
+
+try:
+    import duckdb
+except ImportError:  # optional dependency, only needed for HISTORY_ENGINE=duckdb
+    duckdb = None
+
+TABLES = tuple(VIEW_COLUMNS)
+
+# GTFS service days run past midnight: a cycle collected before this hour
+# belongs to the previous day's service
+SERVICE_DAY_ROLLOVER_HOUR = 3
+
+# Compacted files are sorted so equality filters on the leading column skip
+# whole row groups, and time filters within an hour skip the rest
+SORT_KEYS = {
+    "vehicle_positions": ["vehicle_id", "collected_at"],
+    "trip_updates": ["route_id", "collected_at"],
+}
+ROW_GROUP_ROWS = 64 * 1024
+
+# Holds the id of the newest cycle written, so cached results computed from
+# the history tier are invalidated once it catches up with SQLite
+WATERMARK_FILE = "LAST_CYCLE"
+
+_FLOAT_COLUMNS = {"latitude", "longitude"}
+# Kept as text, exactly as in SQLite, so range filters compare the same way
+_TEXT_COLUMNS = {"collected_at", "start_time", "start_date"}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The history tier needs pyarrow: pip install pyarrow")
+
+
+def schema(table: str):
+    """Arrow schema of a history table: the raw view's columns, with the
+    ingest cycle instead of the row id and IDs dictionary-encoded"""
+    _require_pyarrow()
+    fields = [("cycle_id", pa.int64())]
+    for column in VIEW_COLUMNS[table][1:]:
+        if column in DIMENSIONS:
+            fields.append((column, pa.dictionary(pa.int32(), pa.string())))
+        elif column in _TEXT_COLUMNS:
+            fields.append((column, pa.string()))
+        elif column in _FLOAT_COLUMNS:
+            fields.append((column, pa.float64()))
+        else:
+            fields.append((column, pa.int64()))
+    return pa.schema(fields)
+
+
+# Partitions
+
+def service_partition(collected_at) -> tuple:
+    """(service date, hour of day) a collection timestamp is filed under"""
+    ts = pd.Timestamp(collected_at)
+    return (ts - timedelta(hours=SERVICE_DAY_ROLLOVER_HOUR)).date(), ts.hour
+
+
+def _slot_start(service_date: date, hour: int) -> datetime:
+    """Wall-clock start of a partition's hour"""
+    day = service_date if hour >= SERVICE_DAY_ROLLOVER_HOUR else service_date + timedelta(days=1)
+    return datetime.combine(day, time(hour))
+
+
+def _partition_path(root: Path, table: str, service_date: date, hour: int) -> Path:
+    return root / table / f"service_date={service_date.isoformat()}" / f"hour={hour:02d}"
+
+
+def _partitions(root: Path, table: str, start=None, end=None):
+    """(service date, hour, path) of every partition overlapping [start, end]"""
+    start = None if start is None else pd.Timestamp(start).to_pydatetime()
+    end = None if end is None else pd.Timestamp(end).to_pydatetime()
+    first = None if start is None else service_partition(start)[0]
+    last = None if end is None else service_partition(end)[0]
+    for day_dir in sorted((root / table).glob("service_date=*")):
+        service_date = date.fromisoformat(day_dir.name.split("=", 1)[1])
+        if (first is not None and service_date < first) or (last is not None and service_date > last):
+            continue
+        for hour_dir in sorted(day_dir.glob("hour=*")):
+            hour = int(hour_dir.name.split("=", 1)[1])
+            slot = _slot_start(service_date, hour)
+            if (start is None or slot + timedelta(hours=1) > start) and (end is None or slot <= end):
+                yield service_date, hour, hour_dir
+
+
+def _cycle_range(path: Path) -> tuple:
+    # part-<cycle>.parquet or compact-<first>-<last>.parquet
+    numbers = [int(n) for n in path.stem.split("-")[1:]]
+    return numbers[0], numbers[-1]
+
+
+def _live_files(partition: Path) -> list:
+    """Files holding a partition's rows, skipping any whose cycles a compacted
+    file already covers (compaction deletes them right after)"""
+    files = sorted(partition.glob("*.parquet"), key=lambda path: -_span(path))
+    covered, live = [], []
+    for path in files:
+        first, last = _cycle_range(path)
+        if any(low <= first and last <= high for low, high in covered):
+            continue
+        live.append(path)
+        if path.name.startswith("compact-"):
+            covered.append((first, last))
+    return sorted(live)
+
+
+def _span(path: Path) -> int:
+    first, last = _cycle_range(path)
+    return last - first
+
+
+def _mark_written(root: Path, cycle_id: int):
+    """Record the newest cycle written, which readers use as their watermark"""
+    path = root / WATERMARK_FILE
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(str(cycle_id))
+    os.replace(tmp, path)
+
+
+def _write(table, path: Path):
+    """Write atomically, so readers never open a half-written file"""
+    tmp = path.with_name(f".{path.name}.tmp")
+    pq.write_table(table, tmp, compression="zstd", row_group_size=ROW_GROUP_ROWS)
+    os.replace(tmp, path)
+
+
+def _arrow(frame: pd.DataFrame, table: str):
+    return pa.Table.from_pandas(frame, schema=schema(table), preserve_index=False)
+
+
+def _write_compacted(partition: Path, table: str, data, first: int, last: int) -> Path:
+    """Replace every file of a partition within cycles [first, last] by one sorted file"""
+    # Arrow cannot sort dictionary columns directly; order by their values
+    keys = pa.table({key: data[key].cast(pa.string()) for key in SORT_KEYS[table]})
+    order = pc.sort_indices(keys, sort_keys=[(key, "ascending") for key in SORT_KEYS[table]])
+    data = data.take(order).unify_dictionaries()
+    path = partition / f"compact-{first:010d}-{last:010d}.parquet"
+    _write(data, path)
+    for old in partition.glob("*.parquet"):
+        low, high = _cycle_range(old)
+        if old != path and first <= low and high <= last:
+            old.unlink(missing_ok=True)
+    return path
+
+
+# Writing
+
+class HistoryWriter:
+    """Appends committed cycles to the history tier
+
+    append_cycle is a BulkWriter after-commit hook; it only sees cycles
+    that are already in SQLite, so a failed cycle never reaches Parquet.
+    A cycle that SQLite committed but Parquet did not (a full disk, a
+    crash between the two) leaves a gap; the next append fills it from the
+    database behind `conn` before writing its own cycle, so the watermark
+    only moves once every cycle up to it is written. If a cycle in the gap
+    can't be rebuilt, the watermark stays just before it: later cycles are
+    still written, but only a fresh export moves it on.
+    """
+
+    def __init__(self, root, conn):
+        _require_pyarrow()
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.conn = conn
+        # None until the tier has a watermark; 0 is a real one (nothing
+        # written yet, e.g. an export that stalled on the first cycle)
+        self.written = _last_cycle(self.root) if (self.root / WATERMARK_FILE).exists() else None
+        self.stalled_at = None
+        self.compacted_before = None
+
+    def append_cycle(self, cycle):
+        # A new history tier starts at the first cycle it sees; export
+        # covers what SQLite held before that
+        if self.stalled_at is None and self.written is not None and cycle.cycle_id > self.written + 1:
+            filled, unfilled = export_cycles(self.conn, self.root, self.written + 1, cycle.cycle_id - 1)
+            print(f"History tier gap filled from SQLite: cycles {self.written + 1}-{cycle.cycle_id - 1}, "
+                  + ", ".join(f"{count:,} {table}" for table, count in filled.items()))
+            if unfilled is not None:
+                self.stalled_at = unfilled
+                self.written = unfilled - 1
+                _mark_written(self.root, self.written)
+                print(f"History tier error: the trip updates of cycle {unfilled} can't be rebuilt from SQLite; "
+                      f"its watermark stays at cycle {self.written} until the tier is re-exported")
+
+        service_date, hour = service_partition(cycle.collected_at)
+        for table, frame in (("vehicle_positions", cycle.positions_frame),
+                             ("trip_updates", cycle.updates_frame)):
+            if not len(frame):
+                continue
+            frame = frame.assign(cycle_id=cycle.cycle_id, collected_at=cycle.collected_at)
+            partition = _partition_path(self.root, table, service_date, hour)
+            partition.mkdir(parents=True, exist_ok=True)
+            _write(_arrow(frame, table), partition / f"part-{cycle.cycle_id:010d}.parquet")
+        if self.stalled_at is None:
+            _mark_written(self.root, cycle.cycle_id)
+            self.written = cycle.cycle_id
+
+    def compaction_due(self, now: datetime = None) -> bool:
+        """Whether an hour has finished since the last compaction"""
+        return self.compacted_before != _hour_start(now)
+
+    def compact_finished_hours(self, now: datetime = None) -> int:
+        """Compact every partition whose hour is over"""
+        hour = _hour_start(now)
+        compacted = compact(self.root, before=hour)
+        self.compacted_before = hour
+        return compacted
+
+
+def _hour_start(now: datetime = None) -> datetime:
+    return (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+
+
+def compact(root=HISTORY_DIR, before: datetime = None) -> int:
+    """Merge the files of every partition that ends by `before` (default: the
+    start of the current hour) into one; returns the partitions compacted"""
+    _require_pyarrow()
+    root = Path(root)
+    before = before or _hour_start()
+    compacted = 0
+    for table in TABLES:
+        for service_date, hour, partition in _partitions(root, table, end=before - timedelta(hours=1)):
+            files = _live_files(partition)
+            if len(files) < 2 and all(path.name.startswith("compact-") for path in files):
+                continue
+            data = ds.dataset([str(path) for path in files], schema=schema(table), format="parquet").to_table()
+            ranges = [_cycle_range(path) for path in files]
+            _write_compacted(partition, table, data, min(r[0] for r in ranges), max(r[1] for r in ranges))
+            compacted += 1
+    return compacted
+
+
+def export(conn, root=HISTORY_DIR, start=None, end=None) -> dict:
+    """Write the raw rows already in SQLite (including day partition files)
+    into the history tier, one compacted file per partition
+
+    Partitions already in the history tier are rewritten for the cycles
+    exported, so running this again is harmless. Trip updates of CDC
+    cycles are rebuilt from the change log; if a cycle's can't be, the
+    watermark is left just before it.
+    """
+    from partitions import read_range
+
+    _require_pyarrow()
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    cycles = pd.read_sql("SELECT id, collected_at, update_count FROM ingest_cycles", conn)
+    cycle_ids = dict(zip(cycles["collected_at"], cycles["id"]))
+    days = sorted({value[:10] for value in cycles["collected_at"]})
+    if start is not None:
+        days = [day for day in days if day >= pd.Timestamp(start).date().isoformat()]
+    if end is not None:
+        days = [day for day in days if day <= pd.Timestamp(end).date().isoformat()]
+
+    exported = {table: 0 for table in TABLES}
+    unfilled = []
+    for day in days:
+        low, high = day, (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+        for table in TABLES:
+            columns = ", ".join(VIEW_COLUMNS[table][1:])
+            frame = read_range(conn, f"SELECT {columns} FROM {table} WHERE collected_at >= ? AND collected_at < ?",
+                               (low, high), low, high)
+            frame["cycle_id"] = frame["collected_at"].map(cycle_ids).fillna(0).astype("int64")
+            if table == "trip_updates":
+                day_cycles = cycles[(cycles["collected_at"] >= low) & (cycles["collected_at"] < high)]
+                frame, missing = _rebuild_updates(conn, day_cycles, frame)
+                unfilled += missing
+            exported[table] += _write_rows(root, table, frame)
+        print(f"Exported through {day}: " + ", ".join(f"{count:,} {table}" for table, count in exported.items()))
+    if len(cycles):
+        last = max(int(cycles["id"].max()), _last_cycle(root))
+        if unfilled:
+            last = min(unfilled) - 1
+            print(f"History tier error: the trip updates of cycles {', '.join(map(str, sorted(unfilled)))} "
+                  f"can't be rebuilt from SQLite; the watermark stays at cycle {last}")
+        _mark_written(root, last)
+    return exported
+
+
+def export_cycles(conn, root, first: int, last: int) -> tuple:
+    """Write cycles [first, last] from SQLite into the history tier, one
+    compacted file per partition; used to fill a gap left by failed appends
+
+    Returns the rows written per table, and the first cycle whose trip
+    updates could not be rebuilt (None if all were); nothing from that
+    cycle on is written.
+    """
+    from partitions import read_range
+
+    cycles = pd.read_sql("SELECT id, collected_at, update_count FROM ingest_cycles WHERE id BETWEEN ? AND ?",
+                         conn, params=(first, last))
+    exported = {table: 0 for table in TABLES}
+    if not len(cycles):
+        return exported, None
+    cycle_ids = dict(zip(cycles["collected_at"], cycles["id"]))
+    low, high = cycles["collected_at"].min(), cycles["collected_at"].max()
+    frames = {}
+    for table in TABLES:
+        columns = ", ".join(VIEW_COLUMNS[table][1:])
+        frame = read_range(conn, f"SELECT {columns} FROM {table} WHERE collected_at >= ? AND collected_at <= ?",
+                           (low, high), low, high)
+        frame = frame[frame["collected_at"].isin(cycle_ids)]
+        frames[table] = frame.assign(cycle_id=frame["collected_at"].map(cycle_ids))
+    frames["trip_updates"], missing = _rebuild_updates(conn, cycles, frames["trip_updates"])
+
+    unfilled = min(missing) if missing else None
+    for table, frame in frames.items():
+        if unfilled is not None:
+            frame = frame[frame["cycle_id"] < unfilled]
+        exported[table] = _write_rows(root, table, frame)
+    return exported, unfilled
+
+
+def _rebuild_updates(conn, cycles: pd.DataFrame, frame: pd.DataFrame) -> tuple:
+    """Add the trip updates of cycles that have none in `frame` (CDC cycles
+    only log changes) as rebuilt from the change log
+
+    Cycles on expired days are skipped: their raw rows are gone on purpose.
+    Returns the completed frame and the ids of cycles that had trip updates
+    but nothing to rebuild them from.
+    """
+    from change_capture import states_as_of
+    from partitions import expired_days
+
+    expired = {day.isoformat() for day in expired_days(conn)}
+    missing = cycles[(cycles["update_count"] > 0) & ~cycles["collected_at"].isin(frame["collected_at"])
+                     & ~cycles["collected_at"].str[:10].isin(expired)]
+    if not len(missing):
+        return frame, []
+    missing = missing.sort_values("collected_at")
+    # Only cycles the change log reaches back to can be rebuilt from it
+    first_change = conn.execute("SELECT MIN(collected_at) FROM trip_update_changes").fetchone()[0]
+    if first_change is None:
+        return frame, [int(cycle_id) for cycle_id in missing["id"]]
+    logged = missing["collected_at"] >= first_change
+    unfilled = [int(cycle_id) for cycle_id in missing.loc[~logged, "id"]]
+    missing = missing[logged]
+    rebuilt = [frame]
+    states = states_as_of(conn, missing["collected_at"])
+    for cycle_id, (collected_at, state) in zip(missing["id"], states):
+        if not len(state):
+            unfilled.append(int(cycle_id))
+            continue
+        rebuilt.append(state.assign(collected_at=collected_at, cycle_id=int(cycle_id))
+                       .reindex(columns=frame.columns))
+    rebuilt = [part for part in rebuilt if len(part)] or [frame]
+    return pd.concat(rebuilt, ignore_index=True), unfilled
+
+
+def _write_rows(root: Path, table: str, frame: pd.DataFrame) -> int:
+    """Write raw rows carrying a cycle_id as one compacted file per partition they fall in"""
+    if not len(frame):
+        return 0
+    collected = pd.to_datetime(frame["collected_at"], format="ISO8601")
+    partitions = frame.assign(
+        _service_date=(collected - pd.Timedelta(hours=SERVICE_DAY_ROLLOVER_HOUR)).dt.date,
+        _hour=collected.dt.hour,
+    )
+    for (service_date, hour), rows in partitions.groupby(["_service_date", "_hour"]):
+        partition = _partition_path(root, table, service_date, hour)
+        partition.mkdir(parents=True, exist_ok=True)
+        rows = rows.drop(columns=["_service_date", "_hour"])
+        _write_compacted(partition, table, _arrow(rows, table),
+                         int(rows["cycle_id"].min()), int(rows["cycle_id"].max()))
+    return len(frame)
+
+
+def _last_cycle(root: Path) -> int:
+    try:
+        return int((root / WATERMARK_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+# Reading
+
+class ParquetHistory:
+    """Scans the history tier with pyarrow
+
+    Columns not asked for are never read, partitions outside [start, end]
+    are never opened, and the remaining filters are checked against row
+    group statistics before any data is decoded.
+    """
+
+    def __init__(self, root=HISTORY_DIR):
+        _require_pyarrow()
+        self.root = Path(root)
+
+    def watermark(self) -> int:
+        """Id of the newest cycle written to the history tier"""
+        return _last_cycle(self.root)
+
+    def files(self, table: str, start=None, end=None) -> list:
+        return [path for _, _, partition in _partitions(self.root, table, start, end)
+                for path in _live_files(partition)]
+
+    def _filter(self, start=None, end=None, equals: dict = None, not_null=()):
+        conditions = []
+        if start is not None:
+            conditions.append(pc.field("collected_at") >= str(start))
+        if end is not None:
+            conditions.append(pc.field("collected_at") <= str(end))
+        for column, value in (equals or {}).items():
+            conditions.append(pc.field(column) == value)
+        for column in not_null:
+            conditions.append(pc.field(column).is_valid())
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def _table(self, table: str, columns: list, start=None, end=None, equals: dict = None, not_null=()):
+        for attempt in range(2):
+            files = self.files(table, start, end)
+            try:
+                dataset = ds.dataset([str(path) for path in files], schema=schema(table), format="parquet")
+                return dataset.to_table(columns=columns, filter=self._filter(start, end, equals, not_null))
+            except FileNotFoundError:
+                # Compaction replaced a partition's files after they were listed
+                if attempt:
+                    raise
+
+    def scan(self, table: str, columns: list, start=None, end=None, equals: dict = None,
+             not_null=()) -> pd.DataFrame:
+        """Rows of `table` collected in [start, end] matching `equals` (column -> value)
+        with no nulls in `not_null`, as a frame of `columns` with categorical IDs"""
+        return categorize(self._table(table, columns, start, end, equals, not_null).to_pandas())
+
+    def activity_by_time(self, start=None, end=None) -> pd.DataFrame:
+        """Vehicles and routes reporting in each cycle"""
+        positions = self._table("vehicle_positions", ["collected_at", "vehicle_id", "route_id"], start, end)
+        activity = positions.unify_dictionaries().group_by("collected_at").aggregate(
+            [("vehicle_id", "count_distinct"), ("route_id", "count_distinct")]
+        )
+        activity = activity.to_pandas().rename(columns={
+            "vehicle_id_count_distinct": "active_vehicles",
+            "route_id_count_distinct": "active_routes",
+        })
+        return activity[["collected_at", "active_vehicles", "active_routes"]].sort_values(
+            "collected_at", ignore_index=True)
+
+
+class DuckDBHistory(ParquetHistory):
+    """The same scans run by DuckDB over the same files"""
+
+    def __init__(self, root=HISTORY_DIR):
+        super().__init__(root)
+        if duckdb is None:
+            raise ImportError("HISTORY_ENGINE=duckdb needs duckdb: pip install duckdb")
+        self.db = duckdb.connect()
+
+    def _query(self, sql: str, table: str, start=None, end=None, equals: dict = None,
+               not_null=(), suffix: str = "") -> pd.DataFrame:
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("collected_at >= ?")
+            params.append(str(start))
+        if end is not None:
+            conditions.append("collected_at <= ?")
+            params.append(str(end))
+        for column, value in (equals or {}).items():
+            conditions.append(f"{column} = ?")
+            params.append(value)
+        conditions += [f"{column} IS NOT NULL" for column in not_null]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        for attempt in range(2):
+            files = [str(path) for path in self.files(table, start, end)]
+            if not files:
+                return None
+            try:
+                # A cursor is a separate connection, so threads can query at once
+                return self.db.cursor().execute(
+                    f"{sql} FROM read_parquet(?) {where} {suffix}", [files, *params]
+                ).df()
+            except duckdb.IOException:
+                if attempt:
+                    raise
+
+    def scan(self, table: str, columns: list, start=None, end=None, equals: dict = None,
+             not_null=()) -> pd.DataFrame:
+        frame = self._query(f"SELECT {', '.join(columns)}", table, start, end, equals, not_null)
+        if frame is None:
+            return super().scan(table, columns, start, end, equals, not_null)
+        return categorize(frame)
+
+    def activity_by_time(self, start=None, end=None) -> pd.DataFrame:
+        activity = self._query("""
+            SELECT collected_at,
+                   COUNT(DISTINCT vehicle_id) AS active_vehicles,
+                   COUNT(DISTINCT route_id) AS active_routes
+        """, "vehicle_positions", start, end, suffix="GROUP BY collected_at ORDER BY collected_at")
+        return activity if activity is not None else super().activity_by_time(start, end)
+
+
+ENGINES = {"arrow": ParquetHistory, "duckdb": DuckDBHistory}
+
+
+def open_history(root=HISTORY_DIR, engine: str = HISTORY_ENGINE) -> ParquetHistory:
+    """A reader for the history tier, or None when HISTORY_DIR is not set"""
+    if root is None:
+        return None
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown history engine: {engine}")
+    return ENGINES[engine](root)
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import DATABASE_PATH
+    from db import connect, WRITER_PRAGMAS
+
+    parser = argparse.ArgumentParser(description="Columnar Parquet history tier")
+    parser.add_argument("command", choices=["export", "compact", "list"])
+    parser.add_argument("--history-dir", type=Path, default=HISTORY_DIR)
+    parser.add_argument("--start", help="First day to export (default: all)")
+    parser.add_argument("--end", help="Last day to export")
+    args = parser.parse_args()
+    if args.history_dir is None:
+        parser.error("Set HISTORY_DIR or pass --history-dir")
+
+    if args.command == "export":
+        conn = connect(DATABASE_PATH, WRITER_PRAGMAS)
+        export(conn, args.history_dir, args.start, args.end)
+        conn.close()
+    elif args.command == "compact":
+        print(f"Compacted {compact(args.history_dir)} partitions")
+    else:
+        for table in TABLES:
+            partitions = list(_partitions(args.history_dir, table))
+            files = [path for _, _, partition in partitions for path in _live_files(partition)]
+            size = sum(path.stat().st_size for path in files)
+            print(f"{table}: {len(partitions)} partitions, {len(files)} files, {size / 1e6:,.1f} MB")
@@ -0,0 +1,193 @@
+"""
+Incremental Dashboard Loader
+Keeps recent vehicle positions and trip updates in memory and only pulls
+rows past an id watermark on each refresh, so refresh cost tracks new data
+rather than total history. ID columns are held as categoricals.
+"""
+import sqlite3
+import threading
+from datetime import timedelta
+import pandas as pd
+from config import DATABASE_PATH, DASHBOARD_WINDOW_HOURS
+from db import ReadPool, read_pool
+from partitions import archived_days, range_sources, read_range
+from dimensions import categorize, concat, prune_categories
+
+TABLES = {
+    "positions": "vehicle_positions",
+    "updates": "trip_updates",
+}
+
+
+def _prepare(name: str, frame: pd.DataFrame) -> pd.DataFrame:
+    """Parse timestamps, categorize IDs and add derived columns once, as rows arrive"""
+    frame["collected_at"] = pd.to_datetime(frame["collected_at"], format="ISO8601")
+    categorize(frame)
+    if name == "updates":
+        frame["arrival_delay_mins"] = frame["arrival_delay"] / 60
+    return frame
+
+
+class IncrementalLoader:
+    """Process-wide in-memory cache of the last `window_hours` of data
+
+    The window is measured back from the newest row collected, so a database
+    that is no longer being written still shows its last window. Frames
+    returned by frames() are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, db_path=DATABASE_PATH, window_hours: float = DASHBOARD_WINDOW_HOURS,
+                 pool: ReadPool = None):
+        self.db_path = db_path
+        self.pool = pool if pool is not None else read_pool(db_path)
+        self.window = timedelta(hours=window_hours) if window_hours else None
+        self._lock = threading.Lock()
+        self._frames = {name: None for name in TABLES}
+        self._watermarks = {name: 0 for name in TABLES}
+        # Every row collected at or after this is held in memory; None means
+        # nothing has been skipped or evicted
+        self.covered_from = None
+        self.latest = None
+        self.stats = {"refreshes": 0, "rows_loaded": 0, "rows_evicted": 0, "pushdown_queries": 0}
+
+    def _initial_cutoff(self, conn: sqlite3.Connection):
+        """Start of the window on first load, or None if it covers all history
+
+        Rows already moved into day files are never loaded into memory, so
+        the window starts no earlier than the end of the newest archived day.
+        """
+        archived = archived_days(conn)
+        boundary = pd.Timestamp(archived[-1] + timedelta(days=1)) if archived else None
+        if self.window is None:
+            return boundary
+        newest = max(conn.execute(f"SELECT MAX(collected_at) FROM {table}").fetchone()[0] or ""
+                     for table in TABLES.values())
+        if not newest:
+            return boundary
+        cutoff = pd.Timestamp(newest) - self.window
+        if boundary is not None:
+            return max(cutoff, boundary)
+        older = any(
+            conn.execute(f"SELECT 1 FROM {table} WHERE collected_at < ? LIMIT 1", (str(cutoff),)).fetchone()
+            for table in TABLES.values()
+        )
+        return cutoff if older else None
+
+    @staticmethod
+    def _archived_latest(conn: sqlite3.Connection):
+        """Newest collected_at in the newest day file, for when the main tables are empty"""
+        archived = archived_days(conn)
+        if not archived:
+            return None
+        with range_sources(conn, archived[-1], archived[-1]) as sources:
+            newest = max((source.execute(f"SELECT MAX(collected_at) FROM {table}").fetchone()[0] or ""
+                          for source in sources for table in TABLES.values()), default="")
+        return pd.Timestamp(newest) if newest else None
+
+    def refresh(self) -> dict:
+        """Load rows added since the last refresh and evict rows outside the window"""
+        with self._lock, self.pool.connection() as conn:
+            first_load = self._frames["positions"] is None
+            cutoff = self._initial_cutoff(conn) if first_load else None
+
+            batches = {}
+            for name, table in TABLES.items():
+                query = f"SELECT * FROM {table} WHERE id > ?"
+                params = [self._watermarks[name]]
+                if first_load and cutoff is not None:
+                    query += " AND collected_at >= ?"
+                    params.append(str(cutoff))
+                batches[name] = _prepare(name, pd.read_sql(query + " ORDER BY id", conn, params=params))
+
+            # Only touch state once every table has been read
+            for name, new in batches.items():
+                if first_load:
+                    self._frames[name] = new
+                elif len(new):
+                    self._frames[name] = concat([self._frames[name], new])
+                if len(new):
+                    self._watermarks[name] = int(new["id"].iloc[-1])
+            if first_load:
+                self.covered_from = cutoff
+            loaded = {name: len(new) for name, new in batches.items()}
+
+            self._evict()
+            if self.latest is None:
+                self.latest = self._archived_latest(conn)
+            self.stats["refreshes"] += 1
+            self.stats["rows_loaded"] += sum(loaded.values())
+            return loaded
+
+    def _evict(self):
+        newest = [frame["collected_at"].max() for frame in self._frames.values() if len(frame)]
+        if not newest:
+            return
+        self.latest = max(newest)
+        if self.window is None:
+            return
+
+        cutoff = self.latest - self.window
+        for name, frame in self._frames.items():
+            if len(frame) and frame["collected_at"].iloc[0] < cutoff:
+                keep = frame["collected_at"] >= cutoff
+                self.stats["rows_evicted"] += int((~keep).sum())
+                self._frames[name] = prune_categories(frame[keep].reset_index(drop=True))
+                self.covered_from = cutoff
+
+    def _query_range(self, start, end) -> tuple:
+        """Read a time range straight from SQLite (and any day partitions it spans),
+        filtered in the WHERE clause"""
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("collected_at >= ?")
+            params.append(str(pd.Timestamp(start)))
+        if end is not None:
+            conditions.append("collected_at <= ?")
+            params.append(str(pd.Timestamp(end)))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        self.stats["pushdown_queries"] += 1
+        with self.pool.connection() as conn:
+            return tuple(
+                _prepare(name, read_range(conn, f"SELECT * FROM {table} {where}", params, start, end))
+                for name, table in TABLES.items()
+            )
+
+    def frames(self, start=None, end=None) -> tuple:
+        """(positions, updates) collected between start and end (inclusive)
+
+        Ranges inside the in-memory window are sliced from memory; anything
+        reaching further back is pushed down to SQLite.
+        """
+        with self._lock:
+            positions, updates = self._frames["positions"], self._frames["updates"]
+            covered = self.covered_from
+
+        if positions is None:
+            raise RuntimeError("refresh() has not been called")
+        if covered is not None and (start is None or pd.Timestamp(start) < covered):
+            return self._query_range(start, end)
+        if start is None and end is None:
+            return positions, updates
+
+        def select(frame):
+            mask = pd.Series(True, index=frame.index)
+            if start is not None:
+                mask &= frame["collected_at"] >= pd.Timestamp(start)
+            if end is not None:
+                mask &= frame["collected_at"] <= pd.Timestamp(end)
+            return frame[mask]
+
+        return select(positions), select(updates)
+
+
+if __name__ == "__main__":
+    import time
+
+    loader = IncrementalLoader()
+    for attempt in ("initial", "incremental"):
+        start = time.perf_counter()
+        loaded = loader.refresh()
+        print(f"{attempt} refresh: {loaded} in {time.perf_counter() - start:.3f}s")
+    print(f"Window starts at {loader.covered_from}, newest row {loader.latest}")
+    print(loader.stats)
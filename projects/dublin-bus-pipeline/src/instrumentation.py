@@ -0,0 +1,298 @@
+"""
+Pipeline Instrumentation
+Counters, gauges and latency histograms for each ingest stage (fetch,
+decode, parse, write, raw snapshot save), exported in the Prometheus text
+format over a local HTTP endpoint and/or as a size-rotated JSON-lines log
+of per-cycle stage timings, with optional cProfile / tracemalloc capture
+of individual cycles
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+# Seconds; spans a cached no-op parse up to a timed-out fetch
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """One metric family: a value per label set"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, lock: threading.Lock):
+        self.name = name
+        self.help = help_text
+        self._lock = lock
+        self.values = {}
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels))
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(key)} {value:g}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram, as Prometheus expects"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, lock: threading.Lock, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, lock)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def get(self, **labels) -> tuple:
+        """(sum, count) for a label set"""
+        _, total, count = self.values.get(_label_key(labels), (None, 0.0, 0))
+        return total, count
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for bound, n in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_format_labels(key, (('le', f'{bound:g}'),))} {n}"
+            yield f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}"
+            yield f"{self.name}_sum{_format_labels(key)} {total:g}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+
+class Timer:
+    """Elapsed seconds of a timed block, readable once it exits"""
+    elapsed = 0.0
+
+
+class Registry:
+    """Named metric families, shared by every stage of the pipeline"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+    def _metric(self, cls, name: str, help_text: str, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics.setdefault(name, cls(name, help_text, self._lock, **kwargs))
+        if not isinstance(metric, cls):
+            raise ValueError(f"{name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self._metric(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str = "") -> Gauge:
+        return self._metric(Gauge, name, help_text)
+
+    def histogram(self, name: str, help_text: str = "", buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._metric(Histogram, name, help_text, buckets=buckets)
+
+    @contextmanager
+    def timed(self, stage: str, **labels):
+        """Time a block into pipeline_stage_seconds, counting it as an error if it raises"""
+        timer = Timer()
+        start = time.perf_counter()
+        try:
+            yield timer
+        except Exception:
+            self.counter("pipeline_stage_errors_total", "Stage runs that raised").inc(stage=stage, **labels)
+            raise
+        finally:
+            timer.elapsed = time.perf_counter() - start
+            self.histogram("pipeline_stage_seconds", "Wall time per stage run").observe(
+                timer.elapsed, stage=stage, **labels
+            )
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self.metrics.items()):
+                if metric.help:
+                    lines.append(f"# HELP {name} {metric.help}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# The pipeline's process-wide registry
+METRICS = Registry()
+
+
+def record_db_size(db_path, registry: Registry = METRICS):
+    """Gauge the database file and its WAL"""
+    gauge = registry.gauge("sqlite_file_bytes", "Size of the SQLite database files")
+    for kind, suffix in (("db", ""), ("wal", "-wal")):
+        path = Path(f"{db_path}{suffix}")
+        gauge.set(path.stat().st_size if path.exists() else 0, file=kind)
+
+
+class MetricsServer:
+    """Serves GET /metrics from a background thread"""
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: Registry = METRICS):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        print(f"Serving metrics at http://{host}:{self.port}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsLog:
+    """Appends one JSON line per cycle, rotating the file by size"""
+
+    def __init__(self, path, max_bytes: int = 10_000_000, backups: int = 5):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.logger = logging.getLogger(f"pipeline.metrics.{path}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def write(self, record: dict):
+        self.logger.info(json.dumps(record, default=str))
+
+    def close(self):
+        for handler in list(self.logger.handlers):
+            handler.close()
+            self.logger.removeHandler(handler)
+
+
+class CycleProfiler:
+    """Profiles every Nth cycle with cProfile or tracemalloc
+
+    cProfile dumps `cycle_<n>.prof` (open with pstats or snakeviz) and prints
+    the top functions by cumulative time; tracemalloc prints the lines that
+    allocated the most and gauges the cycle's peak traced memory.
+    """
+
+    MODES = ("cprofile", "tracemalloc")
+
+    def __init__(self, mode: str, every: int = 1, out_dir=None, top: int = 15,
+                 registry: Registry = METRICS):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profiler: {mode}")
+        self.mode = mode
+        self.every = max(1, every)
+        self.out_dir = Path(out_dir) if out_dir else None
+        self.top = top
+        self.registry = registry
+
+    @contextmanager
+    def profile(self, cycle_number: int):
+        if cycle_number % self.every:
+            yield
+            return
+        if self.mode == "cprofile":
+            with self._cprofile(cycle_number):
+                yield
+        else:
+            with self._tracemalloc():
+                yield
+
+    @contextmanager
+    def _cprofile(self, cycle_number: int):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if self.out_dir is not None:
+                self.out_dir.mkdir(parents=True, exist_ok=True)
+                path = self.out_dir / f"cycle_{cycle_number:06d}.prof"
+                profiler.dump_stats(path)
+                print(f"Profile written to {path}")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(self.top)
+
+    @contextmanager
+    def _tracemalloc(self):
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not already_tracing:
+                tracemalloc.stop()
+            self.registry.gauge("pipeline_cycle_peak_traced_bytes",
+                                "Peak Python allocations during the last profiled cycle").set(peak)
+            print(f"Peak traced memory: {peak / 1e6:.1f} MB")
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                print(f"  {stat}")
+
+
+def process_rss_bytes() -> int:
+    """Resident set size of this process, 0 where /proc is unavailable"""
+    try:
+        with open(f"/proc/{os.getpid()}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
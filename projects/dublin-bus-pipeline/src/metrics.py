@@ -0,0 +1,98 @@
+"""
+Delay Metrics Kernel
+Vectorized delay classification and per-group statistics shared by the
+analytics engine, the rollups and the dashboard
+"""
+import numpy as np
+import pandas as pd
+
+# Category thresholds in minutes. Early is strictly below EARLY_MINS, on time
+# is within ±ON_TIME_MINS inclusive, the rest are upper-inclusive bands.
+EARLY_MINS = -1
+ON_TIME_MINS = 1
+SLIGHT_MINS = 5
+MODERATE_MINS = 15
+
+DELAY_CATEGORIES = ("early", "on_time", "slight", "moderate", "severe")
+
+DELAY_LABELS = dict(zip(DELAY_CATEGORIES, [
+    'Early', 'On Time', 'Slight Delay', 'Moderate Delay', 'Severe Delay'
+]))
+
+DELAY_CHART_LABELS = dict(zip(DELAY_CATEGORIES, [
+    'Early (>1 min)', 'On Time (±1 min)', 'Slight (1-5 min)', 'Moderate (5-15 min)', 'Severe (>15 min)'
+]))
+
+
+def category_codes(delay_mins) -> np.ndarray:
+    """Index into DELAY_CATEGORIES for each delay, -1 where the delay is missing"""
+    mins = np.asarray(delay_mins, dtype="float64")
+    return np.select(
+        [mins < EARLY_MINS, mins <= ON_TIME_MINS, mins <= SLIGHT_MINS,
+         mins <= MODERATE_MINS, mins > MODERATE_MINS],
+        [0, 1, 2, 3, 4],
+        default=-1
+    )
+
+
+def categorize_delays(delay_mins, labels: dict = DELAY_LABELS) -> pd.Categorical:
+    """Label each delay with its category"""
+    return pd.Categorical.from_codes(
+        category_codes(delay_mins),
+        categories=[labels[name] for name in DELAY_CATEGORIES]
+    )
+
+
+def category_counts(delay_mins, labels: dict = DELAY_LABELS) -> pd.Series:
+    """Number of delays per category, largest first, empty categories dropped"""
+    codes = category_codes(delay_mins)
+    counts = np.bincount(codes[codes >= 0], minlength=len(DELAY_CATEGORIES))
+    series = pd.Series(counts, index=[labels[name] for name in DELAY_CATEGORIES])
+    return series[series > 0].sort_values(ascending=False, kind="stable")
+
+
+def on_time_rate(delay_mins) -> float:
+    """Percentage of known delays within ±ON_TIME_MINS"""
+    mins = np.asarray(delay_mins, dtype="float64")
+    mins = mins[~np.isnan(mins)]
+    return float((np.abs(mins) <= ON_TIME_MINS).mean() * 100) if len(mins) else float('nan')
+
+
+def delay_summary(delay_mins) -> dict:
+    """Summary statistics for a series of delays in minutes (missing delays are skipped)"""
+    mins = pd.Series(delay_mins, dtype="float64").dropna()
+    n = len(mins)
+
+    return {
+        "avg_delay_mins": round(float(mins.mean()), 2),
+        "median_delay_mins": round(float(mins.median()), 2),
+        "max_delay_mins": round(float(mins.max()), 2),
+        "min_delay_mins": round(float(mins.min()), 2),
+        "std_delay_mins": round(float(mins.std()), 2),
+        "on_time_percentage": round(on_time_rate(mins), 1),
+        "early_percentage": round(float((mins < EARLY_MINS).sum() / n * 100), 1),
+        "delayed_percentage": round(float((mins > ON_TIME_MINS).sum() / n * 100), 1),
+        "severe_delay_percentage": round(float((mins > MODERATE_MINS).sum() / n * 100), 1),
+        "delay_distribution": category_counts(mins).to_dict()
+    }
+
+
+def group_delay_stats(frame: pd.DataFrame, by: str, column: str = 'arrival_delay_mins') -> pd.DataFrame:
+    """Per-group mean/median/std/count and on-time rate in a single groupby pass"""
+    work = pd.DataFrame({
+        by: frame[by],
+        'delay': frame[column],
+        # NaN where the delay is unknown, so the mean skips it
+        'on_time': (np.abs(frame[column]) <= ON_TIME_MINS).where(frame[column].notna()),
+    })
+
+    stats = work.groupby(by, observed=True).agg(
+        avg_delay=('delay', 'mean'),
+        median_delay=('delay', 'median'),
+        std_delay=('delay', 'std'),
+        sample_count=('delay', 'count'),
+        on_time_rate=('on_time', 'mean'),
+    )
+    stats[['avg_delay', 'median_delay', 'std_delay']] = stats[['avg_delay', 'median_delay', 'std_delay']].round(2)
+    stats['on_time_rate'] = stats['on_time_rate'] * 100
+    return stats.reset_index()
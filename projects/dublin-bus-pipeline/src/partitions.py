@@ -0,0 +1,352 @@
+"""
+Time-Partitioned Storage
+The main database holds the most recent PARTITION_HOT_DAYS of raw
+vehicle_positions and trip_updates. Older days are moved into one SQLite
+file per day next to it, listed in partition_catalog, and range queries
+only open the day files that overlap the range. After RAW_RETENTION_DAYS a
+day's positions are downsampled into positions_downsampled and its file is
+deleted; trip updates are already summarized by the delay rollups and
+sketches. Freed pages in the main file are returned with incremental vacuum.
+Day files hold plain denormalized tables with the columns of the raw views
+(see dimensions), so each one can be read on its own.
+"""
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import pandas as pd
+from config import PARTITION_HOT_DAYS, RAW_RETENTION_DAYS, DOWNSAMPLE_SECONDS
+from dimensions import FACT_TABLES
+
+PARTITIONED_TABLES = ("vehicle_positions", "trip_updates")
+
+_PARTITION_INDEXES = {
+    "vehicle_positions": ["collected_at", "vehicle_id, collected_at"],
+    "trip_updates": ["collected_at", "trip_id"],
+}
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS partition_catalog (
+            day TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            position_count INTEGER NOT NULL,
+            update_count INTEGER NOT NULL,
+            archived_at TEXT,
+            expired_at TEXT
+        )
+    """)
+    # Last fix per vehicle per DOWNSAMPLE_SECONDS for days past retention
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS positions_downsampled (
+            vehicle_id TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            route_id TEXT,
+            trip_id TEXT,
+            latitude REAL,
+            longitude REAL,
+            timestamp INTEGER,
+            collected_at TEXT NOT NULL,
+            samples INTEGER NOT NULL,
+            PRIMARY KEY (vehicle_id, bucket_start)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downsampled_time ON positions_downsampled(collected_at)")
+
+
+def partition_dir(conn: sqlite3.Connection) -> Path:
+    """Directory of day files for the database behind conn; None for in-memory databases"""
+    main = next((row[2] for row in conn.execute("PRAGMA database_list") if row[1] == "main"), "")
+    if not main:
+        return None
+    path = Path(main)
+    return path.with_name(f"{path.stem}.partitions")
+
+
+def partition_path(conn: sqlite3.Connection, day: date) -> Path:
+    return partition_dir(conn) / f"{day:%Y%m%d}.db"
+
+
+def _day_bounds(day: date) -> tuple:
+    # ISO date prefixes compare correctly against both "YYYY-MM-DD HH:MM:SS"
+    # and "YYYY-MM-DDTHH:MM:SS" timestamps
+    return day.isoformat(), (day + timedelta(days=1)).isoformat()
+
+
+def _has_catalog(conn: sqlite3.Connection) -> bool:
+    return bool(conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'partition_catalog'"
+    ).fetchone())
+
+
+def _catalog_days(conn: sqlite3.Connection, state: str, start, end) -> list:
+    if not _has_catalog(conn):
+        return []
+    conditions, params = ["state = ?"], [state]
+    if start is not None:
+        conditions.append("day >= ?")
+        params.append(pd.Timestamp(start).date().isoformat())
+    if end is not None:
+        conditions.append("day <= ?")
+        params.append(pd.Timestamp(end).date().isoformat())
+    rows = conn.execute(f"SELECT day FROM partition_catalog WHERE {' AND '.join(conditions)} ORDER BY day",
+                        params)
+    return [date.fromisoformat(day) for (day,) in rows]
+
+
+def archived_days(conn: sqlite3.Connection, start=None, end=None) -> list:
+    """Days with raw rows in a day file overlapping [start, end], oldest first"""
+    if partition_dir(conn) is None:
+        return []
+    return _catalog_days(conn, "archived", start, end)
+
+
+def expired_days(conn: sqlite3.Connection, start=None, end=None) -> list:
+    """Days overlapping [start, end] only kept as positions_downsampled"""
+    return _catalog_days(conn, "expired", start, end)
+
+
+def clear_rebuildable(conn: sqlite3.Connection, table: str, column: str = "bucket_start"):
+    """Empty a table derived from raw rows, except on expired days, which can't be rebuilt"""
+    expired = [day.isoformat() for day in expired_days(conn)]
+    placeholders = ", ".join("?" for _ in expired)
+    conn.execute(f"DELETE FROM {table} WHERE substr({column}, 1, 10) NOT IN ({placeholders})", expired)
+
+
+@contextmanager
+def range_sources(conn: sqlite3.Connection, start=None, end=None):
+    """Connections holding raw rows for [start, end]: each overlapping day file
+    (read-only, oldest first) and then conn itself
+
+    Queries run against each source must filter on collected_at themselves;
+    the day files only narrow which files are opened.
+    """
+    sources = []
+    try:
+        for day in archived_days(conn, start, end):
+            path = partition_path(conn, day)
+            if path.exists():
+                sources.append(sqlite3.connect(f"file:{path}?mode=ro", uri=True))
+        yield sources + [conn]
+    finally:
+        for source in sources:
+            source.close()
+
+
+def read_range(conn: sqlite3.Connection, query: str, params=(), start=None, end=None,
+               main_query: str = None) -> pd.DataFrame:
+    """pd.read_sql over every source in range_sources, concatenated oldest first
+
+    main_query, if given, is run against conn itself instead of query (e.g.
+    one written against the fact tables rather than the raw views).
+    """
+    with range_sources(conn, start, end) as sources:
+        frames = [pd.read_sql(main_query if main_query and source is conn else query, source,
+                              params=list(params))
+                  for source in sources]
+    frames = [frame for frame in frames if len(frame)] or frames[-1:]
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def _common_columns(conn: sqlite3.Connection, table: str) -> list:
+    main = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+    archived = {row[1] for row in conn.execute(f"PRAGMA part.table_info({table})")}
+    return [column for column in main if column in archived]
+
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    return bool(conn.execute("SELECT 1 FROM main.sqlite_master WHERE name = ?", (name,)).fetchone())
+
+
+def _stored_table(conn: sqlite3.Connection, table: str) -> str:
+    """The fact table behind a raw view, or the table itself on a pre-dimension database"""
+    return FACT_TABLES[table] if _has_table(conn, FACT_TABLES[table]) else table
+
+
+def _oldest_day(conn: sqlite3.Connection) -> date:
+    oldest = [conn.execute(f"SELECT MIN(collected_at) FROM main.{table}").fetchone()[0]
+              for table in PARTITIONED_TABLES]
+    oldest = [value for value in oldest if value]
+    return pd.Timestamp(min(oldest)).date() if oldest else None
+
+
+def roll_day(conn: sqlite3.Connection, day: date) -> tuple:
+    """Move one day's raw rows from the main database into its day file
+
+    Safe to repeat: rows already in the file for that day are replaced, so a
+    crash between the two files' commits is fixed by the next roll.
+    """
+    path = partition_path(conn, day)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    low, high = _day_bounds(day)
+
+    conn.execute("ATTACH DATABASE ? AS part", (str(path),))
+    try:
+        for table in PARTITIONED_TABLES:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS part.{table} AS SELECT * FROM main.{table} WHERE 0")
+            for i, columns in enumerate(_PARTITION_INDEXES[table]):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS part.idx_{table}_{i} ON {table}({columns})")
+
+        conn.execute("BEGIN")
+        try:
+            counts = []
+            for table in PARTITIONED_TABLES:
+                columns = ", ".join(_common_columns(conn, table))
+                in_day = "collected_at >= ? AND collected_at < ?"
+                conn.execute(f"DELETE FROM part.{table} WHERE {in_day}", (low, high))
+                conn.execute(f"INSERT INTO part.{table} ({columns}) SELECT {columns} FROM main.{table} "
+                             f"WHERE {in_day}", (low, high))
+                # Rows are deleted from the fact table behind the view
+                stored = _stored_table(conn, table)
+                if table == "vehicle_positions" and _has_table(conn, "positions_rtree"):
+                    conn.execute(f"DELETE FROM main.positions_rtree WHERE id IN "
+                                 f"(SELECT id FROM main.{stored} WHERE {in_day})", (low, high))
+                conn.execute(f"DELETE FROM main.{stored} WHERE {in_day}", (low, high))
+                counts.append(conn.execute(f"SELECT COUNT(*) FROM part.{table}").fetchone()[0])
+            conn.execute("""
+                INSERT INTO partition_catalog (day, state, position_count, update_count, archived_at)
+                VALUES (?, 'archived', ?, ?, ?)
+                ON CONFLICT (day) DO UPDATE SET
+                    state = 'archived',
+                    position_count = excluded.position_count,
+                    update_count = excluded.update_count,
+                    archived_at = excluded.archived_at
+            """, (day.isoformat(), *counts, datetime.now().isoformat(timespec="seconds")))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("DETACH DATABASE part")
+    return tuple(counts)
+
+
+def roll_partitions(conn: sqlite3.Connection, hot_days: int = PARTITION_HOT_DAYS, today: date = None) -> list:
+    """Move every day older than the hot window out of the main database"""
+    if not hot_days or partition_dir(conn) is None:
+        return []
+    cutoff = (today or date.today()) - timedelta(days=hot_days - 1)
+    rolled = []
+    day = _oldest_day(conn)
+    while day is not None and day < cutoff:
+        positions, updates = roll_day(conn, day)
+        print(f"Archived {day}: {positions:,} positions, {updates:,} trip updates")
+        rolled.append(day)
+        day = _oldest_day(conn)
+    return rolled
+
+
+_DOWNSAMPLE = """
+    INSERT OR REPLACE INTO main.positions_downsampled
+    SELECT vehicle_id,
+           datetime(CAST(strftime('%s', collected_at) AS INTEGER) / :step * :step, 'unixepoch') AS bucket_start,
+           route_id, trip_id, latitude, longitude, timestamp,
+           MAX(collected_at), COUNT(*)
+    FROM part.vehicle_positions
+    WHERE vehicle_id IS NOT NULL AND latitude IS NOT NULL AND longitude IS NOT NULL
+    GROUP BY vehicle_id, bucket_start
+"""
+
+
+def expire_day(conn: sqlite3.Connection, day: date, step_seconds: int = DOWNSAMPLE_SECONDS) -> int:
+    """Downsample a day file's positions into the main database and delete the file"""
+    path = partition_path(conn, day)
+    kept = 0
+    if path.exists():
+        conn.execute("ATTACH DATABASE ? AS part", (str(path),))
+        try:
+            conn.execute("BEGIN")
+            try:
+                # Bare columns next to MAX() come from the row holding the maximum,
+                # i.e. the last fix in each bucket
+                kept = conn.execute(_DOWNSAMPLE, {"step": step_seconds}).rowcount
+                conn.execute("""
+                    UPDATE partition_catalog SET state = 'expired', expired_at = ? WHERE day = ?
+                """, (datetime.now().isoformat(timespec="seconds"), day.isoformat()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.execute("DETACH DATABASE part")
+        path.unlink()
+    return kept
+
+
+def expire_partitions(conn: sqlite3.Connection, retention_days: int = RAW_RETENTION_DAYS,
+                      today: date = None) -> list:
+    """Downsample and drop every archived day older than the retention period"""
+    if not retention_days:
+        return []
+    cutoff = (today or date.today()) - timedelta(days=retention_days - 1)
+    expired = []
+    for day in archived_days(conn, end=cutoff - timedelta(days=1)):
+        kept = expire_day(conn, day)
+        print(f"Expired {day}: downsampled to {kept:,} positions")
+        expired.append(day)
+    return expired
+
+
+def incremental_vacuum(conn: sqlite3.Connection) -> int:
+    """Return free pages to the filesystem; needs auto_vacuum=INCREMENTAL"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free:
+        # execute() steps the pragma once, which frees a single page;
+        # executescript runs it to completion
+        conn.executescript("PRAGMA incremental_vacuum;")
+    return free
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection):
+    """Switch an existing database to auto_vacuum=INCREMENTAL (rewrites the file once)"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    print("Rebuilding database for incremental vacuum...")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def maintain(conn: sqlite3.Connection, hot_days: int = PARTITION_HOT_DAYS,
+             retention_days: int = RAW_RETENTION_DAYS, today: date = None) -> dict:
+    """Archive days past the hot window, expire days past retention, vacuum the freed space
+
+    conn must be in autocommit mode (isolation_level=None), like the
+    BulkWriter connection.
+    """
+    if retention_days:
+        # Rows past retention are never left in the main database
+        hot_days = min(hot_days, retention_days) if hot_days else retention_days
+    rolled = roll_partitions(conn, hot_days, today)
+    expired = expire_partitions(conn, retention_days, today)
+    freed = incremental_vacuum(conn) if rolled else 0
+    return {"archived": rolled, "expired": expired, "pages_freed": freed}
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import DATABASE_PATH
+    from db import connect, WRITER_PRAGMAS
+
+    parser = argparse.ArgumentParser(description="Time-partitioned storage maintenance")
+    parser.add_argument("command", choices=["maintain", "list"])
+    parser.add_argument("--hot-days", type=int, default=PARTITION_HOT_DAYS,
+                        help="Days of raw rows kept in the main database")
+    parser.add_argument("--retention-days", type=int, default=RAW_RETENTION_DAYS,
+                        help="Days of raw rows kept at all (0 = forever)")
+    parser.add_argument("--enable-vacuum", action="store_true",
+                        help="Convert an existing database to incremental vacuum first")
+    args = parser.parse_args()
+
+    conn = connect(DATABASE_PATH, WRITER_PRAGMAS, isolation_level=None)
+    create_tables(conn.cursor())
+    if args.command == "maintain":
+        if args.enable_vacuum:
+            enable_incremental_vacuum(conn)
+        print(maintain(conn, args.hot_days, args.retention_days))
+    else:
+        catalog = pd.read_sql("SELECT * FROM partition_catalog ORDER BY day", conn)
+        print(catalog.to_string(index=False) if len(catalog) else "No partitions")
+    conn.close()
@@ -0,0 +1,260 @@
+"""
+Pipelined Ingest
+Splits each collection cycle across threads so a slow SQLite commit or raw
+snapshot dump never holds up the next fetch: the scheduler thread fetches,
+then hands the cycle to a parse thread, a single writer thread and an
+archiver, through bounded queues.
+
+The write queue blocks when full, pushing back on the parser. The parse and
+archive queues never block the fetcher: when they are full the oldest
+waiting cycle is dropped and counted, the same way the scheduler coalesces
+ticks it could not run. On shutdown every queue is drained before the
+threads exit.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from config import PIPELINE_QUEUE_SIZE, RAW_SNAPSHOT_EVERY
+from instrumentation import METRICS
+
+# Marks the end of a queue; passed downstream so each stage drains first
+STOP = object()
+
+
+def snapshot_due(cycle_number: int, every: int = RAW_SNAPSHOT_EVERY) -> bool:
+    """Whether a cycle (counted from 1) saves raw snapshots: the first, then
+    every Nth; never if every is None"""
+    if every is None:
+        return False
+    return cycle_number == 1 or (every > 0 and cycle_number % every == 0)
+
+
+@dataclass
+class Cycle:
+    """One collection cycle on its way through the stages"""
+    number: int
+    tick: float
+    collected_at: str = None
+    fresh: dict = None
+    feed_timestamps: dict = field(default_factory=dict)
+    timings: dict = field(default_factory=dict)
+    positions: list = None
+    updates: list = None
+    written_at: float = None
+
+
+@dataclass
+class QueueStats:
+    capacity: int
+    puts: int = 0
+    dropped: int = 0
+    max_depth: int = 0
+    total_depth: int = 0
+    blocked_seconds: float = 0.0
+
+    @property
+    def avg_depth(self) -> float:
+        """Mean depth seen by items as they were queued"""
+        return self.total_depth / self.puts if self.puts else 0.0
+
+
+class StageQueue:
+    """Bounded queue in front of a stage
+
+    overflow="block" makes producers wait for room (backpressure);
+    "drop_oldest" makes room by discarding the longest-waiting item.
+    """
+
+    def __init__(self, name: str, capacity: int, overflow: str = "block"):
+        if overflow not in ("block", "drop_oldest"):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.name = name
+        self.overflow = overflow
+        self.items = queue.Queue(maxsize=max(1, capacity))
+        self.stats = QueueStats(max(1, capacity))
+        self._depth = METRICS.gauge("pipeline_queue_depth", "Items waiting in front of each stage")
+
+    def put(self, item):
+        if self.overflow == "block":
+            start = time.perf_counter()
+            self.items.put(item)
+            waited = time.perf_counter() - start
+            self.stats.blocked_seconds += waited
+            METRICS.counter("pipeline_queue_blocked_seconds_total",
+                            "Time producers spent waiting for room").inc(waited, queue=self.name)
+        else:
+            while True:
+                try:
+                    self.items.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.items.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self.stats.dropped += 1
+                    METRICS.counter("pipeline_queue_dropped_total",
+                                    "Items discarded to keep fetching on time").inc(queue=self.name)
+        depth = self.items.qsize()
+        self.stats.puts += 1
+        self.stats.total_depth += depth
+        self.stats.max_depth = max(self.stats.max_depth, depth)
+        self._depth.set(depth, queue=self.name)
+
+    def get(self):
+        item = self.items.get()
+        self._depth.set(self.items.qsize(), queue=self.name)
+        return item
+
+    def close(self):
+        """Queue STOP behind everything already waiting; never dropped"""
+        self.items.put(STOP)
+
+
+class Stage(threading.Thread):
+    """Runs handler on each item of its inbox and passes non-None results on
+
+    A handler that raises loses that one item; the stage carries on.
+    """
+
+    def __init__(self, name: str, inbox: StageQueue, handler, outbox: StageQueue = None):
+        super().__init__(name=f"ingest-{name}", daemon=True)
+        self.stage = name
+        self.inbox = inbox
+        self.handler = handler
+        self.outbox = outbox
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is STOP:
+                if self.outbox is not None:
+                    self.outbox.close()
+                return
+            start = time.perf_counter()
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                self.errors += 1
+                METRICS.counter("pipeline_stage_failures_total", "Items a pipeline stage gave up on").inc(
+                    stage=self.stage
+                )
+                print(f"Error in {self.stage} stage: {e}")
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - start
+            self.processed += 1
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+
+
+class IngestPipeline:
+    """Fetch on the caller's thread; parse, write and archive on stage threads
+
+        pipeline = IngestPipeline(collector).start()
+        scheduler.run(pipeline.submit)
+        pipeline.close()
+
+    on_written(cycle) is called on the writer thread after each commit.
+    snapshot_every=None turns raw snapshots off.
+    """
+
+    def __init__(self, collector, queue_size: int = PIPELINE_QUEUE_SIZE,
+                 snapshot_every: int = RAW_SNAPSHOT_EVERY, on_written=None):
+        self.collector = collector
+        self.snapshot_every = snapshot_every
+        self.on_written = on_written
+        self.parse_queue = StageQueue("parse", queue_size, "drop_oldest")
+        self.write_queue = StageQueue("write", queue_size, "block")
+        self.archive_queue = StageQueue("archive", queue_size, "drop_oldest")
+        self.stages = [
+            Stage("parse", self.parse_queue, self._parse, self.write_queue),
+            Stage("write", self.write_queue, self._write),
+            Stage("archive", self.archive_queue, self._archive),
+        ]
+        self.lag = METRICS.histogram("pipeline_ingest_lag_seconds", "Scheduler tick to commit")
+        self.closed = False
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def submit(self, tick: float = None):
+        """Fetch one cycle and queue it for the stages"""
+        if self.closed:
+            raise RuntimeError("Pipeline is closed")
+        collector = self.collector
+        collector.cycle_count += 1
+        cycle = Cycle(collector.cycle_count, time.time() if tick is None else tick)
+        collector.cycle_timings = cycle.timings
+        cycle.fresh = collector.fetch_feeds()
+        cycle.collected_at = str(datetime.now())
+        cycle.feed_timestamps = {name: result.feed_timestamp for name, result in cycle.fresh.items()}
+        if cycle.fresh and snapshot_due(cycle.number, self.snapshot_every):
+            self.archive_queue.put((cycle.fresh, cycle.collected_at))
+        self.parse_queue.put(cycle)
+        return cycle
+
+    def _parse(self, cycle: Cycle) -> Cycle:
+        self.collector.cycle_timings = cycle.timings
+        cycle.positions, cycle.updates = self.collector.parse_feeds(cycle.fresh)
+        # The archiver holds its own reference; drop ours so the decoded
+        # bodies are freed as soon as both are done with them
+        cycle.fresh = None
+        return cycle
+
+    def _write(self, cycle: Cycle):
+        collector = self.collector
+        collector.cycle_timings = cycle.timings
+        if collector.profiler is None:
+            collector.finish_cycle(cycle.positions, cycle.updates, cycle.number, cycle.collected_at)
+        else:
+            # Only the writer thread is profiled; it is the one that can stall
+            with collector.profiler.profile(cycle.number):
+                collector.finish_cycle(cycle.positions, cycle.updates, cycle.number, cycle.collected_at)
+        cycle.written_at = time.time()
+        self.lag.observe(cycle.written_at - cycle.tick)
+        if self.on_written is not None:
+            self.on_written(cycle)
+
+    def _archive(self, item: tuple):
+        fresh, collected_at = item
+        self.collector.cycle_timings = {}
+        self.collector.archive_feeds(fresh, collected_at)
+
+    def close(self, timeout: float = None) -> bool:
+        """Stop accepting cycles and wait for every queued one to be written
+
+        Returns False if the stages had not drained within `timeout` or a
+        second Ctrl-C cut the wait short.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            if not self.closed:
+                self.closed = True
+                self.parse_queue.close()
+                self.archive_queue.close()
+            for stage in self.stages:
+                stage.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except KeyboardInterrupt:
+            print("Abandoning queued cycles")
+            return False
+        return not any(stage.is_alive() for stage in self.stages)
+
+    def summary(self) -> str:
+        lines = []
+        for stage in self.stages:
+            stats = stage.inbox.stats
+            lines.append(
+                f"  {stage.stage}: {stage.processed} done, {stage.errors} failed, "
+                f"busy {stage.busy_seconds:.1f}s; queue depth avg {stats.avg_depth:.1f} / "
+                f"max {stats.max_depth} of {stats.capacity}, {stats.dropped} dropped, "
+                f"{stats.blocked_seconds:.1f}s blocked"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,198 @@
+"""
+GTFS-Realtime Protobuf Feed Support
+Decodes the binary FeedMessage form of the TFI feeds into the same column
+buffers the streaming JSON parser produces, and converts the JSON snapshots
+in data/raw/ into .pb fixtures for offline testing and benchmarking
+"""
+from pathlib import Path
+import numpy as np
+from stream_parser import VehiclePositionColumns, TripUpdateColumns
+
+try:
+    from google.protobuf import json_format
+    from google.protobuf.message import DecodeError
+    from google.transit import gtfs_realtime_pb2
+except ImportError:  # optional dependency, only needed for FEED_FORMAT=protobuf
+    json_format = None
+    DecodeError = None
+    gtfs_realtime_pb2 = None
+
+
+def _require_bindings():
+    if gtfs_realtime_pb2 is None:
+        raise ImportError(
+            "Protobuf feeds need the GTFS-RT bindings: pip install gtfs-realtime-bindings"
+        )
+
+
+def _opt(message, field: str):
+    """Value of an optional proto2 field, or None when it is not set"""
+    return getattr(message, field) if message.HasField(field) else None
+
+
+def decode_feed(content: bytes):
+    """Decode a serialized FeedMessage"""
+    _require_bindings()
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+
+def _coordinate(position, field: str):
+    # Coordinates are float32 on the wire. The JSON feed prints them the way
+    # protobuf's SimpleFtoa does: 6 significant digits when that reads back
+    # as the same float32, otherwise 9, which always does
+    value = _opt(position, field)
+    if value is None:
+        return None
+    text = f"{value:.6g}"
+    if np.float32(text) != np.float32(value):
+        text = f"{value:.9g}"
+    return float(text)
+
+
+def _header_dict(feed) -> dict:
+    return json_format.MessageToDict(feed.header, preserving_proto_field_name=True)
+
+
+def _read_varint(content: bytes, pos: int) -> tuple:
+    result = shift = 0
+    while True:
+        byte = content[pos]
+        result |= (byte & 0x7F) << shift
+        pos += 1
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def peek_feed_timestamp_pb(content: bytes):
+    """Read the header timestamp without decoding the entities
+
+    FeedMessage.header is field 1, which the TFI feed (like most producers)
+    serializes first; anything else falls back to a full decode. A body
+    that is not a FeedMessage raises ValueError, like a bad JSON body does.
+    """
+    _require_bindings()
+    try:
+        if content[:1] == b"\x0a":
+            length, pos = _read_varint(content, 1)
+            header = gtfs_realtime_pb2.FeedHeader.FromString(content[pos:pos + length])
+        else:
+            header = decode_feed(content).header
+    except (DecodeError, IndexError) as e:
+        raise ValueError(f"Not a GTFS-RT FeedMessage: {e}") from e
+    return str(header.timestamp) if header.HasField("timestamp") else None
+
+
+def parse_vehicle_positions_pb(content: bytes) -> tuple:
+    """Decode a VehiclePositions feed, returning (header, columns)"""
+    feed = decode_feed(content)
+    columns = VehiclePositionColumns()
+
+    for entity in feed.entity:
+        vehicle = entity.vehicle
+        trip = vehicle.trip
+        position = vehicle.position
+        columns.append_row(
+            _opt(vehicle.vehicle, "id"),
+            _opt(trip, "trip_id"),
+            _opt(trip, "route_id"),
+            _coordinate(position, "latitude"),
+            _coordinate(position, "longitude"),
+            _opt(vehicle, "timestamp"),
+            _opt(trip, "start_time"),
+            _opt(trip, "start_date"),
+            _opt(trip, "direction_id"),
+        )
+
+    return _header_dict(feed), columns
+
+
+def parse_trip_updates_pb(content: bytes) -> tuple:
+    """Decode a TripUpdates feed, returning (header, columns)"""
+    feed = decode_feed(content)
+    columns = TripUpdateColumns()
+
+    for entity in feed.entity:
+        trip_update = entity.trip_update
+        trip = trip_update.trip
+        trip_values = (
+            _opt(trip, "trip_id"),
+            _opt(trip, "route_id"),
+            _opt(trip, "start_date"),
+            _opt(trip, "start_time"),
+        )
+        timestamp = _opt(trip_update, "timestamp")
+
+        for stop_update in trip_update.stop_time_update:
+            columns.append_row(
+                *trip_values,
+                _opt(stop_update, "stop_sequence"),
+                _opt(stop_update, "stop_id"),
+                _opt(stop_update.arrival, "delay"),
+                _opt(stop_update.departure, "delay"),
+                timestamp,
+                _opt(stop_update.arrival, "time"),
+                _opt(stop_update.departure, "time"),
+            )
+
+    return _header_dict(feed), columns
+
+
+def json_to_protobuf(data: dict) -> bytes:
+    """Serialize a JSON-format feed (as returned by ?format=json) to protobuf"""
+    _require_bindings()
+    feed = json_format.ParseDict(data, gtfs_realtime_pb2.FeedMessage(), ignore_unknown_fields=True)
+    return feed.SerializeToString()
+
+
+def convert_snapshots(source_dir: Path, output_dir: Path) -> list:
+    """Write a .pb fixture next to every JSON snapshot in source_dir"""
+    import json
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+    for path in sorted(source_dir.glob("*.json")):
+        with open(path) as f:
+            content = json_to_protobuf(json.load(f))
+        target = output_dir / f"{path.stem}.pb"
+        target.write_bytes(content)
+        written.append(target)
+        print(f"{path.name} ({path.stat().st_size:,} B) -> {target.name} ({len(content):,} B)")
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from config import RAW_DATA_DIR, DATA_DIR
+    from stream_parser import parse_vehicle_positions_stream, parse_trip_updates_stream
+
+    parser = argparse.ArgumentParser(description="GTFS-RT protobuf fixtures")
+    parser.add_argument("command", choices=["convert", "bench"])
+    parser.add_argument("--source", type=Path, default=RAW_DATA_DIR, help="Directory of JSON snapshots")
+    parser.add_argument("--output", type=Path, default=DATA_DIR / "fixtures", help="Directory for .pb fixtures")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_snapshots(args.source, args.output)
+    else:
+        # Compare decode throughput of the JSON and protobuf forms of each snapshot
+        print(f"{'snapshot':<32} {'format':<9} {'bytes':>10} {'records':>8} {'rec/s':>11}")
+        for pb_path in sorted(args.output.glob("*.pb")):
+            json_path = args.source / f"{pb_path.stem}.json"
+            if pb_path.stem.startswith("vehicles"):
+                parsers = (parse_vehicle_positions_stream, parse_vehicle_positions_pb)
+            else:
+                parsers = (parse_trip_updates_stream, parse_trip_updates_pb)
+
+            for label, path, parse in (("json", json_path, parsers[0]), ("protobuf", pb_path, parsers[1])):
+                if not path.exists():
+                    continue
+                content = path.read_bytes()
+                start = time.perf_counter()
+                _, columns = parse(content)
+                elapsed = time.perf_counter() - start
+                print(f"{pb_path.stem:<32} {label:<9} {len(content):>10,} {len(columns):>8,} "
+                      f"{len(columns) / elapsed:>11,.0f}")
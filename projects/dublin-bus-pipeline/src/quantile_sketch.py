@@ -0,0 +1,263 @@
+"""
+Mergeable Quantile Sketches
+A KLL sketch (Karnin, Lang & Liberty, 2016) per route per hour, stored as a
+compact BLOB and maintained at ingest. Sketches merge across hours and
+routes, so medians and p90/p95 over months of data never touch raw rows.
+
+Error bound: with the default k = 200 the rank of a returned quantile is
+within about ±1.65% of the requested rank (99% confidence), independent of
+how many values were added or how many sketches were merged. For example a
+reported p95 lies between the true p93.35 and p96.65.
+"""
+import math
+import random
+import sqlite3
+import struct
+from array import array
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import partitions
+from rollups import BUCKETS
+
+DEFAULT_K = 200
+_C = 2 / 3
+_VERSION = 1
+_HEADER = struct.Struct("<BHQddB")
+
+# Sketch key that aggregates every route in a bucket
+ALL_ROUTES = "*"
+
+
+class KLLSketch:
+    """KLL quantile sketch over float values"""
+
+    def __init__(self, k: int = DEFAULT_K, seed=None):
+        self.k = k
+        self.n = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.compactors = [[]]
+        self._rng = random.Random(seed)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _capacity(self, level: int) -> int:
+        height = len(self.compactors)
+        return max(int(math.ceil(self.k * _C ** (height - level - 1))), 2)
+
+    def _size(self) -> int:
+        return sum(len(items) for items in self.compactors)
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(level) for level in range(len(self.compactors)))
+
+    def _compress(self):
+        """Halve the lowest full compactor, promoting every other item one level up"""
+        for level, items in enumerate(self.compactors):
+            if len(items) < self._capacity(level):
+                continue
+            if level + 1 == len(self.compactors):
+                self.compactors.append([])
+            items.sort()
+            leftover = [items.pop()] if len(items) % 2 else []
+            offset = self._rng.randint(0, 1)
+            self.compactors[level + 1].extend(items[offset::2])
+            self.compactors[level] = leftover
+            return
+
+    def _settle(self):
+        while self._size() >= self._max_size():
+            self._compress()
+
+    def update(self, value: float):
+        self.update_many([value])
+
+    def update_many(self, values):
+        values = [float(v) for v in values]
+        if not values:
+            return
+        self.compactors[0].extend(values)
+        self.n += len(values)
+        self.min = min(self.min, min(values))
+        self.max = max(self.max, max(values))
+        self._settle()
+
+    def merge(self, other: "KLLSketch") -> "KLLSketch":
+        """Fold another sketch into this one (in place) and return self"""
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._settle()
+        return self
+
+    def quantiles(self, qs) -> np.ndarray:
+        """Estimated values at each quantile in qs (0..1)"""
+        qs = np.atleast_1d(np.asarray(qs, dtype=float))
+        if self.n == 0:
+            return np.full(len(qs), np.nan)
+
+        values = np.concatenate([np.asarray(items, dtype=float) for items in self.compactors])
+        weights = np.concatenate([
+            np.full(len(items), 2 ** level, dtype=float)
+            for level, items in enumerate(self.compactors)
+        ])
+        order = np.argsort(values, kind="stable")
+        values, cumulative = values[order], np.cumsum(weights[order])
+
+        index = np.searchsorted(cumulative, qs * cumulative[-1], side="left")
+        result = values[np.clip(index, 0, len(values) - 1)]
+        # The extremes are tracked exactly
+        result[qs <= 0] = self.min
+        result[qs >= 1] = self.max
+        return result
+
+    def quantile(self, q: float) -> float:
+        return float(self.quantiles([q])[0])
+
+    def to_bytes(self) -> bytes:
+        parts = [_HEADER.pack(_VERSION, self.k, self.n, self.min, self.max, len(self.compactors))]
+        for items in self.compactors:
+            parts.append(struct.pack("<I", len(items)))
+            parts.append(array("d", items).tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, seed=None) -> "KLLSketch":
+        version, k, n, min_value, max_value, levels = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f"Unsupported sketch version: {version}")
+
+        sketch = cls(k, seed=seed)
+        sketch.n, sketch.min, sketch.max = n, min_value, max_value
+        sketch.compactors = []
+        offset = _HEADER.size
+        for _ in range(levels):
+            (count,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            items = array("d")
+            items.frombytes(data[offset:offset + 8 * count])
+            offset += 8 * count
+            sketch.compactors.append(items.tolist())
+        return sketch
+
+
+def merge_all(sketches) -> KLLSketch:
+    merged = KLLSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS delay_sketches (
+            route_id TEXT NOT NULL,
+            bucket_size TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (bucket_size, bucket_start, route_id)
+        )
+    """)
+
+
+def _fold(conn: sqlite3.Connection, bucket_start: str, groups: dict):
+    """Add {route_id: delays} into the stored hourly sketches for one bucket"""
+    stored = dict(conn.execute(
+        "SELECT route_id, sketch FROM delay_sketches WHERE bucket_size = 'hour' AND bucket_start = ?",
+        (bucket_start,)
+    ))
+
+    rows = []
+    for route_id, values in groups.items():
+        # Seeded from what is stored so far, so replaying the same cycles in
+        # the same order rebuilds byte-identical sketches
+        blob = stored.get(route_id)
+        seed = f"{bucket_start}/{route_id}/{len(blob) if blob else 0}"
+        sketch = KLLSketch.from_bytes(blob, seed=seed) if blob else KLLSketch(seed=seed)
+        sketch.update_many(values)
+        rows.append((route_id, "hour", bucket_start, sketch.to_bytes()))
+
+    conn.executemany("""
+        INSERT OR REPLACE INTO delay_sketches (route_id, bucket_size, bucket_start, sketch)
+        VALUES (?, ?, ?, ?)
+    """, rows)
+
+
+def _route_groups(route_ids: pd.Series, delays: pd.Series) -> dict:
+    frame = pd.DataFrame({
+        "route_id": route_ids.fillna("").astype(object),
+        "delay": pd.to_numeric(delays, errors="coerce").astype("float64"),
+    }).dropna(subset=["delay"])
+
+    groups = {route: series.tolist() for route, series in frame.groupby("route_id")["delay"]}
+    if len(frame):
+        groups[ALL_ROUTES] = frame["delay"].tolist()
+    return groups
+
+
+def update_sketches(conn: sqlite3.Connection, cycle):
+    """Ingest hook: add one cycle's arrival delays to the hourly sketches"""
+    if not len(cycle.updates):
+        return
+    frame = cycle.updates_frame
+    bucket_start = datetime.fromisoformat(cycle.collected_at).strftime(BUCKETS["hour"])
+    _fold(conn, bucket_start, _route_groups(frame["route_id"], frame["arrival_delay"]))
+
+
+def backfill(conn: sqlite3.Connection, chunk_size: int = 500_000):
+    """Rebuild the hourly sketches from trip_updates, in the main database and in day files
+
+    Expired days no longer have their updates, so their sketches are kept.
+    """
+    partitions.clear_rebuildable(conn, "delay_sketches")
+    with partitions.range_sources(conn) as sources:
+        for source in sources:
+            chunks = pd.read_sql(f"""
+                SELECT strftime('{BUCKETS["hour"]}', collected_at) AS bucket_start, route_id, arrival_delay
+                FROM trip_updates
+                WHERE arrival_delay IS NOT NULL
+                ORDER BY bucket_start
+            """, source, chunksize=chunk_size)
+
+            for chunk in chunks:
+                for bucket_start, group in chunk.groupby("bucket_start"):
+                    _fold(conn, bucket_start, _route_groups(group["route_id"], group["arrival_delay"]))
+    conn.commit()
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    if conn.execute("SELECT 1 FROM delay_sketches LIMIT 1").fetchone():
+        return False
+    if not conn.execute("SELECT 1 FROM trip_updates LIMIT 1").fetchone():
+        return False
+    print("Backfilling delay sketches from existing data...")
+    backfill(conn)
+    return True
+
+
+if __name__ == "__main__":
+    # Empirical check of the documented rank error on a skewed distribution
+    rng = np.random.default_rng(7)
+    data = np.round(rng.lognormal(4, 1.2, 1_000_000) - 60)
+
+    shards = []
+    for chunk in np.array_split(data, 500):
+        sketch = KLLSketch()
+        sketch.update_many(chunk)
+        shards.append(KLLSketch.from_bytes(sketch.to_bytes()))
+    merged = merge_all(shards)
+
+    ordered = np.sort(data)
+    print(f"{len(data):,} values in 500 merged shards, {len(merged.to_bytes()):,} byte sketch")
+    for q in (0.5, 0.9, 0.95, 0.99):
+        estimate = merged.quantile(q)
+        low = np.searchsorted(ordered, estimate, side="left") / len(data)
+        high = np.searchsorted(ordered, estimate, side="right") / len(data)
+        error = 0.0 if low <= q <= high else min(abs(q - low), abs(q - high))
+        print(f"  p{q * 100:g}: {estimate:8.1f}  true {np.quantile(data, q):8.1f}  rank error {error:.4%}")
@@ -0,0 +1,226 @@
+"""
+Query Result Cache
+Memoizes BusAnalytics query results keyed by query, arguments and a data
+watermark (the newest ingest cycle and row ids), so a result is reused until
+new data actually lands rather than for a fixed TTL. An in-memory LRU tier
+is bounded by entry count and bytes; an optional on-disk tier of pickles is
+shared by every process pointed at the same directory.
+"""
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import pandas as pd
+from config import QUERY_CACHE_ENTRIES, QUERY_CACHE_MB, QUERY_CACHE_DIR, QUERY_CACHE_DISK_MB
+from instrumentation import METRICS
+
+# Tables whose newest id moves whenever a cycle is written (or backfilled);
+# raw rows are in the fact tables, or in plain tables on a pre-dimension database
+WATERMARK_TABLES = ("ingest_cycles", "vehicle_positions_fact", "trip_updates_fact",
+                    "vehicle_positions", "trip_updates", "trip_update_changes")
+
+
+def data_watermark(conn) -> tuple:
+    """Newest id of every ingest table, plus the partition catalog's state
+
+    Archiving and expiring day partitions change what range queries return
+    without writing a cycle, so they are part of the watermark too.
+    """
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    parts = [f"(SELECT MAX(id) FROM {table})" for table in WATERMARK_TABLES if table in tables]
+    if "partition_catalog" in tables:
+        parts.append("(SELECT COUNT(*) || '/' || COALESCE(SUM(state = 'expired'), 0) FROM partition_catalog)")
+    if not parts:
+        return ()
+    return tuple(conn.execute(f"SELECT {', '.join(parts)}").fetchone())
+
+
+def _sizeof(value) -> int:
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(repr(value).encode()).hexdigest()[:32]
+
+
+class QueryCache:
+    """Two-tier result cache; values are shared between callers and must not be mutated
+
+    Each query keeps only its result for the newest watermark seen: a lookup
+    at a newer watermark replaces it. Concurrent misses on the same query
+    compute it once.
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_ENTRIES, max_mb: float = QUERY_CACHE_MB,
+                 disk_dir=QUERY_CACHE_DIR, max_disk_mb: float = QUERY_CACHE_DISK_MB):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1e6)
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.max_disk_bytes = int(max_disk_mb * 1e6)
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()     # key -> (watermark, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def get_or_compute(self, key: tuple, watermark: tuple, compute):
+        """Cached value of `key` at `watermark`, calling compute() on a miss"""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            value, found = self._memory_get(key, watermark)
+            if found:
+                self._count("hits", "hit")
+                return value
+            value, found = self._disk_get(key, watermark)
+            if found:
+                self._count("disk_hits", "disk_hit")
+            else:
+                self._count("misses", "miss")
+                value = compute()
+                self._disk_put(key, watermark, value)
+            self._memory_put(key, watermark, value)
+            return value
+
+    def _count(self, stat: str, result: str):
+        with self._lock:
+            self.stats[stat] += 1
+        METRICS.counter("query_cache_requests_total", "Cached query lookups by outcome").inc(result=result)
+
+    # Memory tier
+
+    def _memory_get(self, key: tuple, watermark: tuple) -> tuple:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            if entry[0] != watermark:
+                self.stats["stale"] += 1
+                return None, False
+            self._entries.move_to_end(key)
+            return entry[1], True
+
+    def _memory_put(self, key: tuple, watermark: tuple, value):
+        if self.max_entries <= 0:
+            return
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (watermark, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.stats["evictions"] += 1
+            METRICS.gauge("query_cache_bytes", "Bytes held by the in-memory query cache").set(self._bytes)
+
+    # Disk tier: <query digest>-<watermark digest>.pkl, so a newer result
+    # can find and remove the files it supersedes
+
+    def _disk_path(self, key: tuple, watermark: tuple) -> Path:
+        return self.disk_dir / f"{_digest(key)}-{_digest(watermark)}.pkl"
+
+    def _disk_get(self, key: tuple, watermark: tuple) -> tuple:
+        if self.disk_dir is None:
+            return None, False
+        path = self._disk_path(key, watermark)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None, False
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Ignoring unreadable cache file {path.name}: {e}")
+            return None, False
+        try:
+            os.utime(path)  # recency for the disk LRU
+        except OSError:
+            pass
+        return value, True
+
+    def _disk_put(self, key: tuple, watermark: tuple, value):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key, watermark)
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        for superseded in self.disk_dir.glob(f"{_digest(key)}-*.pkl"):
+            if superseded != path:
+                superseded.unlink(missing_ok=True)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = []
+        for path in self.disk_dir.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # removed by another process
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.disk_dir is not None:
+            for path in self.disk_dir.glob("*.pkl"):
+                path.unlink(missing_ok=True)
+
+
+def cached_query(method):
+    """Serve a BusAnalytics method through the instance's cache, if it has one
+
+    Arguments are bound against the signature first, so calls that differ
+    only in spelling out a default share an entry.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = tuple((name, repr(value)) for name, value in list(bound.arguments.items())[1:])
+        key = (self.db_key, method.__name__, params)
+        return self.cache.get_or_compute(key, self.data_watermark(),
+                                         lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_cache() -> QueryCache:
+    """The process-wide cache, configured from QUERY_CACHE_*"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = QueryCache()
+        return _shared
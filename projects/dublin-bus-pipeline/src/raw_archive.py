@@ -0,0 +1,342 @@
+"""
+Raw Snapshot Archive
+Feed bodies are appended, each compressed on its own (one zstd frame or gzip
+member), to one file per day, raw_YYYY-MM-DD.zst or .gz. A JSON-lines
+index beside it, raw_YYYY-MM-DD.idx, records where each body starts and
+ends. Any snapshot can be read back with one seek, and the data file stays
+a valid stream for `zstd -d` or `zcat`. The index line is written after
+the body, so a crash mid-append leaves at most an unindexed tail. The next
+append truncates that tail.
+
+Replay re-ingests an archive, or a directory of the old per-file
+snapshots, through the collector's normal write path. A process pool
+decompresses and parses cycles; the main process writes them in collection
+order. The resulting database does not depend on the number of workers.
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from config import RAW_ARCHIVE_DIR, RAW_ARCHIVE_CODEC
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, only needed for RAW_ARCHIVE_CODEC=zstd
+    zstandard = None
+
+CODECS = {"zstd": ".zst", "gzip": ".gz"}
+FEEDS = ("vehicles", "updates")
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def _require_codec(codec: str):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown archive codec: {codec}")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError("RAW_ARCHIVE_CODEC=zstd needs zstandard: pip install zstandard")
+
+
+def compress(body: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    _require_codec(codec)
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _codec_of(path: Path) -> str:
+    return next(codec for codec, suffix in CODECS.items() if path.suffix == suffix)
+
+
+@dataclass(frozen=True)
+class SnapshotRef:
+    """Where one feed body is stored: a span of an archive file, or a whole plain file"""
+    path: str
+    format: str                 # "json" or "pb"
+    offset: int = None
+    length: int = None
+    codec: str = None
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            if self.offset is None:
+                return f.read()
+            f.seek(self.offset)
+            data = f.read(self.length)
+        return decompress(data, self.codec)
+
+
+@dataclass(frozen=True)
+class ReplayCycle:
+    """The snapshots saved by one collection cycle"""
+    collected_at: str
+    vehicles: SnapshotRef = None
+    updates: SnapshotRef = None
+
+
+# Writing
+
+class RawArchive:
+    """Appends feed bodies to the day's archive file"""
+
+    def __init__(self, directory=RAW_ARCHIVE_DIR, codec: str = RAW_ARCHIVE_CODEC):
+        self.directory = Path(directory)
+        self.codec = codec or default_codec()
+        _require_codec(self.codec)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._ends = {}     # data file -> end of its last indexed body
+        self._lock = threading.Lock()
+
+    def paths(self, day: str) -> tuple:
+        return (self.directory / f"raw_{day}{CODECS[self.codec]}",
+                self.directory / f"raw_{day}.idx")
+
+    def append(self, feed: str, body, collected_at: str, feed_format: str = "json",
+               feed_timestamp=None) -> int:
+        """Append one feed body (bytes, or a decoded JSON feed) and return its
+        compressed size; `collected_at` groups the feeds of one cycle"""
+        if not isinstance(body, bytes):
+            body = json.dumps(body, separators=(",", ":")).encode()
+        data = compress(body, self.codec)
+        data_path, index_path = self.paths(collected_at[:10])
+        with self._lock:
+            end = self._recover(data_path, index_path)
+            with open(data_path, "ab") as f:
+                f.write(data)
+            entry = {"feed": feed, "collected_at": collected_at, "format": feed_format,
+                     "feed_timestamp": feed_timestamp, "offset": end, "length": len(data),
+                     "size": len(body)}
+            with open(index_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self._ends[data_path] = end + len(data)
+        return len(data)
+
+    def _recover(self, data_path: Path, index_path: Path) -> int:
+        """End of the last indexed body, dropping any unindexed tail after it"""
+        end = self._ends.get(data_path)
+        if end is None:
+            entries = read_index(index_path) if index_path.exists() else []
+            end = max((e["offset"] + e["length"] for e in entries), default=0)
+        if data_path.exists() and data_path.stat().st_size > end:
+            print(f"Truncating unindexed tail of {data_path.name} at {end:,} bytes")
+            os.truncate(data_path, end)
+        return end
+
+
+def read_index(index_path: Path) -> list:
+    """Index entries of one day; a torn final line is ignored"""
+    entries = []
+    with open(index_path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return entries
+
+
+# Reading
+
+def _archive_cycles(directory: Path) -> list:
+    cycles = {}
+    for index_path in sorted(directory.glob("raw_*.idx")):
+        data_path = next((index_path.with_suffix(suffix) for suffix in CODECS.values()
+                          if index_path.with_suffix(suffix).exists()), None)
+        if data_path is None:
+            continue
+        size = data_path.stat().st_size
+        for entry in read_index(index_path):
+            if entry["offset"] + entry["length"] > size:
+                continue  # indexed, but the body never made it to disk
+            ref = SnapshotRef(str(data_path), entry["format"], entry["offset"], entry["length"],
+                              _codec_of(data_path))
+            cycles.setdefault(entry["collected_at"], {})[entry["feed"]] = ref
+    return [ReplayCycle(collected_at, **feeds) for collected_at, feeds in cycles.items()]
+
+
+def _file_cycles(directory: Path) -> list:
+    """Cycles from <feed>_YYYYmmdd_HHMMSS.json/.pb files, paired by timestamp"""
+    cycles = {}
+    for path in sorted(directory.iterdir()):
+        if path.suffix not in (".json", ".pb") or path.stem.count("_") != 2:
+            continue
+        feed, stamp = path.stem.split("_", 1)
+        if feed not in FEEDS:
+            continue
+        try:
+            collected_at = str(datetime.strptime(stamp, "%Y%m%d_%H%M%S"))
+        except ValueError:
+            continue
+        ref = SnapshotRef(str(path), "pb" if path.suffix == ".pb" else "json")
+        cycles.setdefault(collected_at, {})[feed] = ref
+    return [ReplayCycle(collected_at, **feeds) for collected_at, feeds in cycles.items()]
+
+
+def find_cycles(source: Path, start: str = None, end: str = None) -> list:
+    """Replayable cycles in an archive directory or a raw snapshot directory, oldest first"""
+    source = Path(source)
+    if any(source.glob("raw_*.idx")):
+        cycles = _archive_cycles(source)
+    else:
+        cycles = _file_cycles(source)
+    cycles = [c for c in cycles if (start is None or c.collected_at >= start)
+              and (end is None or c.collected_at[:len(end)] <= end)]
+    return sorted(cycles, key=lambda c: c.collected_at)
+
+
+def _parse(ref: SnapshotRef, feed: str, parser: str):
+    if ref is None:
+        return []
+    from data_collector import DataCollector
+    from protobuf_feed import parse_vehicle_positions_pb, parse_trip_updates_pb
+    from stream_parser import parse_vehicle_positions_stream, parse_trip_updates_stream
+
+    body = ref.read()
+    if ref.format == "pb":
+        pb_parser = parse_vehicle_positions_pb if feed == "vehicles" else parse_trip_updates_pb
+        return pb_parser(body)[1]
+    if parser == "stream":
+        stream_parser = parse_vehicle_positions_stream if feed == "vehicles" else parse_trip_updates_stream
+        return stream_parser(body)[1]
+    dict_parser = (DataCollector.parse_vehicle_positions if feed == "vehicles"
+                   else DataCollector.parse_trip_updates)
+    return dict_parser(json.loads(body))
+
+
+def parse_cycle(cycle: ReplayCycle, parser: str = "dict") -> tuple:
+    """(collected_at, positions, updates) of one cycle; runs in the worker processes"""
+    return cycle.collected_at, _parse(cycle.vehicles, "vehicles", parser), _parse(cycle.updates, "updates", parser)
+
+
+# Replay
+
+def replay(cycles: list, collector, workers: int = None, parser: str = "dict") -> dict:
+    """Write `cycles` through collector.save_to_database in the order given
+
+    Parsing runs ahead on `workers` processes (0 parses inline), with at
+    most two cycles per worker waiting, so memory stays bounded however
+    long the archive is.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    totals = {"cycles": 0, "positions": 0, "updates": 0}
+    start = time.perf_counter()
+
+    def write(parsed):
+        collected_at, positions, updates = parsed
+        saved_positions, saved_updates = collector.save_to_database(positions, updates, collected_at=collected_at)
+        totals["cycles"] += 1
+        totals["positions"] += saved_positions
+        totals["updates"] += saved_updates
+        if totals["cycles"] % 50 == 0:
+            rows = totals["positions"] + totals["updates"]
+            print(f"  {totals['cycles']:,} cycles, {rows:,} rows "
+                  f"({rows / (time.perf_counter() - start):,.0f} rows/s)")
+
+    if workers == 0:
+        for cycle in cycles:
+            write(parse_cycle(cycle, parser))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque()
+            for cycle in cycles:
+                pending.append(pool.submit(parse_cycle, cycle, parser))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+
+    totals["seconds"] = time.perf_counter() - start
+    return totals
+
+
+def pack(source: Path, archive: RawArchive) -> dict:
+    """Append a directory of per-file snapshots to the archive"""
+    written = {"files": 0, "bytes_in": 0, "bytes_out": 0}
+    for cycle in find_cycles(source):
+        for feed in FEEDS:
+            ref = getattr(cycle, feed)
+            if ref is None:
+                continue
+            body = ref.read()
+            if ref.format == "json":
+                body = json.loads(body)
+            written["bytes_in"] += Path(ref.path).stat().st_size
+            written["bytes_out"] += archive.append(feed, body, cycle.collected_at, ref.format)
+            written["files"] += 1
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import DATABASE_PATH, FEED_PARSER, HISTORY_DIR, RAW_DATA_DIR, TRIP_UPDATES_INGEST_MODE
+
+    parser = argparse.ArgumentParser(description="Compressed raw snapshot archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = sub.add_parser("replay", help="Re-ingest an archive or a raw snapshot directory")
+    replay_parser.add_argument("--source", type=Path, default=RAW_ARCHIVE_DIR,
+                               help=f"Archive or snapshot directory (e.g. {RAW_DATA_DIR})")
+    replay_parser.add_argument("--db", type=Path, default=DATABASE_PATH)
+    replay_parser.add_argument("--workers", type=int, default=None,
+                               help="Parser processes (default: one per CPU, 0 = parse inline)")
+    replay_parser.add_argument("--parser", choices=["dict", "stream"], default=FEED_PARSER)
+    replay_parser.add_argument("--mode", choices=["full", "cdc"], default=TRIP_UPDATES_INGEST_MODE)
+    replay_parser.add_argument("--start", help="First collected_at to replay (e.g. 2026-01-30)")
+    replay_parser.add_argument("--end", help="Last collected_at to replay")
+    replay_parser.add_argument("--include-existing", action="store_true",
+                               help="Also replay cycles whose collected_at is already in the database")
+
+    pack_parser = sub.add_parser("pack", help="Append per-file snapshots to the archive")
+    pack_parser.add_argument("--source", type=Path, default=RAW_DATA_DIR)
+    pack_parser.add_argument("--archive", type=Path, default=RAW_ARCHIVE_DIR)
+    pack_parser.add_argument("--codec", choices=list(CODECS), default=RAW_ARCHIVE_CODEC)
+
+    list_parser = sub.add_parser("list", help="Summarize the archive by day")
+    list_parser.add_argument("--archive", type=Path, default=RAW_ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        from data_collector import DataCollector
+
+        cycles = find_cycles(args.source, args.start, args.end)
+        collector = DataCollector(ingest_mode=args.mode, db_path=args.db, history_dir=HISTORY_DIR,
+                                  snapshot_sink="files")
+        if not args.include_existing:
+            existing = {value for (value,) in collector.writer.conn.execute("SELECT collected_at FROM ingest_cycles")}
+            skipped = sum(c.collected_at in existing for c in cycles)
+            cycles = [c for c in cycles if c.collected_at not in existing]
+            if skipped:
+                print(f"Skipping {skipped:,} cycles already in the database")
+        print(f"Replaying {len(cycles):,} cycles from {args.source}")
+        totals = replay(cycles, collector, args.workers, args.parser)
+        collector.writer.close()
+        collector.fetcher.close()
+        rows = totals["positions"] + totals["updates"]
+        print(f"Replayed {totals['cycles']:,} cycles, {rows:,} rows in {totals['seconds']:.1f}s "
+              f"({rows / max(totals['seconds'], 1e-9):,.0f} rows/s)")
+    elif args.command == "pack":
+        written = pack(args.source, RawArchive(args.archive, args.codec))
+        print(f"Packed {written['files']} snapshots: {written['bytes_in'] / 1e6:,.1f} MB -> "
+              f"{written['bytes_out'] / 1e6:,.1f} MB")
+    else:
+        for index_path in sorted(args.archive.glob("raw_*.idx")):
+            entries = read_index(index_path)
+            size = sum(e["size"] for e in entries)
+            stored = sum(e["length"] for e in entries)
+            cycles = len({e["collected_at"] for e in entries})
+            print(f"{index_path.stem[4:]}: {cycles:,} cycles, {len(entries):,} snapshots, "
+                  f"{size / 1e6:,.1f} MB -> {stored / 1e6:,.1f} MB")
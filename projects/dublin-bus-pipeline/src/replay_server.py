@@ -0,0 +1,374 @@
+"""
+GTFS-RT Replay Server
+A local stand-in for the TFI API: serves the data/raw snapshots (optionally
+scaled up) at the same /Vehicles and /TripUpdates paths, in JSON or
+protobuf, re-headed with a fresh feed timestamp as they rotate. Latency,
+bandwidth throttling, error injection and gzip are configurable, and a
+load-test mode drives the whole collector against it to measure sustained
+cycles/sec and ingest lag.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+from config import RAW_DATA_DIR
+
+try:
+    from google.transit import gtfs_realtime_pb2
+    from google.protobuf import json_format
+except ImportError:  # optional dependency, only needed to serve protobuf
+    gtfs_realtime_pb2 = None
+    json_format = None
+
+FEED_PATHS = {"Vehicles": "vehicles", "TripUpdates": "updates"}
+ERROR_KINDS = ("500", "503", "429", "reset", "truncate")
+
+
+def scale_vehicles(feed: dict, scale: int) -> dict:
+    """The feed with each vehicle repeated `scale` times under new ids, slightly offset"""
+    if scale == 1:
+        return feed
+    entities = []
+    for copy_index in range(scale):
+        for entity in feed.get("entity", []):
+            vehicle = dict(entity.get("vehicle", {}))
+            trip = dict(vehicle.get("trip", {}))
+            position = dict(vehicle.get("position", {}))
+            if copy_index:
+                vehicle["vehicle"] = {"id": f"{vehicle.get('vehicle', {}).get('id')}-{copy_index}"}
+                trip["trip_id"] = f"{trip.get('trip_id')}-{copy_index}"
+                if position.get("latitude") is not None:
+                    position["latitude"] += copy_index * 1e-4
+                    position["longitude"] += copy_index * 1e-4
+            vehicle.update(trip=trip, position=position)
+            entities.append({**entity, "id": f"{entity.get('id')}-{copy_index}", "vehicle": vehicle})
+    return {**feed, "entity": entities}
+
+
+def scale_updates(feed: dict, scale: int) -> dict:
+    """The feed with each trip update repeated `scale` times under new trip ids"""
+    if scale == 1:
+        return feed
+    entities = []
+    for copy_index in range(scale):
+        for entity in feed.get("entity", []):
+            trip_update = dict(entity.get("trip_update", {}))
+            trip = dict(trip_update.get("trip", {}))
+            if copy_index:
+                trip["trip_id"] = f"{trip.get('trip_id')}-{copy_index}"
+            # stop_time_update lists are shared; parsing only reads them
+            trip_update["trip"] = trip
+            entities.append({**entity, "id": f"{entity.get('id')}-{copy_index}", "trip_update": trip_update})
+    return {**feed, "entity": entities}
+
+
+class ReplayFeeds:
+    """Recorded snapshots served in rotation under fresh header timestamps
+
+    With advance_seconds=0 every request publishes the next snapshot; with a
+    positive value the feed moves on once per period (like the live API), so
+    faster polls see an unchanged timestamp. Entity bodies are serialized
+    once per snapshot and only the header is rebuilt per generation.
+    """
+
+    def __init__(self, raw_dir: Path = RAW_DATA_DIR, scale: int = 1, advance_seconds: float = 0.0):
+        self.advance_seconds = advance_seconds
+        self.started = time.time()
+        self.entities = {"vehicles": [], "updates": []}
+        for path in sorted(raw_dir.glob("vehicles_*.json")):
+            updates_path = raw_dir / path.name.replace("vehicles_", "updates_")
+            with open(path) as f:
+                self.entities["vehicles"].append(scale_vehicles(json.load(f), scale)["entity"])
+            if updates_path.exists():
+                with open(updates_path) as f:
+                    self.entities["updates"].append(scale_updates(json.load(f), scale)["entity"])
+        if not self.entities["vehicles"]:
+            raise FileNotFoundError(f"No vehicles_*.json snapshots in {raw_dir}")
+
+        self._lock = threading.Lock()
+        self._bodies = {}
+        self._generation = {name: -1 for name in self.entities}
+        self._timestamp = {name: 0 for name in self.entities}
+        self.published_at = {name: {} for name in self.entities}
+
+    def _entity_body(self, name: str, index: int, fmt: str) -> bytes:
+        key = (name, index, fmt)
+        if key not in self._bodies:
+            entities = self.entities[name][index]
+            if fmt == "json":
+                self._bodies[key] = json.dumps(entities).encode()
+            else:
+                # Repeated fields of concatenated messages append, so the
+                # entities can be serialized once without a header
+                message = json_format.ParseDict({"entity": entities}, gtfs_realtime_pb2.FeedMessage(),
+                                                ignore_unknown_fields=True)
+                self._bodies[key] = message.SerializePartialToString()
+        return self._bodies[key]
+
+    def _advance(self, name: str) -> tuple:
+        """(generation, header timestamp) of the feed as of now"""
+        now = time.time()
+        with self._lock:
+            if self.advance_seconds > 0:
+                generation = int((now - self.started) // self.advance_seconds)
+            else:
+                generation = self._generation[name] + 1
+            if generation != self._generation[name]:
+                # Feed timestamps are whole seconds and must change with every generation
+                self._generation[name] = generation
+                self._timestamp[name] = max(int(now), self._timestamp[name] + 1)
+                self.published_at[name][str(self._timestamp[name])] = now
+            return generation, self._timestamp[name]
+
+    def body(self, name: str, fmt: str) -> bytes:
+        generation, timestamp = self._advance(name)
+        snapshots = self.entities[name]
+        entities = self._entity_body(name, generation % len(snapshots), fmt)
+        header = {"gtfs_realtime_version": "2.0", "incrementality": "FULL_DATASET", "timestamp": str(timestamp)}
+        if fmt == "json":
+            return b'{"header": ' + json.dumps(header).encode() + b', "entity": ' + entities + b"}"
+        message = json_format.ParseDict({"header": header}, gtfs_realtime_pb2.FeedMessage())
+        return message.SerializeToString() + entities
+
+
+@dataclass
+class Faults:
+    """Network conditions applied to every response"""
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    bandwidth_kbps: float = 0.0     # 0 = unthrottled
+    error_rate: float = 0.0
+    error_kinds: tuple = ERROR_KINDS
+
+
+def _handler(feeds: ReplayFeeds, faults: Faults, use_gzip: bool, stats: dict):
+    lock = threading.Lock()
+
+    def count(**amounts):
+        with lock:
+            for key, amount in amounts.items():
+                stats[key] += amount
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            name = FEED_PATHS.get(url.path.rstrip("/").rsplit("/", 1)[-1])
+            if name is None:
+                self.send_error(404)
+                return
+            fmt = "json" if parse_qs(url.query).get("format") == ["json"] else "protobuf"
+            if fmt == "protobuf" and gtfs_realtime_pb2 is None:
+                self.send_error(501, "Serving protobuf needs gtfs-realtime-bindings")
+                return
+
+            delay = faults.latency_ms + random.uniform(-faults.jitter_ms, faults.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+            error = None
+            if faults.error_rate and random.random() < faults.error_rate:
+                error = random.choice(faults.error_kinds)
+                count(errors=1)
+            if error == "reset":
+                self.close_connection = True
+                self.connection.close()
+                return
+            if error in ("500", "503", "429"):
+                self.send_error(int(error))
+                return
+
+            body = feeds.body(name, fmt)
+            encoded = use_gzip and "gzip" in self.headers.get("Accept-Encoding", "")
+            if encoded:
+                body = gzip.compress(body, compresslevel=6)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json" if fmt == "json" else "application/x-protobuf")
+            if encoded:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            if error == "truncate":
+                body = body[:len(body) // 2]
+                self.close_connection = True
+            self._write(body)
+            count(requests=1, bytes=len(body))
+
+        def _write(self, body: bytes):
+            if not faults.bandwidth_kbps:
+                self.wfile.write(body)
+                return
+            # Pace 10 chunks a second at the configured rate
+            chunk = max(1, int(faults.bandwidth_kbps * 1000 / 8 / 10))
+            start = time.perf_counter()
+            for offset in range(0, len(body), chunk):
+                self.wfile.write(body[offset:offset + chunk])
+                due = start + (offset + chunk) * 8 / (faults.bandwidth_kbps * 1000)
+                pause = due - time.perf_counter()
+                if pause > 0:
+                    time.sleep(pause)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ReplayServer:
+    """Serves ReplayFeeds from a background thread; base_url stands in for TFI_BASE_URL"""
+
+    def __init__(self, feeds: ReplayFeeds, faults: Faults = None, host: str = "127.0.0.1",
+                 port: int = 0, use_gzip: bool = True):
+        self.feeds = feeds
+        self.faults = faults or Faults()
+        self.stats = {"requests": 0, "errors": 0, "bytes": 0}
+        self.server = ThreadingHTTPServer((host, port), _handler(feeds, self.faults, use_gzip, self.stats))
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}/gtfsr/v2"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="replay", daemon=True)
+
+    def start(self) -> "ReplayServer":
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else float("nan")
+
+
+def load_test(cycles: int, interval: float = 0.0, scale: int = 1, advance_seconds: float = 0.0,
+              faults: Faults = None, use_gzip: bool = True, db_path: Path = None,
+              pipelined: bool = False, **collector_options) -> dict:
+    """Run the collector against a local replay server and measure throughput and lag
+
+    Ingest lag is the time from the server publishing a feed generation to
+    the cycle that ingested it committing. interval=0 runs cycles back to
+    back to find the sustained maximum rate; with pipelined that is the
+    fetch rate, and cycles the writer could not keep up with are dropped.
+    """
+    import tempfile
+    from data_collector import DataCollector
+    from pipeline import IngestPipeline
+    from scheduler import FixedRateScheduler
+
+    server = ReplayServer(ReplayFeeds(RAW_DATA_DIR, scale, advance_seconds), faults,
+                          use_gzip=use_gzip).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Nothing the load test ingests reaches the real archive or history tier
+        options = {"snapshot_sink": "files", "history_dir": None, **collector_options}
+        collector = DataCollector(db_path=db_path or Path(tmp) / "loadtest.db",
+                                  base_url=server.base_url, **options)
+        lags = {name: [] for name in collector.endpoints}
+        seen = {}
+        rows = 0
+
+        def record(positions: int, updates: int, timestamps: dict):
+            nonlocal rows
+            committed = time.time()
+            rows += positions + updates
+            for name, timestamp in timestamps.items():
+                if timestamp is not None and timestamp != seen.get(name):
+                    seen[name] = timestamp
+                    lags[name].append(committed - server.feeds.published_at[name][str(timestamp)])
+
+        pipeline = None
+        if pipelined:
+            pipeline = IngestPipeline(collector, snapshot_every=None, on_written=lambda c: record(
+                len(c.positions), len(c.updates), c.feed_timestamps)).start()
+
+        def cycle(tick=None):
+            if pipeline is not None:
+                pipeline.submit(tick)
+                return
+            positions, updates = collector.collect()
+            record(positions, updates, dict(collector.fetcher.last_feed_timestamp))
+
+        start = time.perf_counter()
+        try:
+            if interval > 0:
+                schedule = FixedRateScheduler(interval, align=False)
+                schedule.run(cycle, max_ticks=cycles,
+                             on_error=lambda e: print(f"Error during collection: {e}"))
+            else:
+                for _ in range(cycles):
+                    cycle()
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            elapsed = time.perf_counter() - start
+            collector.fetcher.close()
+            collector.writer.close()
+            server.close()
+
+    return {
+        "cycles": cycles,
+        "seconds": round(elapsed, 2),
+        "cycles_per_sec": round(cycles / elapsed, 2),
+        "rows_per_sec": round(rows / elapsed),
+        "server": dict(server.stats),
+        "lag_ms": {
+            name: {"samples": len(values),
+                   "p50": round(_percentile(values, 0.5) * 1000, 1),
+                   "p95": round(_percentile(values, 0.95) * 1000, 1),
+                   "max": round(max(values, default=float("nan")) * 1000, 1)}
+            for name, values in lags.items()
+        },
+        **({"pipeline": {
+            stage.stage: {"processed": stage.processed, "failed": stage.errors,
+                          "dropped": stage.inbox.stats.dropped, "max_depth": stage.inbox.stats.max_depth}
+            for stage in pipeline.stages
+        }} if pipeline is not None else {}),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import FEED_PARSER, FEED_FORMAT
+
+    parser = argparse.ArgumentParser(description="Local GTFS-RT replay server")
+    parser.add_argument("command", choices=["serve", "loadtest"])
+    parser.add_argument("--port", type=int, default=8765, help="Port to serve on")
+    parser.add_argument("--scale", type=int, default=1, help="Entity multiplier")
+    parser.add_argument("--advance", type=float, default=0.0,
+                        help="Seconds between feed updates (0 = a new snapshot per request)")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--bandwidth-kbps", type=float, default=0.0, help="Throttle responses (0 = off)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--errors", nargs="+", choices=ERROR_KINDS, default=list(ERROR_KINDS),
+                        help="Failure kinds to inject")
+    parser.add_argument("--no-gzip", action="store_true")
+    parser.add_argument("--cycles", type=int, default=30, help="Load test cycles")
+    parser.add_argument("--interval", type=float, default=0.0,
+                        help="Load test cycle interval in seconds (0 = back to back)")
+    parser.add_argument("--parser", choices=["dict", "stream"], default=FEED_PARSER)
+    parser.add_argument("--format", choices=["json", "protobuf"], default=FEED_FORMAT)
+    parser.add_argument("--pipeline", action="store_true", help="Load test the pipelined collector")
+    args = parser.parse_args()
+
+    faults = Faults(args.latency_ms, args.jitter_ms, args.bandwidth_kbps, args.error_rate, tuple(args.errors))
+    if args.command == "serve":
+        server = ReplayServer(ReplayFeeds(RAW_DATA_DIR, args.scale, args.advance), faults,
+                              port=args.port, use_gzip=not args.no_gzip)
+        print(f"Serving {RAW_DATA_DIR} at {server.base_url} (set TFI_BASE_URL to use it)")
+        try:
+            server.server.serve_forever()
+        except KeyboardInterrupt:
+            server.server.server_close()
+    else:
+        result = load_test(args.cycles, args.interval, args.scale, args.advance, faults,
+                           use_gzip=not args.no_gzip, pipelined=args.pipeline,
+                           parser=args.parser, feed_format=args.format)
+        print(json.dumps(result, indent=2))
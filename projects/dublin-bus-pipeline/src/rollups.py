@@ -0,0 +1,211 @@
+"""
+Incremental Rollup Tables
+Per-route, per-time-bucket delay aggregates maintained inside each ingest
+transaction, so summary queries cost O(routes x buckets) instead of O(rows)
+"""
+import sqlite3
+from datetime import datetime
+import pandas as pd
+import partitions
+from metrics import (
+    DELAY_CATEGORIES, EARLY_MINS, ON_TIME_MINS, SLIGHT_MINS, MODERATE_MINS, category_codes
+)
+
+# Bucket name -> strftime format of the bucket start (also valid in SQLite)
+BUCKETS = {
+    "minute": "%Y-%m-%d %H:%M:00",
+    "hour": "%Y-%m-%d %H:00:00",
+}
+
+STAT_COLUMNS = ("count", "sum", "sum_sq", "min", "max", *DELAY_CATEGORIES)
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    """Create rollup tables"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS delay_rollups (
+            route_id TEXT NOT NULL,
+            bucket_size TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            sum REAL NOT NULL,
+            sum_sq REAL NOT NULL,
+            min REAL,
+            max REAL,
+            {", ".join(f"{name} INTEGER NOT NULL" for name in DELAY_CATEGORIES)},
+            PRIMARY KEY (bucket_size, bucket_start, route_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS seen_vehicles (
+            vehicle_id TEXT PRIMARY KEY,
+            first_seen TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS seen_routes (
+            route_id TEXT PRIMARY KEY,
+            first_seen TIMESTAMP
+        )
+    """)
+
+
+_UPSERT = f"""
+    INSERT INTO delay_rollups (route_id, bucket_size, bucket_start, {", ".join(STAT_COLUMNS)})
+    VALUES (?, ?, ?, {", ".join("?" for _ in STAT_COLUMNS)})
+    ON CONFLICT (bucket_size, bucket_start, route_id) DO UPDATE SET
+        count = count + excluded.count,
+        sum = sum + excluded.sum,
+        sum_sq = sum_sq + excluded.sum_sq,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max),
+        {", ".join(f"{name} = {name} + excluded.{name}" for name in DELAY_CATEGORIES)}
+"""
+
+
+def aggregate_delays(updates: pd.DataFrame) -> pd.DataFrame:
+    """Per-route rollup stats for one batch of trip updates"""
+    delays = pd.to_numeric(updates["arrival_delay"], errors="coerce").astype("float64")
+    frame = pd.DataFrame({
+        "route_id": updates["route_id"].fillna("").astype(object),
+        "delay": delays,
+    }).dropna(subset=["delay"])
+
+    categories = category_codes(frame["delay"].to_numpy() / 60)
+    for index, name in enumerate(DELAY_CATEGORIES):
+        frame[name] = categories == index
+    frame["delay_sq"] = frame["delay"] ** 2
+
+    return frame.groupby("route_id").agg(
+        count=("delay", "size"),
+        sum=("delay", "sum"),
+        sum_sq=("delay_sq", "sum"),
+        min=("delay", "min"),
+        max=("delay", "max"),
+        **{name: (name, "sum") for name in DELAY_CATEGORIES}
+    )
+
+
+def update_rollups(conn: sqlite3.Connection, cycle):
+    """Ingest hook: fold one cycle into the rollup tables"""
+    collected = datetime.fromisoformat(cycle.collected_at)
+
+    if len(cycle.updates):
+        stats = aggregate_delays(cycle.updates_frame)
+        rows = [
+            (route_id, bucket, collected.strftime(fmt),
+             *(v.item() if hasattr(v, "item") else v for v in values))
+            for bucket, fmt in BUCKETS.items()
+            for route_id, values in zip(stats.index, stats[list(STAT_COLUMNS)].itertuples(index=False))
+        ]
+        conn.executemany(_UPSERT, rows)
+
+    if len(cycle.positions):
+        positions = cycle.positions_frame
+        conn.executemany(
+            "INSERT OR IGNORE INTO seen_vehicles (vehicle_id, first_seen) VALUES (?, ?)",
+            ((v, cycle.collected_at) for v in positions["vehicle_id"].dropna().unique())
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO seen_routes (route_id, first_seen) VALUES (?, ?)",
+            ((r, cycle.collected_at) for r in positions["route_id"].dropna().unique())
+        )
+
+
+def _category_sql(column: str) -> str:
+    """SUM() per delay category for a column of delays in seconds"""
+    early, on_time, slight, moderate = (60 * m for m in (EARLY_MINS, ON_TIME_MINS, SLIGHT_MINS, MODERATE_MINS))
+    conditions = [
+        f"{column} < {early}",
+        f"{column} >= {early} AND {column} <= {on_time}",
+        f"{column} > {on_time} AND {column} <= {slight}",
+        f"{column} > {slight} AND {column} <= {moderate}",
+        f"{column} > {moderate}",
+    ]
+    return ", ".join(f"SUM({condition})" for condition in conditions)
+
+
+def backfill(conn: sqlite3.Connection):
+    """Rebuild every rollup from the raw rows, in the main database and in day files
+
+    Expired days only have downsampled positions left, so their rollups and
+    first sightings are kept as they are. ingest_cycles is only added to:
+    existing cycles keep their ids, and cycles found in the raw rows without
+    one get an entry.
+    """
+    partitions.clear_rebuildable(conn, "delay_rollups")
+    partitions.clear_rebuildable(conn, "seen_vehicles", "first_seen")
+    partitions.clear_rebuildable(conn, "seen_routes", "first_seen")
+
+    cycles = []
+    with partitions.range_sources(conn) as sources:
+        for source in sources:
+            for bucket, fmt in BUCKETS.items():
+                conn.executemany(_UPSERT, source.execute(f"""
+                    SELECT COALESCE(route_id, ''), ?, strftime(?, collected_at),
+                           COUNT(*), SUM(arrival_delay), SUM(arrival_delay * arrival_delay),
+                           MIN(arrival_delay), MAX(arrival_delay), {_category_sql("arrival_delay")}
+                    FROM trip_updates
+                    WHERE arrival_delay IS NOT NULL
+                    GROUP BY 1, 3
+                """, (bucket, fmt)).fetchall())
+
+            # Older cycles stamped positions and updates separately, so each
+            # distinct timestamp becomes its own catalog entry
+            cycles += source.execute("""
+                SELECT collected_at, SUM(positions), SUM(updates) FROM (
+                    SELECT collected_at, COUNT(*) AS positions, 0 AS updates
+                    FROM vehicle_positions GROUP BY collected_at
+                    UNION ALL
+                    SELECT collected_at, 0, COUNT(*) FROM trip_updates GROUP BY collected_at
+                )
+                GROUP BY collected_at
+            """).fetchall()
+            for table, column in (("seen_vehicles", "vehicle_id"), ("seen_routes", "route_id")):
+                _upsert_first_seen(conn, table, column, source.execute(f"""
+                    SELECT {column}, MIN(collected_at) FROM vehicle_positions
+                    WHERE {column} IS NOT NULL GROUP BY {column}
+                """).fetchall())
+
+    known = {collected_at for (collected_at,) in conn.execute("SELECT collected_at FROM ingest_cycles")}
+    conn.executemany(
+        "INSERT INTO ingest_cycles (collected_at, position_count, update_count) VALUES (?, ?, ?)",
+        sorted(cycle for cycle in cycles if cycle[0] not in known)
+    )
+    conn.commit()
+
+
+def _upsert_first_seen(conn: sqlite3.Connection, table: str, column: str, rows: list):
+    conn.executemany(f"""
+        INSERT INTO {table} ({column}, first_seen) VALUES (?, ?)
+        ON CONFLICT ({column}) DO UPDATE SET first_seen = MIN(first_seen, excluded.first_seen)
+    """, rows)
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    """Backfill once for databases that predate the rollup tables"""
+    if conn.execute("SELECT 1 FROM ingest_cycles LIMIT 1").fetchone():
+        return False
+    has_data = (conn.execute("SELECT 1 FROM vehicle_positions LIMIT 1").fetchone()
+                or conn.execute("SELECT 1 FROM trip_updates LIMIT 1").fetchone())
+    if not has_data:
+        return False
+    print("Backfilling rollup tables from existing data...")
+    backfill(conn)
+    return True
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import DATABASE_PATH
+
+    parser = argparse.ArgumentParser(description="Maintain rollup tables")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild all rollups from raw rows, including day files")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        conn = sqlite3.connect(DATABASE_PATH)
+        backfill(conn)
+        count = conn.execute("SELECT COUNT(*) FROM delay_rollups").fetchone()[0]
+        print(f"Rebuilt {count:,} rollup rows")
+        conn.close()
@@ -0,0 +1,126 @@
+"""
+Fixed-Rate Collection Scheduler
+Runs a task on wall-clock aligned ticks (e.g. :00, :15, :30, :45 for a 15 s
+interval) so the period never drifts with cycle duration. A cycle that
+overruns coalesces the ticks it missed instead of queueing them, and failing
+endpoints back off exponentially with jitter.
+"""
+import math
+import random
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class Backoff:
+    """Exponential backoff with full jitter for one endpoint"""
+    base_seconds: float = 5.0
+    max_seconds: float = 300.0
+    failures: int = 0
+    retry_at: float = 0.0
+
+    def ready(self, now: float = None) -> bool:
+        return (time.time() if now is None else now) >= self.retry_at
+
+    def failure(self, now: float = None) -> float:
+        """Record a failure and return how long to wait before the next attempt"""
+        self.failures += 1
+        ceiling = min(self.max_seconds, self.base_seconds * 2 ** (self.failures - 1))
+        wait = random.uniform(0, ceiling)
+        self.retry_at = (time.time() if now is None else now) + wait
+        return wait
+
+    def success(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+@dataclass
+class SchedulerStats:
+    """Cadence and lag of the ticks actually run"""
+    interval: float
+    ticks_run: int = 0
+    ticks_skipped: int = 0
+    failures: int = 0
+    total_lag: float = 0.0
+    max_lag: float = 0.0
+    total_duration: float = 0.0
+    max_duration: float = 0.0
+    first_start: float = None
+    last_start: float = None
+
+    def record(self, lag: float, started: float, duration: float):
+        self.ticks_run += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        if self.first_start is None:
+            self.first_start = started
+        self.last_start = started
+
+    @property
+    def avg_lag(self) -> float:
+        return self.total_lag / self.ticks_run if self.ticks_run else 0.0
+
+    @property
+    def avg_duration(self) -> float:
+        return self.total_duration / self.ticks_run if self.ticks_run else 0.0
+
+    @property
+    def achieved_interval(self) -> float:
+        """Mean time between cycle starts"""
+        if self.ticks_run < 2:
+            return float("nan")
+        return (self.last_start - self.first_start) / (self.ticks_run - 1)
+
+    def summary(self) -> str:
+        return (f"{self.ticks_run} cycles, {self.ticks_skipped} ticks skipped, {self.failures} failed; "
+                f"cadence {self.achieved_interval:.2f}s (target {self.interval:g}s), "
+                f"lag avg {self.avg_lag * 1000:.0f} ms / max {self.max_lag * 1000:.0f} ms, "
+                f"cycle avg {self.avg_duration:.2f}s / max {self.max_duration:.2f}s")
+
+
+class FixedRateScheduler:
+    """Call task(tick_time) once per interval on wall-clock aligned ticks"""
+
+    def __init__(self, interval_seconds: float, align: bool = True,
+                 clock=time.time, sleep=time.sleep):
+        if interval_seconds <= 0:
+            raise ValueError("interval_seconds must be positive")
+        self.interval = interval_seconds
+        self.align = align
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = SchedulerStats(interval_seconds)
+
+    def first_tick(self, now: float) -> float:
+        if not self.align:
+            return now
+        return math.ceil(now / self.interval) * self.interval
+
+    def run(self, task, until: float = None, max_ticks: int = None, on_error=None):
+        """Run until the `until` timestamp or max_ticks cycles; task exceptions go to on_error"""
+        tick = self.first_tick(self.clock())
+        while (until is None or tick < until) and (max_ticks is None or self.stats.ticks_run < max_ticks):
+            wait = tick - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+
+            started = self.clock()
+            try:
+                task(tick)
+            except Exception as e:
+                self.stats.failures += 1
+                if on_error is None:
+                    raise
+                on_error(e)
+            finished = self.clock()
+            self.stats.record(started - tick, started, finished - started)
+
+            # If the cycle overran several ticks, run once at the latest one
+            # (starting late) and count the older ones as skipped
+            passed = math.floor((finished - tick) / self.interval)
+            self.stats.ticks_skipped += max(0, passed - 1)
+            tick += max(1, passed) * self.interval
+        return self.stats
@@ -0,0 +1,149 @@
+"""
+Spatial Index
+An SQLite R*Tree over vehicle_positions on (latitude, longitude, time),
+maintained inside each ingest transaction, plus the bounding-box and
+nearest-vehicle queries built on it
+"""
+import math
+import sqlite3
+import numpy as np
+import pandas as pd
+from partitions import range_sources
+
+EARTH_RADIUS_M = 6_371_000
+METERS_PER_DEGREE_LAT = 111_320
+
+# R*Tree stores 32-bit float bounds rounded outwards, so it returns a superset
+# of the matching rows; queries re-check the exact values on vehicle_positions
+_TIME = "CAST(strftime('%s', {}) AS INTEGER)"
+
+POSITION_FIELDS = "p.id, p.vehicle_id, p.route_id, p.latitude, p.longitude, p.collected_at, p.direction_id"
+
+
+def haversine_m(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Great-circle distance in metres (vectorized)"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype="float64")) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def radius_bbox(lat: float, lon: float, radius_m: float) -> tuple:
+    """(min_lat, min_lon, max_lat, max_lon) enclosing a circle around a point"""
+    dlat = radius_m / METERS_PER_DEGREE_LAT
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def create_tables(cursor: sqlite3.Cursor) -> bool:
+    """Create the R*Tree; returns False if this SQLite build lacks the module"""
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS positions_rtree USING rtree(
+                id,
+                min_lat, max_lat,
+                min_lon, max_lon,
+                min_t, max_t
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"Spatial index disabled: {e}")
+        return False
+    return True
+
+
+def _index_sql(where: str) -> str:
+    t = _TIME.format("collected_at")
+    return f"""
+        INSERT INTO positions_rtree (id, min_lat, max_lat, min_lon, max_lon, min_t, max_t)
+        SELECT id, latitude, latitude, longitude, longitude, {t}, {t}
+        FROM vehicle_positions
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND {where}
+    """
+
+
+def has_index(conn: sqlite3.Connection) -> bool:
+    return bool(conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'positions_rtree'"
+    ).fetchone())
+
+
+def update_index(conn: sqlite3.Connection, cycle):
+    """Ingest hook: index the cycle's positions"""
+    if len(cycle.positions) and has_index(conn):
+        conn.execute(_index_sql("collected_at = ?"), (cycle.collected_at,))
+
+
+def backfill(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM positions_rtree")
+    conn.execute(_index_sql("1"))
+    conn.commit()
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    if not has_index(conn) or conn.execute("SELECT 1 FROM positions_rtree LIMIT 1").fetchone():
+        return False
+    if not conn.execute("SELECT 1 FROM vehicle_positions LIMIT 1").fetchone():
+        return False
+    print("Building spatial index from existing data...")
+    backfill(conn)
+    return True
+
+
+def positions_in_bbox(conn: sqlite3.Connection, min_lat: float, min_lon: float,
+                      max_lat: float, max_lon: float, start=None, end=None) -> pd.DataFrame:
+    """Every position inside the box, optionally collected between start and end"""
+    exact = ["p.latitude BETWEEN ? AND ?", "p.longitude BETWEEN ? AND ?"]
+    params = [min_lat, max_lat, min_lon, max_lon]
+    if start is not None:
+        exact.append("p.collected_at >= ?")
+        params.append(str(start))
+    if end is not None:
+        exact.append("p.collected_at <= ?")
+        params.append(str(end))
+
+    scan = f"SELECT {POSITION_FIELDS} FROM vehicle_positions p WHERE {' AND '.join(exact)}"
+    with range_sources(conn, start, end) as sources:
+        # Day partitions have no R*Tree; their collected_at index narrows the scan
+        archived = [pd.read_sql(scan, source, params=params) for source in sources[:-1]]
+    archived = [frame for frame in archived if len(frame)]
+
+    if not has_index(conn):
+        current = pd.read_sql(scan, conn, params=params)
+        return pd.concat(archived + [current], ignore_index=True) if archived else current
+
+    coarse = ["r.max_lat >= ?", "r.min_lat <= ?", "r.max_lon >= ?", "r.min_lon <= ?"]
+    coarse_params = [min_lat, max_lat, min_lon, max_lon]
+    if start is not None:
+        coarse.append(f"r.max_t >= {_TIME.format('?')}")
+        coarse_params.append(str(start))
+    if end is not None:
+        coarse.append(f"r.min_t <= {_TIME.format('?')}")
+        coarse_params.append(str(end))
+
+    current = pd.read_sql(f"""
+        SELECT {POSITION_FIELDS}
+        FROM positions_rtree r
+        JOIN vehicle_positions p ON p.id = r.id
+        WHERE {' AND '.join(coarse + exact)}
+    """, conn, params=coarse_params + params)
+    return pd.concat(archived + [current], ignore_index=True) if archived else current
+
+
+def nearest_positions(conn: sqlite3.Connection, lat: float, lon: float, k: int = 10,
+                      start=None, end=None, initial_radius_m: float = 500,
+                      max_radius_m: float = 200_000) -> pd.DataFrame:
+    """The k vehicles closest to a point, each at its closest position in the window
+
+    Searches a box around the point and doubles its radius until k vehicles
+    are found within the radius (or max_radius_m is reached).
+    """
+    radius = initial_radius_m
+    while True:
+        found = positions_in_bbox(conn, *radius_bbox(lat, lon, radius), start=start, end=end)
+        found["distance_m"] = haversine_m(lat, lon, found["latitude"], found["longitude"])
+        closest = (found[found["distance_m"] <= radius]
+                   .sort_values(["distance_m", "collected_at"], ascending=[True, False])
+                   .drop_duplicates("vehicle_id"))
+        if len(closest) >= k or radius >= max_radius_m:
+            return closest.head(k).reset_index(drop=True)
+        radius *= 2
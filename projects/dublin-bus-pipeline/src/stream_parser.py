@@ -0,0 +1,335 @@
+"""
+Streaming GTFS-RT JSON Parser
+Walks the feed's entity[] array one entity at a time and writes fields
+straight into typed column buffers, so memory stays flat regardless of
+feed size and no per-record dicts are built
+"""
+import io
+import json
+from array import array
+import numpy as np
+import pandas as pd
+
+_WHITESPACE = " \t\n\r"
+
+
+class FeedStreamReader:
+    """Incrementally decodes a GTFS-RT JSON document from a file-like object
+
+    Only the entity currently being decoded is held in memory, plus one read
+    chunk of raw text.
+    """
+
+    def __init__(self, fp, chunk_size: int = 1 << 16):
+        if isinstance(fp, (bytes, bytearray)):
+            fp = io.BytesIO(fp)
+        if not isinstance(fp, io.TextIOBase):
+            fp = io.TextIOWrapper(fp, encoding="utf-8")
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.header = {}
+        self._started = False
+
+    def _fill(self) -> bool:
+        """Read one more chunk, dropping text that has already been consumed"""
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _next_char(self) -> str:
+        """Skip whitespace and return the next significant character without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of feed")
+
+    def _expect(self, chars: str) -> str:
+        char = self._next_char()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at offset {self.pos}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def _decode_value(self):
+        """Decode the next complete JSON value, reading more input if it is cut off"""
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A bare number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof or isinstance(value, (dict, list, str)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            if not self._fill():
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+
+    def peek_header(self) -> dict:
+        """Decode top-level members up to the entity array and return the header"""
+        for _ in self._members(stop_at_entity=True):
+            pass
+        return self.header
+
+    def _members(self, stop_at_entity: bool = False):
+        if not self._started:
+            self._expect("{")
+            self._started = True
+        while self._next_char() != "}":
+            key = self._decode_value()
+            self._expect(":")
+            if key == "entity":
+                if stop_at_entity:
+                    return
+                yield from self._entities()
+            else:
+                value = self._decode_value()
+                if key == "header":
+                    self.header = value
+            if self._expect(",}") == "}":
+                return
+
+    def _entities(self):
+        self._expect("[")
+        if self._next_char() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self._decode_value()
+            if self._expect(",]") == "]":
+                return
+
+    def entities(self):
+        """Yield each entity of the feed in order"""
+        yield from self._members()
+
+
+class ColumnBuffer:
+    """Append-only typed column storage for parsed feed records
+
+    Integer columns are int64 arrays with a validity mask, float columns use
+    NaN for missing values and string columns are interned Python lists.
+    """
+
+    schema = {}
+
+    def __init__(self):
+        self.columns = {}
+        self.valid = {}
+        for name, kind in self.schema.items():
+            if kind == "int":
+                self.columns[name] = array("q")
+                self.valid[name] = bytearray()
+            elif kind == "float":
+                self.columns[name] = array("d")
+            else:
+                self.columns[name] = []
+        self._strings = {}
+
+    def __len__(self) -> int:
+        first = next(iter(self.columns))
+        return len(self.columns[first])
+
+    def _str(self, value):
+        if value is None:
+            return None
+        return self._strings.setdefault(value, value)
+
+    def _int(self, name: str, value):
+        if value is None:
+            self.columns[name].append(0)
+            self.valid[name].append(0)
+        else:
+            self.columns[name].append(int(value))
+            self.valid[name].append(1)
+
+    def _float(self, name: str, value):
+        self.columns[name].append(float("nan") if value is None else float(value))
+
+    def append_row(self, *values):
+        """Append one record given as values in schema order"""
+        for (name, kind), value in zip(self.schema.items(), values):
+            if kind == "int":
+                self._int(name, value)
+            elif kind == "float":
+                self._float(name, value)
+            else:
+                self.columns[name].append(self._str(value))
+
+    def to_frame(self) -> pd.DataFrame:
+        """Build a DataFrame without going through per-row objects"""
+        data = {}
+        for name, kind in self.schema.items():
+            if kind == "int":
+                values = np.frombuffer(self.columns[name], dtype=np.int64)
+                mask = np.frombuffer(self.valid[name], dtype=np.uint8) == 0
+                data[name] = pd.arrays.IntegerArray(values.copy(), mask)
+            elif kind == "float":
+                data[name] = np.frombuffer(self.columns[name], dtype=np.float64).copy()
+            else:
+                data[name] = pd.array(self.columns[name], dtype=object)
+        return pd.DataFrame(data)
+
+    def rows(self):
+        """Iterate row tuples in schema order (e.g. for executemany)"""
+        columns = []
+        for name, kind in self.schema.items():
+            if kind == "int":
+                columns.append([v if ok else None for v, ok in zip(self.columns[name], self.valid[name])])
+            elif kind == "float":
+                columns.append([None if v != v else v for v in self.columns[name]])
+            else:
+                columns.append(self.columns[name])
+        return zip(*columns)
+
+    def to_records(self) -> list:
+        """Materialize as the list-of-dicts shape the dict parsers return"""
+        names = list(self.schema)
+        return [dict(zip(names, row)) for row in self.rows()]
+
+
+class VehiclePositionColumns(ColumnBuffer):
+    schema = {
+        "vehicle_id": "str",
+        "trip_id": "str",
+        "route_id": "str",
+        "latitude": "float",
+        "longitude": "float",
+        "timestamp": "int",
+        "start_time": "str",
+        "start_date": "str",
+        "direction_id": "int",
+    }
+
+    def add_entity(self, entity: dict):
+        vehicle = entity.get("vehicle", {})
+        trip = vehicle.get("trip", {})
+        position = vehicle.get("position", {})
+        cols = self.columns
+
+        cols["vehicle_id"].append(self._str(vehicle.get("vehicle", {}).get("id")))
+        cols["trip_id"].append(self._str(trip.get("trip_id")))
+        cols["route_id"].append(self._str(trip.get("route_id")))
+        self._float("latitude", position.get("latitude"))
+        self._float("longitude", position.get("longitude"))
+        self._int("timestamp", vehicle.get("timestamp"))
+        cols["start_time"].append(self._str(trip.get("start_time")))
+        cols["start_date"].append(self._str(trip.get("start_date")))
+        self._int("direction_id", trip.get("direction_id"))
+
+
+class TripUpdateColumns(ColumnBuffer):
+    schema = {
+        "trip_id": "str",
+        "route_id": "str",
+        "start_date": "str",
+        "start_time": "str",
+        "stop_sequence": "int",
+        "stop_id": "str",
+        "arrival_delay": "int",
+        "departure_delay": "int",
+        "timestamp": "int",
+        "arrival_time": "int",
+        "departure_time": "int",
+    }
+
+    def add_entity(self, entity: dict):
+        trip_update = entity.get("trip_update", {})
+        trip = trip_update.get("trip", {})
+        cols = self.columns
+
+        trip_id = self._str(trip.get("trip_id"))
+        route_id = self._str(trip.get("route_id"))
+        start_date = self._str(trip.get("start_date"))
+        start_time = self._str(trip.get("start_time"))
+        timestamp = trip_update.get("timestamp")
+
+        for stop_update in trip_update.get("stop_time_update", []):
+            cols["trip_id"].append(trip_id)
+            cols["route_id"].append(route_id)
+            cols["start_date"].append(start_date)
+            cols["start_time"].append(start_time)
+            self._int("stop_sequence", stop_update.get("stop_sequence"))
+            cols["stop_id"].append(self._str(stop_update.get("stop_id")))
+            arrival = stop_update.get("arrival", {})
+            departure = stop_update.get("departure", {})
+            self._int("arrival_delay", arrival.get("delay"))
+            self._int("departure_delay", departure.get("delay"))
+            self._int("timestamp", timestamp)
+            self._int("arrival_time", arrival.get("time"))
+            self._int("departure_time", departure.get("time"))
+
+
+def parse_feed_stream(fp, columns_class) -> tuple:
+    """Stream a feed into a column buffer, returning (header, columns)"""
+    reader = FeedStreamReader(fp)
+    columns = columns_class()
+    for entity in reader.entities():
+        columns.add_entity(entity)
+    return reader.header, columns
+
+
+def parse_vehicle_positions_stream(fp) -> tuple:
+    return parse_feed_stream(fp, VehiclePositionColumns)
+
+
+def parse_trip_updates_stream(fp) -> tuple:
+    return parse_feed_stream(fp, TripUpdateColumns)
+
+
+def peek_feed_timestamp(content: bytes):
+    """Read only as far as the header to get the feed timestamp"""
+    return FeedStreamReader(content, chunk_size=4096).peek_header().get("timestamp")
+
+
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+    from config import RAW_DATA_DIR
+    from data_collector import DataCollector
+
+    def measure(func):
+        tracemalloc.start()
+        start = time.perf_counter()
+        count = func()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return count, elapsed, peak
+
+    def dict_path(path, parse):
+        with open(path) as f:
+            records = parse(json.load(f))
+        return len(pd.DataFrame(records))
+
+    def stream_path(path, parse):
+        with open(path, "rb") as f:
+            _, columns = parse(f)
+        return len(columns.to_frame())
+
+    print(f"{'snapshot':<32} {'path':<7} {'records':>8} {'rec/s':>11} {'peak MB':>8}")
+    for path in sorted(RAW_DATA_DIR.glob("*.json")):
+        if path.name.startswith("vehicles"):
+            parsers = (DataCollector.parse_vehicle_positions, parse_vehicle_positions_stream)
+        else:
+            parsers = (DataCollector.parse_trip_updates, parse_trip_updates_stream)
+
+        for label, run in (("dict", lambda: dict_path(path, parsers[0])),
+                           ("stream", lambda: stream_path(path, parsers[1]))):
+            count, elapsed, peak = measure(run)
+            print(f"{path.name:<32} {label:<7} {count:>8,} {count / elapsed:>11,.0f} {peak / 1e6:>8.1f}")
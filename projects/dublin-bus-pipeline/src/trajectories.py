@@ -0,0 +1,209 @@
+"""
+Vehicle Trajectories
+Per-vehicle tracks held as compact NumPy (time, lat, lon) arrays, loaded
+with parameterized queries on the (vehicle, collected_at) index, with
+vectorized kinematics and simplification for rendering
+"""
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from operator import itemgetter
+import numpy as np
+import pandas as pd
+from partitions import range_sources, expired_days
+from dimensions import POSITIONS_BY_VEHICLE, is_encoded
+from spatial_index import haversine_m, METERS_PER_DEGREE_LAT
+
+
+def bearing_deg(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Initial compass bearing in degrees (0 = north), vectorized"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype="float64")) for v in (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+@dataclass
+class Track:
+    """One vehicle's positions in time order, one point per GPS fix"""
+    vehicle_id: str
+    times: np.ndarray       # epoch seconds, int64
+    latitudes: np.ndarray   # float64
+    longitudes: np.ndarray  # float64
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def _subset(self, keep) -> "Track":
+        return Track(self.vehicle_id, self.times[keep], self.latitudes[keep], self.longitudes[keep])
+
+    def distances_m(self) -> np.ndarray:
+        """Length of each segment (len - 1)"""
+        return haversine_m(self.latitudes[:-1], self.longitudes[:-1], self.latitudes[1:], self.longitudes[1:])
+
+    def total_distance_m(self) -> float:
+        return float(self.distances_m().sum())
+
+    def speeds_kmh(self) -> np.ndarray:
+        """Average speed over each segment (len - 1)"""
+        return self.distances_m() / np.diff(self.times) * 3.6
+
+    def headings_deg(self) -> np.ndarray:
+        """Bearing of each segment (len - 1)"""
+        return bearing_deg(self.latitudes[:-1], self.longitudes[:-1], self.latitudes[1:], self.longitudes[1:])
+
+    def kinematics(self) -> pd.DataFrame:
+        """Points with the distance, speed and heading of the segment ending at each"""
+        def leading_nan(values):
+            return np.concatenate([[np.nan], values]) if len(self) else values
+
+        return pd.DataFrame({
+            "vehicle_id": self.vehicle_id,
+            "time": pd.to_datetime(self.times, unit="s", utc=True),
+            "latitude": self.latitudes,
+            "longitude": self.longitudes,
+            "distance_m": leading_nan(self.distances_m()),
+            "speed_kmh": leading_nan(self.speeds_kmh()),
+            "heading_deg": leading_nan(self.headings_deg()),
+        })
+
+    def simplify(self, tolerance_m: float) -> "Track":
+        """Douglas-Peucker: drop points within tolerance_m of the simplified line"""
+        if len(self) < 3:
+            return self
+
+        # Local equirectangular projection is accurate to well under a metre
+        # over the extent of one city
+        scale = np.cos(np.radians(self.latitudes.mean()))
+        x = self.longitudes * scale * METERS_PER_DEGREE_LAT
+        y = self.latitudes * METERS_PER_DEGREE_LAT
+
+        keep = np.zeros(len(self), dtype=bool)
+        keep[[0, -1]] = True
+        stack = [(0, len(self) - 1)]
+        while stack:
+            first, last = stack.pop()
+            if last - first < 2:
+                continue
+            dx, dy = x[last] - x[first], y[last] - y[first]
+            px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+            length_sq = dx * dx + dy * dy
+            if length_sq == 0:
+                distances = np.hypot(px, py)
+            else:
+                along = np.clip((px * dx + py * dy) / length_sq, 0, 1)
+                distances = np.hypot(px - along * dx, py - along * dy)
+
+            index = int(np.argmax(distances))
+            if distances[index] > tolerance_m:
+                split = first + 1 + index
+                keep[split] = True
+                stack.append((first, split))
+                stack.append((split, last))
+        return self._subset(keep)
+
+    def resample(self, interval_seconds: int) -> "Track":
+        """Keep the first point in each interval_seconds window (and the last point)"""
+        if len(self) < 3:
+            return self
+        bins = self.times // interval_seconds
+        keep = np.concatenate([[True], bins[1:] != bins[:-1]])
+        keep[-1] = True
+        return self._subset(keep)
+
+
+_TRACK_COLUMNS = "vehicle_id, timestamp, collected_at, latitude, longitude"
+
+
+def _track_query(vehicle_count: int, start, end, table: str = "vehicle_positions") -> tuple:
+    conditions = ["latitude IS NOT NULL", "longitude IS NOT NULL"]
+    params = []
+    if vehicle_count:
+        conditions.append(f"vehicle_id IN ({', '.join('?' for _ in range(vehicle_count))})")
+    else:
+        conditions.append("vehicle_id IS NOT NULL")
+    if start is not None:
+        conditions.append("collected_at >= ?")
+        params.append(str(start))
+    if end is not None:
+        conditions.append("collected_at <= ?")
+        params.append(str(end))
+    return (f"SELECT {_TRACK_COLUMNS} FROM {table} WHERE {' AND '.join(conditions)} "
+            f"ORDER BY vehicle_id, collected_at"), params
+
+
+def load_tracks(conn: sqlite3.Connection, vehicle_ids=None, start=None, end=None) -> dict:
+    """{vehicle_id: Track} for the given vehicles (default all) between start and end
+
+    Times are the vehicle's GPS timestamps; rows that repeat the previous fix
+    (the vehicle had not reported again yet) are dropped. Archived days are
+    read from their partitions, and days past retention from the
+    downsampled history.
+    """
+    vehicle_ids = [vehicle_ids] if isinstance(vehicle_ids, str) else list(vehicle_ids or [])
+    query, params = _track_query(len(vehicle_ids), start, end)
+    if is_encoded(conn):
+        main_query, _ = _track_query(len(vehicle_ids), start, end, table=POSITIONS_BY_VEHICLE)
+    else:
+        main_query = query
+    batches = []
+    if expired_days(conn, start, end):
+        downsampled, _ = _track_query(len(vehicle_ids), start, end, table="positions_downsampled")
+        batches.append(conn.execute(downsampled, vehicle_ids + params).fetchall())
+    with range_sources(conn, start, end) as sources:
+        batches += [source.execute(main_query if source is conn else query, vehicle_ids + params).fetchall()
+                    for source in sources]
+    batches = [batch for batch in batches if batch]
+    if not batches:
+        return {}
+    rows = batches[0]
+    if len(batches) > 1:
+        # Each source is ordered by vehicle; times are sorted per vehicle below
+        rows = sorted((row for batch in batches for row in batch), key=itemgetter(0))
+
+    vehicles, timestamps, collected, latitudes, longitudes = zip(*rows)
+    times = np.array([
+        ts if ts is not None else int(datetime.fromisoformat(at).timestamp())
+        for ts, at in zip(timestamps, collected)
+    ], dtype=np.int64)
+    latitudes = np.array(latitudes, dtype=np.float64)
+    longitudes = np.array(longitudes, dtype=np.float64)
+    vehicles = np.array(vehicles, dtype=object)
+
+    tracks = {}
+    boundaries = np.flatnonzero(vehicles[1:] != vehicles[:-1]) + 1
+    for first, last in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(rows)]])):
+        segment = slice(first, last)
+        order = np.argsort(times[segment], kind="stable")
+        t = times[segment][order]
+        fresh = np.concatenate([[True], t[1:] != t[:-1]])
+        tracks[vehicles[first]] = Track(
+            vehicles[first], t[fresh],
+            latitudes[segment][order][fresh], longitudes[segment][order][fresh]
+        )
+    return tracks
+
+
+def create_indexes(cursor: sqlite3.Cursor):
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_positions_vehicle_time ON vehicle_positions_fact(vehicle_sk, collected_at)"
+    )
+
+
+if __name__ == "__main__":
+    import time
+    from config import DATABASE_PATH
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    start = time.perf_counter()
+    tracks = load_tracks(conn)
+    elapsed = time.perf_counter() - start
+
+    points = sum(len(track) for track in tracks.values())
+    simplified = sum(len(track.simplify(25)) for track in tracks.values())
+    distance = sum(track.total_distance_m() for track in tracks.values())
+    print(f"Loaded {len(tracks):,} tracks, {points:,} fixes in {elapsed:.2f}s")
+    print(f"Douglas-Peucker at 25 m keeps {simplified:,} points ({simplified / max(points, 1):.0%})")
+    print(f"Fleet distance covered: {distance / 1000:,.1f} km")
+    conn.close()
@@ -0,0 +1,103 @@
+"""
+Live Vehicle State
+One row per vehicle holding its most recent position, upserted inside each
+ingest transaction. Vehicles that drop out of the feed age out after
+VEHICLE_STALE_SECONDS, so the table stays the size of the live fleet.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+import pandas as pd
+from config import VEHICLE_STALE_SECONDS
+from bulk_writer import POSITION_COLUMNS
+
+_VEHICLE_ID = 1 + POSITION_COLUMNS.index("vehicle_id")
+
+_UPSERT = f"""
+    INSERT INTO vehicle_latest (collected_at, {", ".join(POSITION_COLUMNS)})
+    VALUES (?, {", ".join("?" for _ in POSITION_COLUMNS)})
+    ON CONFLICT (vehicle_id) DO UPDATE SET
+        {", ".join(f"{name} = excluded.{name}" for name in ("collected_at", *POSITION_COLUMNS) if name != "vehicle_id")}
+    WHERE excluded.collected_at >= vehicle_latest.collected_at
+"""
+
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vehicle_latest (
+            vehicle_id TEXT PRIMARY KEY,
+            collected_at TIMESTAMP NOT NULL,
+            trip_id TEXT,
+            route_id TEXT,
+            latitude REAL,
+            longitude REAL,
+            timestamp INTEGER,
+            start_time TEXT,
+            start_date TEXT,
+            direction_id INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_latest_time ON vehicle_latest(collected_at)")
+
+
+def _cutoff(collected_at: str, max_age_seconds: int) -> str:
+    return str(datetime.fromisoformat(str(collected_at)) - timedelta(seconds=max_age_seconds))
+
+
+def update_vehicle_latest(conn: sqlite3.Connection, cycle):
+    """Ingest hook: upsert each vehicle's position and drop vehicles gone stale"""
+    if not len(cycle.positions):
+        return
+    conn.executemany(_UPSERT, (row for row in cycle.position_rows() if row[_VEHICLE_ID] is not None))
+    conn.execute("DELETE FROM vehicle_latest WHERE collected_at < ?",
+                 (_cutoff(cycle.collected_at, VEHICLE_STALE_SECONDS),))
+
+
+def latest_positions(conn: sqlite3.Connection, max_age_seconds: int = VEHICLE_STALE_SECONDS,
+                     bbox: tuple = None) -> pd.DataFrame:
+    """Vehicles seen within max_age_seconds of the newest cycle
+
+    Age is measured from the newest row rather than the clock, so a database
+    that is no longer collecting still shows its last fleet. `bbox` is
+    (min_lat, min_lon, max_lat, max_lon).
+    """
+    newest = conn.execute("SELECT MAX(collected_at) FROM vehicle_latest").fetchone()[0]
+    if newest is None:
+        return pd.read_sql("SELECT * FROM vehicle_latest LIMIT 0", conn)
+
+    conditions, params = ["collected_at >= ?"], [_cutoff(newest, max_age_seconds)]
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        conditions += ["latitude BETWEEN ? AND ?", "longitude BETWEEN ? AND ?"]
+        params += [min_lat, max_lat, min_lon, max_lon]
+    return pd.read_sql(
+        f"SELECT * FROM vehicle_latest WHERE {' AND '.join(conditions)} ORDER BY vehicle_id",
+        conn, params=params
+    )
+
+
+def backfill(conn: sqlite3.Connection):
+    """Rebuild from the last stale window of vehicle_positions"""
+    conn.execute("DELETE FROM vehicle_latest")
+    newest = conn.execute("SELECT MAX(collected_at) FROM vehicle_positions").fetchone()[0]
+    if newest is not None:
+        conn.execute(f"""
+            INSERT INTO vehicle_latest (collected_at, {", ".join(POSITION_COLUMNS)})
+            SELECT collected_at, {", ".join(POSITION_COLUMNS)}
+            FROM vehicle_positions
+            WHERE id IN (
+                SELECT MAX(id) FROM vehicle_positions
+                WHERE collected_at >= ? AND vehicle_id IS NOT NULL
+                GROUP BY vehicle_id
+            )
+        """, (_cutoff(newest, VEHICLE_STALE_SECONDS),))
+    conn.commit()
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    if conn.execute("SELECT 1 FROM vehicle_latest LIMIT 1").fetchone():
+        return False
+    if not conn.execute("SELECT 1 FROM vehicle_positions LIMIT 1").fetchone():
+        return False
+    print("Backfilling live vehicle state from existing data...")
+    backfill(conn)
+    return True